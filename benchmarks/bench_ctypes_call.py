@@ -0,0 +1,104 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+Compare calls/sec of the old per-call symbol lookup against prebound
+prototypes.
+
+With a VHD path, vhd_io_read is timed reading one sector.  Without one,
+libc's memset stands in for it (same shape: pointer, int, size) so the
+binding overhead can be measured on hosts without libvhd.so.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import time
+
+import libvhd.libvhd as libvhd
+import libvhd.utils.utils as utils
+
+
+def _rate(fn, seconds):
+    calls = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for _ in xrange(1000):
+            fn()
+        calls += 1000
+    return calls / seconds
+
+
+def _libc_calls():
+    handle = ctypes.CDLL(ctypes.util.find_library('c'))
+    buf = utils.AlignedBuffer(libvhd.VHD_SECTOR_SIZE)
+
+    def before():
+        # What _call used to do: look the symbol up and box every argument
+        fn = getattr(handle, 'memset')
+        fn(buf.get_pointer(), ctypes.c_int(0),
+           ctypes.c_uint(libvhd.VHD_SECTOR_SIZE))
+
+    bound = ctypes.CDLL(ctypes.util.find_library('c')).memset
+    bound.restype = ctypes.c_void_p
+    bound.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_size_t]
+    addr = buf.buf_addr
+
+    def after():
+        bound(addr, 0, libvhd.VHD_SECTOR_SIZE)
+
+    return before, after
+
+
+def _vhd_calls(filename):
+    vhd = libvhd.VHD(filename)
+    buf = utils.AlignedBuffer(libvhd.VHD_SECTOR_SIZE)
+    handle = utils._get_libvhd_handle()
+
+    def before():
+        fn = getattr(handle, 'vhd_io_read')
+        fn(ctypes.pointer(vhd.vhd_context), buf.get_pointer(),
+           ctypes.c_ulonglong(0), ctypes.c_uint(1))
+
+    requests = [(buf, 0, 1)]
+
+    def after():
+        vhd.io_readv(requests)
+
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('vhd', nargs='?',
+                        help="VHD to read from (uses libc if omitted)")
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.vhd:
+        before, after = _vhd_calls(args.vhd)
+    else:
+        before, after = _libc_calls()
+
+    before_rate = _rate(before, args.seconds)
+    after_rate = _rate(after, args.seconds)
+    print("per-call lookup: %12.0f calls/sec" % before_rate)
+    print("prebound:        %12.0f calls/sec" % after_rate)
+    print("speedup:         %12.2fx" % (after_rate / before_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+Throughput and latency benchmarks for python-libvhd.
+
+Synthetic raw images (dense, and sparse with 1 in 8 blocks written) are
+generated from a fixed seed, converted to VHD and back, and the VHD is
+read and written at several chunk sizes.  Results are printed as JSON so
+runs can be diffed to catch regressions.
+
+Uses libvhd.so when asked to, otherwise the pure-Python backend in
+libvhd.pyvhd.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import libvhd.libvhd as libvhd
+import libvhd.pyvhd as pyvhd
+import libvhd.utils.utils as utils
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+BLOCK_SIZE = 1 << libvhd.VHD_BLOCK_SHIFT
+IO_CHUNK_SECS = [1, 8, 64, 512, 4096]
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+
+def _best_of(repeat, fn, *args, **kwargs):
+    return min(_timed(fn, *args, **kwargs) for _ in xrange(repeat))
+
+
+def make_raw(filename, size, sparse, seed=0):
+    """Write a synthetic raw image.  Dense images are random data
+    throughout; sparse ones only have every eighth block written.
+    """
+    rand = random.Random(seed)
+    block = ''.join(chr(rand.randint(0, 255)) for _ in xrange(4096))
+    block *= BLOCK_SIZE // len(block)
+    with open(filename, 'wb') as f:
+        f.truncate(size)
+        for offset in xrange(0, size, BLOCK_SIZE):
+            if sparse and (offset // BLOCK_SIZE) % 8:
+                continue
+            f.seek(offset)
+            f.write(block[:size - offset])
+
+
+def bench_convert(workdir, size, repeat):
+    results = {}
+    for kind in ('dense', 'sparse'):
+        raw = os.path.join(workdir, '%s.raw' % kind)
+        vhd = os.path.join(workdir, '%s.vhd' % kind)
+        out = os.path.join(workdir, '%s.out' % kind)
+        make_raw(raw, size, kind == 'sparse')
+        secs = _best_of(repeat, libvhd.vhd_convert_from_raw, raw, vhd,
+                        sparse=True)
+        results['convert_from_raw_%s' % kind] = {
+                'mb_per_sec': size / float(MB) / secs, 'seconds': secs}
+        secs = _best_of(repeat, libvhd.vhd_convert_to_raw, vhd, out,
+                        sparse=True)
+        results['convert_to_raw_%s' % kind] = {
+                'mb_per_sec': size / float(MB) / secs, 'seconds': secs}
+    return results
+
+
+def bench_io(workdir, size, repeat):
+    """Latency of sequential io_read/io_write calls by chunk size."""
+    filename = os.path.join(workdir, 'io.vhd')
+    libvhd.vhd_create(filename, size)
+    vhd = libvhd.VHD(filename, 'rdwr')
+    total_secs = size // SECTOR
+    results = {}
+    for chunk_secs in IO_CHUNK_SECS:
+        buf = utils.AlignedBuffer(chunk_secs * SECTOR)
+        calls = min(total_secs // chunk_secs, 2000)
+        for op, fn in (('write', vhd.io_write), ('read', vhd.io_read)):
+            def _run():
+                for i in xrange(calls):
+                    fn(buf, i * chunk_secs, chunk_secs)
+            secs = _best_of(repeat, _run)
+            nbytes = calls * chunk_secs * SECTOR
+            results['io_%s_%d_secs' % (op, chunk_secs)] = {
+                    'usec_per_call': secs / calls * 1e6,
+                    'mb_per_sec': nbytes / float(MB) / secs}
+    vhd.close()
+    return results
+
+
+def bench_buffer(repeat):
+    """Cost of moving a 2 MiB chunk in and out of an AlignedBuffer."""
+    data = 'x' * BLOCK_SIZE
+    buf = utils.AlignedBuffer(BLOCK_SIZE)
+    calls = 200
+    results = {}
+    for name, fn in (('write', lambda: buf.write(data)),
+                     ('read', lambda: buf.read()),
+                     ('view', lambda: buf.view()),
+                     ('nonzero_sector_runs',
+                      lambda: buf.nonzero_sector_runs())):
+        def _run():
+            for _ in xrange(calls):
+                fn()
+        secs = _best_of(repeat, _run)
+        results['buffer_%s_2mb' % name] = {
+                'usec_per_call': secs / calls * 1e6}
+    return results
+
+
+def bench_header(workdir, repeat):
+    filename = os.path.join(workdir, 'hdr.vhd')
+    libvhd.vhd_create(filename, 64 * MB)
+    vhd = libvhd.VHD(filename)
+    calls = 2000
+
+    fields = libvhd.VHDHeaderInfo._fields
+
+    def _run():
+        for _ in xrange(calls):
+            # get_header() caches its result; drop it so each call
+            # builds and decodes a new VHDHeaderInfo.
+            vhd._header_info = None
+            hdr = vhd.get_header()
+            for field in fields:
+                getattr(hdr, field)
+    secs = _best_of(repeat, _run)
+    vhd.close()
+    return {'get_header': {'usec_per_call': secs / calls * 1e6}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=64,
+                        help="Image size in MiB (default 64)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per benchmark, best is kept")
+    parser.add_argument('--backend', choices=['python', 'libvhd'],
+                        default='python')
+    parser.add_argument('--workdir',
+                        help="Directory for images (default: a temp dir)")
+    parser.add_argument('--output', help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.backend == 'python':
+        utils._libvhd_handle = pyvhd.PyLibVHD()
+    size = args.size * MB
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        results = {}
+        results.update(bench_convert(workdir, size, args.repeat))
+        results.update(bench_io(workdir, size, args.repeat))
+        results.update(bench_buffer(args.repeat))
+        results.update(bench_header(workdir, args.repeat))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {'backend': args.backend,
+              'python': platform.python_version(),
+              'size_mb': args.size,
+              'repeat': args.repeat,
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+asyncio front end to VHD I/O and the long-running operations.
+
+Every call here returns an asyncio future, to be awaited (or yielded
+from) by a coroutine; the blocking work runs on a thread pool so the
+event loop keeps serving other coroutines meanwhile.  Needs asyncio, or
+trollius and the futures backport on Python 2; installing the 'aio'
+extra (pip install python-libvhd[aio]) pulls them in.  Without them the
+module still imports, and an AsyncVHD given a loop and an executor of
+its own works, but IOExecutor and the default event loop raise
+ImportError.
+"""
+
+import functools
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+import libvhd
+import utils.pipeline as pipeline
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_IO_SECS = 4096
+
+
+def _check_backports():
+    if asyncio is None or futures is None:
+        raise ImportError("libvhd.aio needs asyncio, or trollius and "
+                          "futures: pip install python-libvhd[aio]")
+
+
+def _event_loop(loop):
+    if loop is None:
+        _check_backports()
+        loop = asyncio.get_event_loop()
+    return loop
+
+
+class IOExecutor(object):
+    """A thread pool running at most 'concurrency' VHD reads and writes
+    at once, each with an aligned buffer of 'max_io_secs' sectors from a
+    shared pool.  One IOExecutor can serve any number of AsyncVHDs.
+    """
+
+    def __init__(self, concurrency=None, max_io_secs=None):
+        if concurrency is None:
+            concurrency = DEFAULT_CONCURRENCY
+        if max_io_secs is None:
+            max_io_secs = DEFAULT_MAX_IO_SECS
+        _check_backports()
+        self.concurrency = concurrency
+        self.max_io_secs = max_io_secs
+        self.executor = futures.ThreadPoolExecutor(concurrency)
+        # Workers never hold more than one buffer each
+        self.buffers = pipeline.BufferPool(concurrency,
+                max_io_secs * libvhd.VHD_SECTOR_SIZE,
+                alignment=libvhd.VHD_SECTOR_SIZE)
+
+    def run(self, loop, fn, *args):
+        return loop.run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+_default_io = None
+_default_io_lock = threading.Lock()
+
+
+def default_io_executor():
+    """The IOExecutor AsyncVHDs use unless given one."""
+    global _default_io
+    with _default_io_lock:
+        if _default_io is None:
+            _default_io = IOExecutor()
+        return _default_io
+
+
+class AsyncVHD(object):
+    """Wraps an open libvhd.VHD for use from coroutines.
+
+    Operations on one AsyncVHD run one at a time, since a libvhd context
+    can't be used from several threads at once; operations on different
+    AsyncVHDs run concurrently, up to the IOExecutor's limit.
+    """
+
+    def __init__(self, vhd, loop=None, io_executor=None):
+        loop = _event_loop(loop)
+        if io_executor is None:
+            io_executor = default_io_executor()
+        self.vhd = vhd
+        self.loop = loop
+        self.io = io_executor
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename, flags=None, loop=None, io_executor=None,
+             **kwargs):
+        """Open a VHD off the event loop.  Returns a future for the
+        AsyncVHD; other arguments are passed on to libvhd.VHD.
+        """
+        loop = _event_loop(loop)
+        if io_executor is None:
+            io_executor = default_io_executor()
+
+        def _open():
+            return cls(libvhd.VHD(filename, flags, **kwargs), loop=loop,
+                       io_executor=io_executor)
+        return io_executor.run(loop, _open)
+
+    def _run(self, fn, *args):
+        return self.io.run(self.loop, fn, *args)
+
+    def read(self, cur_sec, num_secs):
+        """Read sectors; returns a future for the data as a str."""
+        return self._run(self._read, cur_sec, num_secs)
+
+    def write(self, cur_sec, data):
+        """Write 'data', a whole number of sectors, from 'cur_sec' on.
+        Returns a future that completes once it's written.
+        """
+        return self._run(self._write, cur_sec, data)
+
+    def close(self):
+        return self._run(self._close)
+
+    # Each takes the VHD's lock before a pooled buffer, so calls queued
+    # behind a slow VHD don't hold buffers other VHDs could use
+
+    def _read(self, cur_sec, num_secs):
+        max_secs = self.io.max_io_secs
+        chunks = []
+        with self._lock:
+            buf = self.io.buffers.get()
+            try:
+                while num_secs:
+                    count = min(num_secs, max_secs)
+                    self.vhd.io_read(buf, cur_sec, count)
+                    chunks.append(buf.read(
+                            size=count * libvhd.VHD_SECTOR_SIZE))
+                    cur_sec += count
+                    num_secs -= count
+            finally:
+                self.io.buffers.put(buf)
+        return ''.join(chunks)
+
+    def _write(self, cur_sec, data):
+        if len(data) % libvhd.VHD_SECTOR_SIZE:
+            raise libvhd.exceptions.VHDInvalidSize("data is not a multiple "
+                    "of %d bytes" % libvhd.VHD_SECTOR_SIZE)
+        max_bytes = self.io.max_io_secs * libvhd.VHD_SECTOR_SIZE
+        with self._lock:
+            buf = self.io.buffers.get()
+            try:
+                for offset in xrange(0, len(data), max_bytes):
+                    chunk = data[offset:offset + max_bytes]
+                    buf.write(chunk)
+                    self.vhd.io_write(buf, cur_sec,
+                                      len(chunk) // libvhd.VHD_SECTOR_SIZE)
+                    cur_sec += len(chunk) // libvhd.VHD_SECTOR_SIZE
+            finally:
+                self.io.buffers.put(buf)
+
+    def _close(self):
+        with self._lock:
+            self.vhd.close()
+
+
+def _in_executor(fn):
+    """Make an async version of a blocking function.  It takes the same
+    arguments plus 'loop' and 'executor', and returns a future.  The
+    default executor is the loop's; these calls run for a long time, so
+    they don't take slots from the IOExecutor.
+    """
+    @functools.wraps(fn)
+    def _async(*args, **kwargs):
+        loop = _event_loop(kwargs.pop('loop', None))
+        executor = kwargs.pop('executor', None)
+        return loop.run_in_executor(executor,
+                                    functools.partial(fn, *args, **kwargs))
+    return _async
+
+
+vhd_create = _in_executor(libvhd.vhd_create)
+vhd_import_stream = _in_executor(libvhd.vhd_import_stream)
+vhd_convert_from_raw = _in_executor(libvhd.vhd_convert_from_raw)
+vhd_convert_to_raw = _in_executor(libvhd.vhd_convert_to_raw)
+vhd_flatten = _in_executor(libvhd.vhd_flatten)
+vhd_coalesce = _in_executor(libvhd.vhd_coalesce)
+vhd_export_delta = _in_executor(libvhd.vhd_export_delta)
+vhd_apply_delta = _in_executor(libvhd.vhd_apply_delta)
+vhd_sync_export = _in_executor(libvhd.vhd_sync_export)
+vhd_sync_apply = _in_executor(libvhd.vhd_sync_apply)
@@ -0,0 +1,92 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+LRU cache of VHD block contents.
+
+Entries are keyed by (file uuid, block number) and hold the block as the
+file with that uuid presents it, parents included.  A BlockCache can be
+passed to several VHD objects; children of the same parent then share
+the entries for blocks they haven't written themselves.
+"""
+
+import collections
+import threading
+
+
+class BlockCache(object):
+
+    def __init__(self, max_bytes):
+        """Create a cache holding at most max_bytes of block data."""
+        self.max_bytes = max_bytes
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        """Return the data cached for key, or None."""
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._blocks[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Cache data for key, evicting the least recently used entries
+        to stay within max_bytes.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._blocks[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is not None:
+                self.bytes -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._blocks),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
@@ -0,0 +1,253 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+Index of which VHDs in a directory are parents of which.
+
+scan_directory() reads just the footer and header of each file with
+libvhd.VHDMetadata, on a pool of threads, and links the files by uuid;
+the BATs are never loaded.  Given a cache file, it remembers what it
+read along with each file's mtime and size, and a rescan only reads the
+files that changed.
+"""
+
+import errno
+import fnmatch
+import json
+import multiprocessing.pool
+import os
+import uuid
+
+import libvhd
+import utils.exceptions as exceptions
+
+SCAN_WORKERS = 8
+CACHE_VERSION = 1
+
+_DIFFERENCING = libvhd.VHD_DISK_TYPES['differencing']
+
+
+class VHDInfo(object):
+    """What the chain index knows about one VHD file."""
+    __slots__ = ('path', 'mtime', 'size', 'uuid', 'disk_type',
+                 'virtual_size', 'parent_uuid', 'parent_name')
+
+    def __init__(self, path, mtime, size, uuid, disk_type, virtual_size,
+                 parent_uuid=None, parent_name=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.uuid = uuid
+        self.disk_type = disk_type
+        self.virtual_size = virtual_size
+        self.parent_uuid = parent_uuid
+        self.parent_name = parent_name
+
+    def to_json(self):
+        return [self.mtime, self.size, str(self.uuid), self.disk_type,
+                self.virtual_size,
+                self.parent_uuid and str(self.parent_uuid),
+                self.parent_name]
+
+    @classmethod
+    def from_json(cls, path, values):
+        (mtime, size, disk_uuid, disk_type, virtual_size, parent_uuid,
+         parent_name) = values
+        return cls(path, mtime, size, uuid.UUID(disk_uuid), disk_type,
+                   virtual_size, parent_uuid and uuid.UUID(parent_uuid),
+                   parent_name)
+
+    def __repr__(self):
+        return "<VHDInfo %s: %s>" % (self.path, self.uuid)
+
+
+def read_info(path, st=None):
+    """Read a VHDInfo from the footer and header of a file, through
+    libvhd.VHDMetadata.  Raises VHDOpenFailure if it isn't a VHD.
+    """
+    if st is None:
+        st = os.stat(path)
+    meta = libvhd.VHDMetadata(path)
+    footer = meta.footer
+    info = VHDInfo(path, st.st_mtime, st.st_size,
+                   uuid.UUID(bytes=libvhd._raw_field(footer, 'uuid')),
+                   footer.type, footer.curr_size)
+    if footer.type == _DIFFERENCING:
+        info.parent_uuid = uuid.UUID(
+                bytes=libvhd._raw_field(meta.header, 'prt_uuid'))
+        info.parent_name = meta._decode_parent_name().decode('utf-8')
+    return info
+
+
+class ChainIndex(object):
+    """The VHDs found by scan_directory(), linked parent to child by
+    uuid.  'errors' maps the paths that couldn't be read to the reason.
+    """
+
+    def __init__(self, infos, errors=None):
+        self.errors = errors or {}
+        self.by_path = {}
+        self.by_uuid = {}
+        self._children = {}
+        # Sorted, so that if two files share a uuid the same one wins
+        for info in sorted(infos, key=lambda info: info.path):
+            self.by_path[info.path] = info
+            self.by_uuid.setdefault(info.uuid, info)
+        for info in self.by_uuid.itervalues():
+            if info.parent_uuid is not None:
+                self._children.setdefault(info.parent_uuid, []).append(info)
+        for children in self._children.itervalues():
+            children.sort(key=lambda info: info.path)
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def __iter__(self):
+        return iter(sorted(self.by_path.itervalues(),
+                           key=lambda info: info.path))
+
+    def get(self, disk_uuid):
+        return self.by_uuid.get(disk_uuid)
+
+    def parent(self, disk_uuid):
+        """The parent of a VHD, or None if it has none or it isn't in
+        the index.
+        """
+        info = self.by_uuid[disk_uuid]
+        if info.parent_uuid is None:
+            return None
+        return self.by_uuid.get(info.parent_uuid)
+
+    def children(self, disk_uuid):
+        return list(self._children.get(disk_uuid, []))
+
+    def chain(self, disk_uuid):
+        """The VHD and its ancestors, child first, as far as the index
+        goes.
+        """
+        chain = [self.by_uuid[disk_uuid]]
+        seen = set([disk_uuid])
+        while True:
+            parent = self.parent(chain[-1].uuid)
+            if parent is None or parent.uuid in seen:
+                return chain
+            chain.append(parent)
+            seen.add(parent.uuid)
+
+    def depth(self, disk_uuid):
+        """Chain depth, counted as VHD.get_chain_depth() does.  Only
+        meaningful when the whole chain is in the index; see orphans().
+        """
+        return len(self.chain(disk_uuid))
+
+    def roots(self):
+        """VHDs that aren't differencing disks."""
+        return [info for info in self if info.parent_uuid is None]
+
+    def leaves(self):
+        """VHDs that nothing in the index is a child of."""
+        return [info for info in self if info.uuid not in self._children]
+
+    def orphans(self):
+        """Differencing disks whose parent isn't in the index."""
+        return [info for info in self if info.parent_uuid is not None and
+                info.parent_uuid not in self.by_uuid]
+
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            data = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return {}
+        raise
+    except ValueError:
+        # Corrupt; everything gets read again
+        return {}
+    if data.get('version') != CACHE_VERSION:
+        return {}
+    infos = {}
+    for path, values in data['entries'].iteritems():
+        infos[path] = VHDInfo.from_json(path, values)
+    return infos
+
+
+def _save_cache(cache_file, infos):
+    data = {'version': CACHE_VERSION,
+            'entries': dict((info.path, info.to_json()) for info in infos)}
+    tmp = '%s.tmp.%d' % (cache_file, os.getpid())
+    with open(tmp, 'wb') as f:
+        json.dump(data, f)
+    os.rename(tmp, cache_file)
+
+
+def _read_one(args):
+    path, st = args
+    try:
+        return read_info(path, st), None
+    except (IOError, OSError, exceptions.VHDOpenFailure) as e:
+        return None, str(e)
+    except ValueError as e:
+        # A corrupt header, such as a parent name that isn't UTF-16
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+def scan_directory(dirname, cache_file=None, pattern='*.vhd', workers=None):
+    """Build a ChainIndex of the files in 'dirname' matching 'pattern'.
+
+    If 'cache_file' is given, entries whose path, mtime and size are
+    unchanged since it was written are taken from it rather than read,
+    and it is rewritten with the result.  'workers' threads read the
+    rest, SCAN_WORKERS by default.
+    """
+    if workers is None:
+        workers = SCAN_WORKERS
+    cached = _load_cache(cache_file) if cache_file else {}
+
+    infos = []
+    to_read = []
+    for name in fnmatch.filter(os.listdir(dirname), pattern):
+        path = os.path.join(dirname, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Deleted since the listing
+            continue
+        info = cached.get(path)
+        if (info is not None and info.mtime == st.st_mtime and
+                info.size == st.st_size):
+            infos.append(info)
+        else:
+            to_read.append((path, st))
+
+    errors = {}
+    if to_read:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(to_read)))
+        try:
+            results = pool.map(_read_one, to_read)
+        finally:
+            pool.close()
+            pool.join()
+        for (path, _), (info, error) in zip(to_read, results):
+            if info is None:
+                errors[path] = error
+            else:
+                infos.append(info)
+
+    if cache_file:
+        _save_cache(cache_file, infos)
+    return ChainIndex(infos, errors)
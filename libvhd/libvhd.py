@@ -19,18 +19,68 @@
 Module for interfacing with xen's vhd library.
 """
 
+import array
+import binascii
 import ctypes
 import ctypes.util
+import errno
+import hashlib
+import io
+import json
+import mmap
 import os
+import re
+import struct
+import threading
+import time
 from utils.utils import _call
 
 import utils.utils as utils
 import utils.exceptions as exceptions
+import utils.pipeline as pipeline
+import observer as vhd_observer
 
 
 VHD_SECTOR_SIZE = 512
 VHD_BLOCK_SHIFT = 21
 
+# BAT entry value for a block that is not allocated in this file
+VHD_BAT_ENTRY_UNUSED = 0xFFFFFFFF
+
+# Default number of sectors the converters move per I/O
+VHD_CONVERT_CHUNK_SECS = 4096
+
+# Default number of threads vhd_flatten() reads the chain with
+VHD_FLATTEN_READERS = 4
+
+# Default number of threads VHD.block_manifest() hashes blocks with
+VHD_MANIFEST_READERS = 4
+
+# Appended to a VHD's name to get its block manifest sidecar
+VHD_MANIFEST_SUFFIX = '.manifest'
+_MANIFEST_VERSION = 1
+
+# Delta streams, see vhd_export_delta(): a header, then records of a
+# (first sector, sector count) pair followed by the sectors, then an end
+# record carrying the total sector count
+_DELTA_MAGIC = 'VHDDELTA'
+_DELTA_VERSION = 1
+_DELTA_HEADER = struct.Struct('>8sIQ16s16s')
+_DELTA_RECORD = struct.Struct('>QQ')
+_DELTA_END = 0xFFFFFFFFFFFFFFFF
+
+# Sync patches, see vhd_sync_export(): a header, then a record per block
+# of a kind, the block number and the block's digest, followed by the
+# block's data for _SYNC_DATA records, then an end record whose block
+# number is the count of records before it
+_SYNC_MAGIC = 'VHDPATCH'
+_SYNC_VERSION = 1
+_SYNC_HEADER = struct.Struct('>8sIQI16sI')
+_SYNC_RECORD = struct.Struct('>BQ')
+_SYNC_DATA = 1
+_SYNC_ZERO = 2
+_SYNC_END = 0xFF
+
 VHD_DISK_TYPES = {
         'fixed': 2,
         'dynamic': 3,
@@ -53,6 +103,16 @@ VHD_PLATFORM_CODES = {
         'PLAT_CODE_MACX': 0x4D616358,  # File URL (UTF-8), see RFC 2396.
 }
 
+_FOOTER_COOKIE = 'conectix'
+_HEADER_COOKIE = 'cxsparse'
+
+# Encodings of the parent locators get_parent_path() understands
+_LOCATOR_ENCODINGS = {
+        VHD_PLATFORM_CODES['PLAT_CODE_MACX']: 'utf-8',
+        VHD_PLATFORM_CODES['PLAT_CODE_W2KU']: 'utf-16-le',
+        VHD_PLATFORM_CODES['PLAT_CODE_W2RU']: 'utf-16-le',
+}
+
 class VHDVersion(object):
 
     def __init__(self, major_minor=None, version=None):
@@ -162,6 +222,132 @@ class VHDBatMap(ctypes.Structure):
             ('map', ctypes.c_void_p)]
 
 
+class VHDAllocationMap(object):
+    """Block allocation state of an opened VHD.
+
+    'bat' is an array('I') with one entry per block holding the sector
+    offset of the block's bitmap within the file, or VHD_BAT_ENTRY_UNUSED
+    if the block isn't allocated in this file.  Fixed disks have no BAT,
+    so every block of a fixed disk is reported as allocated.
+
+    'bitmaps' maps block numbers to raw sector bitmaps for the blocks
+    whose bitmaps were requested.
+    """
+
+    # A run of at least one whole unused entry, whatever the byte order
+    _unused_run_re = re.compile('\xff{4,}')
+
+    def __init__(self, bat, spb, bitmaps=None):
+        self.bat = bat
+        self.spb = spb
+        if bitmaps is None:
+            bitmaps = {}
+        self.bitmaps = bitmaps
+
+    def __len__(self):
+        return len(self.bat)
+
+    def is_allocated(self, block):
+        return self.bat[block] != VHD_BAT_ENTRY_UNUSED
+
+    def num_allocated(self):
+        return len(self.bat) - self.bat.count(VHD_BAT_ENTRY_UNUSED)
+
+    def unallocated_extents(self):
+        """Return a list of (first_block, num_blocks) tuples covering the
+        unallocated blocks, in order.
+        """
+        itemsize = self.bat.itemsize
+        extents = []
+        for m in self._unused_run_re.finditer(self.bat.tostring()):
+            start = -(-m.start() // itemsize)
+            end = m.end() // itemsize
+            if end > start:
+                extents.append((start, end - start))
+        return extents
+
+    def extents(self):
+        """Return a list of (first_block, num_blocks) tuples covering the
+        allocated blocks, in order.
+        """
+        extents = []
+        cur = 0
+        for start, count in self.unallocated_extents():
+            if start > cur:
+                extents.append((cur, start - cur))
+            cur = start + count
+        if cur < len(self.bat):
+            extents.append((cur, len(self.bat) - cur))
+        return extents
+
+    def sector_allocated(self, block, sector):
+        """Return whether a sector (relative to the start of the block)
+        holds data in this file.  The block's bitmap must have been read
+        into the map.
+        """
+        if not self.is_allocated(block):
+            return False
+        return utils.bitmap_test(self.bitmaps[block], sector)
+
+
+class VHDBlockManifest(object):
+    """Content hashes of the blocks of a VHD, from VHD.block_manifest().
+
+    'hashes' is a list with the hex digest of each block, as the VHD
+    presents it (parents included), in block order.  The last block only
+    covers the part of it within the virtual size.
+    """
+
+    def __init__(self, algorithm, block_size, size, hashes):
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.size = size
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getitem__(self, block):
+        return self.hashes[block]
+
+    def __eq__(self, other):
+        return (isinstance(other, VHDBlockManifest) and
+                self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def diff(self, other):
+        """Return the blocks whose contents differ from those described
+        by manifest 'other', in order.  Blocks past the end of the
+        shorter manifest count as different.
+        """
+        if (self.algorithm != other.algorithm or
+                self.block_size != other.block_size):
+            raise exceptions.VHDException("Manifests use different "
+                    "hashes or block sizes")
+        return [block for block in xrange(max(len(self), len(other)))
+                if block >= len(self) or block >= len(other) or
+                self.hashes[block] != other.hashes[block]]
+
+    def to_dict(self):
+        return {'algorithm': self.algorithm,
+                'block_size': self.block_size,
+                'size': self.size,
+                'hashes': list(self.hashes)}
+
+    @classmethod
+    def from_dict(cls, values):
+        # JSON hands back unicode
+        return cls(str(values['algorithm']), values['block_size'],
+                   values['size'], [str(digest) for digest in
+                                    values['hashes']])
+
+    def __repr__(self):
+        return "<VHDBlockManifest %s, %d blocks>" % (self.algorithm,
+                                                     len(self))
+
+
 class VHDContext(ctypes.Structure):
     _fields_ = [
             ('fd', ctypes.c_int),
@@ -178,11 +364,206 @@ class VHDContext(ctypes.Structure):
             ('custom_parent', ctypes.c_char_p)]
 
 
+def _raw_field(struct, name):
+    """Return the raw bytes of a char array field.  Reading the field as
+    an attribute would stop at the first NUL.
+    """
+    field = getattr(type(struct), name)
+    return ctypes.string_at(ctypes.addressof(struct) + field.offset,
+                            field.size)
+
+
+class _VHDInfoBase(object):
+    """Read-only snapshot of a header or footer.  Fields are decoded on
+    first access and kept; they can be read as attributes or, as the
+    dicts get_header() and get_footer() used to return, by key.
+    """
+    __slots__ = ('_raw',)
+    _struct_type = None
+    _fields = ()
+
+    def __init__(self, struct):
+        object.__setattr__(self, '_raw',
+                           self._struct_type.from_buffer_copy(struct))
+
+    def _decode(self, name, val):
+        return val
+
+    def __getattr__(self, name):
+        # Only reached while the field's slot is still empty
+        if name not in self._fields:
+            raise AttributeError(name)
+        val = self._decode(name, getattr(self._raw, name))
+        object.__setattr__(self, name, val)
+        return val
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __getitem__(self, name):
+        if name not in self._fields:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, name, default=None):
+        if name not in self._fields:
+            return default
+        return getattr(self, name)
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self._fields]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.to_dict())
+
+
+class VHDFooterInfo(_VHDInfoBase):
+    _struct_type = VHDFooter
+    _fields = tuple(name for name, _ in VHDFooter._fields_)
+    __slots__ = _fields
+
+
+class VHDHeaderInfo(_VHDInfoBase):
+    _struct_type = VHDHeader
+    _fields = tuple(name for name, _ in VHDHeader._fields_)
+    __slots__ = _fields
+
+    def __init__(self, struct, parent_name):
+        """'parent_name' is decoded by the VHD up front, as that needs
+        the VHD to still be open.
+        """
+        super(VHDHeaderInfo, self).__init__(struct)
+        if parent_name is None:
+            parent_name = 'Cannot read parent name'
+        object.__setattr__(self, 'prt_name', parent_name)
+
+    def _decode(self, name, val):
+        if name == 'prt_uuid':
+            val = utils.uuid_unparse(_raw_field(self._raw, name))
+        elif name == 'hdr_ver':
+            val = VHDVersion(version=val)
+        elif name == 'loc':
+            val = _get_locators(val)
+        return val
+
+
+def _get_locators(raw_locs):
+    locators = []
+    for raw_loc in raw_locs:
+        locator = {}
+        for name, _ in raw_loc._fields_:
+            locator[name] = getattr(raw_loc, name)
+        if locator['code'] != 0L:
+            locators.append(locator)
+
+    return locators
+
+
+def _find_parent_path(filename, footer, header, parent_name):
+    """Resolve the parent of a differencing disk; see
+    VHD.get_parent_path().
+    """
+    if footer.type != VHD_DISK_TYPES['differencing']:
+        raise exceptions.VHDInvalidDiskType("Only differencing disks "
+                "have a parent")
+    candidates = []
+    with io.open(filename, 'rb') as f:
+        for loc in header.loc:
+            encoding = _LOCATOR_ENCODINGS.get(loc.code)
+            if encoding is None or not loc.data_len:
+                continue
+            f.seek(loc.data_offset)
+            path = f.read(loc.data_len).decode(encoding).rstrip(u'\x00')
+            if path.startswith(u'file://'):
+                path = path[len(u'file://'):]
+            if encoding != 'utf-8':
+                path = path.replace(u'\\', u'/')
+            candidates.append(path.encode('utf-8'))
+    if parent_name:
+        candidates.append(parent_name)
+
+    base = os.path.dirname(os.path.abspath(filename))
+    for path in candidates:
+        path = os.path.join(base, path)
+        if os.path.exists(path):
+            return os.path.normpath(path)
+    raise exceptions.VHDOpenFailure("Cannot find the parent of %s" %
+            filename)
+
+
+def _big_endian(struct_type):
+    """A big-endian twin of a ctypes structure, to decode on-disk data."""
+    fields = []
+    for name, field_type in struct_type._fields_:
+        if (issubclass(field_type, ctypes.Array) and
+                issubclass(field_type._type_, ctypes.Structure)):
+            field_type = _big_endian(field_type._type_) * field_type._length_
+        fields.append((name, field_type))
+    return type('BE' + struct_type.__name__, (ctypes.BigEndianStructure,),
+                {'_fields_': fields})
+
+
+def _from_disk(struct_type, disk_type, data):
+    """Decode big-endian 'data' into a new 'struct_type', converting to
+    host order as libvhd does when it reads a footer or header.
+    """
+    return _to_native(disk_type.from_buffer_copy(data), struct_type())
+
+
+def _to_native(src, dest):
+    for name, field_type in dest._fields_:
+        if issubclass(field_type, ctypes.Array):
+            if issubclass(field_type._type_, ctypes.Structure):
+                for src_item, dest_item in zip(getattr(src, name),
+                                               getattr(dest, name)):
+                    _to_native(src_item, dest_item)
+            else:
+                ctypes.memmove(ctypes.addressof(dest) +
+                               getattr(type(dest), name).offset,
+                               _raw_field(src, name),
+                               ctypes.sizeof(field_type))
+        else:
+            setattr(dest, name, getattr(src, name))
+    return dest
+
+
+_BE_FOOTER = _big_endian(VHDFooter)
+_BE_HEADER = _big_endian(VHDHeader)
+
+
 class VHD(object):
     _closed = True
-
-    def __init__(self, filename, flags=None):
-        """Open a VHD."""
+    _map = None
+    _header_info = None
+    _footer_info = None
+    _sidecar_dropped = False
+
+    def __init__(self, filename, flags=None, cache=None, observer=None,
+                 observer_op=None):
+        """Open a VHD.  'cache' is an optional cache.BlockCache that reads
+        are served from; it may be shared with other VHD objects.
+        'observer' is an optional observer.Observer told about the
+        latency of every read and write, as done for the operation named
+        'observer_op'.
+        """
         if flags is None:
             flags = 'rdonly'
         open_flags = 0
@@ -195,6 +576,10 @@ class VHD(object):
 
         self.filename = filename
         self.open_flags = flags
+        self.cache = cache
+        self.observer = observer
+        self.observer_op = observer_op
+        self._block_buf = None
         self.vhd_context = VHDContext()
 
         ret = _call('vhd_open',
@@ -208,6 +593,9 @@ class VHD(object):
         """Close a VHD."""
         if self._closed:
             return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
         _call('vhd_close', ctypes.pointer(self.vhd_context))
         self._closed = True
         self.vhd_context = None
@@ -217,53 +605,221 @@ class VHD(object):
         self.close()
 
     def get_footer(self):
-        """Get the VHD footer data."""
-        ftr = {}
-        footer = self.vhd_context.footer
-        for field, _ in footer._fields_:
-            ftr[field] = getattr(footer, field)
-        return ftr
+        """Get the VHD footer, as a VHDFooterInfo.  It is decoded lazily
+        and cached until something is written through this VHD.
+        """
+        if self._footer_info is None:
+            self._footer_info = VHDFooterInfo(self.vhd_context.footer)
+        return self._footer_info
 
     def get_header(self):
-        """Get the VHD header data."""
-        hdr = {}
-        header = self.vhd_context.header
-        for field, _ in header._fields_:
-            val = getattr(header, field)
-            if field == 'prt_name':
-                buf_type = ctypes.c_char * 512
-                buf_p = ctypes.POINTER(buf_type)()
-                ret = _call('vhd_header_decode_parent',
-                            ctypes.pointer(self.vhd_context),
-                            ctypes.pointer(header),
-                            ctypes.pointer(buf_p))
-                if ret:
-                    val = 'Cannot read parent name'
+        """Get the VHD header, as a VHDHeaderInfo.  It is decoded lazily
+        and cached until something is written through this VHD.
+        """
+        if self._header_info is None:
+            self._header_info = VHDHeaderInfo(self.vhd_context.header,
+                                              self._decode_parent_name())
+        return self._header_info
+
+    def _decode_parent_name(self):
+        """Return the parent name from the header, or None."""
+        buf_type = ctypes.c_char * 512
+        buf_p = ctypes.POINTER(buf_type)()
+        ret = _call('vhd_header_decode_parent',
+                    ctypes.pointer(self.vhd_context),
+                    ctypes.pointer(self.vhd_context.header),
+                    ctypes.pointer(buf_p))
+        if ret:
+            return None
+        return buf_p.contents.value
+
+    def get_parent_path(self):
+        """Return the path of a differencing disk's parent.  As libvhd
+        does, the file URL and Windows path locators are tried before
+        the parent name; relative paths are taken from the directory
+        this VHD is in.
+        """
+        ctx = self.vhd_context
+        return _find_parent_path(self.filename, ctx.footer, ctx.header,
+                                 self._decode_parent_name())
+
+    def _read_bat(self):
+        """Return a copy of the BAT as an array('I')."""
+        ctx = self.vhd_context
+        if ctx.footer.type == VHD_DISK_TYPES['fixed']:
+            block_size = self._block_secs() * VHD_SECTOR_SIZE
+            num_blocks = -(-ctx.footer.curr_size // block_size)
+            return array.array('I', [0]) * num_blocks
+
+        if not ctx.bat.bat:
+            ret = _call('vhd_get_bat', ctypes.pointer(ctx))
+            if ret:
+                raise exceptions.VHDReadError("Error reading BAT: %d" % ret)
+        bat = array.array('I')
+        bat.fromstring(ctypes.string_at(ctx.bat.bat,
+                                        ctx.bat.entries * bat.itemsize))
+        return bat
+
+    def read_bitmap(self, block):
+        """Read the sector bitmap of an allocated block."""
+        buf_p = ctypes.c_void_p()
+        ret = _call('vhd_read_bitmap',
+                    ctypes.pointer(self.vhd_context),
+                    ctypes.c_uint(block),
+                    ctypes.byref(buf_p))
+        if ret:
+            raise exceptions.VHDReadError(
+                    "Error reading bitmap for block %d: %d" % (block, ret))
+        try:
+            return ctypes.string_at(buf_p.value,
+                    self.vhd_context.bm_secs * VHD_SECTOR_SIZE)
+        finally:
+            utils._free(buf_p)
+
+    def allocation_map(self, bitmaps=False):
+        """Return a VHDAllocationMap for this VHD.  If 'bitmaps' is True,
+        the sector bitmap of every allocated block is read as well;
+        it may also be an iterable of the block numbers to read bitmaps for.
+        """
+        bat = self._read_bat()
+        alloc_map = VHDAllocationMap(bat, self._block_secs())
+        if not bitmaps or self.vhd_context.footer.type == \
+                VHD_DISK_TYPES['fixed']:
+            return alloc_map
+
+        if bitmaps is True:
+            blocks = (blk for start, count in alloc_map.extents()
+                      for blk in xrange(start, start + count))
+        else:
+            blocks = bitmaps
+        for block in blocks:
+            if alloc_map.is_allocated(block):
+                alloc_map.bitmaps[block] = self.read_bitmap(block)
+        return alloc_map
+
+    def block_manifest(self, algorithm='md5', readers=None, sidecar=True,
+                       unsafe_trust_bitmaps=False):
+        """Return a VHDBlockManifest hashing each block of this VHD with
+        hashlib's 'algorithm'.  Blocks a dynamic disk hasn't allocated
+        are known to be zero and aren't read; the rest are read and
+        hashed by 'readers' threads, VHD_MANIFEST_READERS by default.
+
+        If 'sidecar' is True the manifest is kept next to the VHD, under
+        VHD_MANIFEST_SUFFIX, and is reused while the footer uuid and
+        timestamp and the file's mtime and size match.  Writing through
+        a VHD object removes the sidecar.  Once the file has changed
+        every allocated block is hashed again.
+
+        'unsafe_trust_bitmaps' reuses the hash of each block whose BAT
+        entry and sector bitmap are unchanged instead.  A sector
+        overwritten in place changes neither, so this is only correct
+        if nothing rewrites sectors that are already allocated.
+        """
+        if readers is None:
+            readers = VHD_MANIFEST_READERS
+        footer = self.vhd_context.footer
+        disk_type = footer.type
+        size = footer.curr_size
+        spb = self._block_secs()
+        block_size = spb * VHD_SECTOR_SIZE
+        total_secs = size // VHD_SECTOR_SIZE
+        num_blocks = -(-total_secs // spb)
+        ident = {'version': _MANIFEST_VERSION,
+                 'uuid': _raw_field(footer, 'uuid').encode('hex'),
+                 'timestamp': footer.timestamp,
+                 'prt_uuid': _raw_field(self.vhd_context.header,
+                                        'prt_uuid').encode('hex'),
+                 'algorithm': algorithm,
+                 'block_size': block_size,
+                 'size': size}
+        sidecar_file = self.filename + VHD_MANIFEST_SUFFIX
+        st = os.stat(self.filename)
+        cached = _load_manifest_sidecar(sidecar_file, ident) if sidecar \
+                else None
+        if (cached is not None and cached['mtime'] == st.st_mtime and
+                cached['file_size'] == st.st_size):
+            return VHDBlockManifest(algorithm, block_size, size,
+                                    [str(digest) for _, digest in
+                                     cached['blocks']])
+
+        # What each block's hash depends on, besides parents, which
+        # don't change while they have children.  Only the sidecar
+        # keeps these, and unsafe_trust_bitmaps compares against it, so
+        # without one the bitmaps aren't read.
+        if disk_type == VHD_DISK_TYPES['fixed']:
+            keys = [None] * num_blocks
+        else:
+            alloc_map = self.allocation_map()
+            keys = []
+            for block in xrange(num_blocks):
+                if block >= len(alloc_map) or \
+                        not alloc_map.is_allocated(block):
+                    keys.append('absent')
+                elif not sidecar:
+                    keys.append(None)
                 else:
-                    val = buf_p.contents.value
-
-            elif field == 'prt_uuid':
-                val = utils.uuid_unparse(val)
+                    bitmap = self.read_bitmap(block)
+                    keys.append([alloc_map.bat[block],
+                                 binascii.crc32(bitmap) & 0xFFFFFFFF])
+
+        hashes = [None] * num_blocks
+        cached_blocks = cached['blocks'] if cached is not None else []
+        jobs = []
+        zero_hashes = {}
+        for block, key in enumerate(keys):
+            secs = min(spb, total_secs - block * spb)
+            if key == 'absent' and disk_type == VHD_DISK_TYPES['dynamic']:
+                if secs not in zero_hashes:
+                    zero_hashes[secs] = hashlib.new(algorithm,
+                            utils._zeros(secs * VHD_SECTOR_SIZE)[
+                                :secs * VHD_SECTOR_SIZE]).hexdigest()
+                hashes[block] = zero_hashes[secs]
+            elif (unsafe_trust_bitmaps and key is not None and
+                    block < len(cached_blocks) and
+                    cached_blocks[block][0] == key):
+                hashes[block] = str(cached_blocks[block][1])
+            else:
+                jobs.append((block, secs))
+
+        if jobs:
+            self._hash_blocks(jobs, hashes, algorithm, spb, readers)
+        if sidecar:
+            ident.update(mtime=st.st_mtime, file_size=st.st_size,
+                         blocks=zip(keys, hashes))
+            _save_manifest_sidecar(sidecar_file, ident)
+            self._sidecar_dropped = False
+        return VHDBlockManifest(algorithm, block_size, size, hashes)
+
+    def _hash_blocks(self, jobs, hashes, algorithm, spb, readers):
+        """Read and hash the (block, secs) jobs into 'hashes', on reader
+        threads that each open their own VHD.
+        """
+        local = threading.local()
+        opened = []
+        opened_lock = threading.Lock()
+
+        def _hash_block(buf, job):
+            vhd = getattr(local, 'vhd', None)
+            if vhd is None:
+                vhd = local.vhd = VHD(self.filename)
+                with opened_lock:
+                    opened.append(vhd)
+            block, secs = job
+            vhd.io_read(buf, block * spb, secs)
+            # hashlib drops the GIL for large updates
+            return hashlib.new(algorithm,
+                               buf.view(size=secs * VHD_SECTOR_SIZE)
+                               ).hexdigest()
+
+        def _store(buf, job, digest):
+            hashes[job[0]] = digest
 
-            elif field == 'hdr_ver':
-                val = VHDVersion(version=val)
-
-            elif field == 'loc':
-                val = self._get_locators(val)
-
-            hdr[field] = val
-        return hdr
-
-    def _get_locators(self, raw_locs):
-        locators = []
-        for raw_loc in raw_locs:
-            locator = {}
-            for name, _ in raw_loc._fields_:
-                locator[name] = getattr(raw_loc, name)
-            if locator['code'] != 0L:
-                locators.append(locator)
-
-        return locators
+        try:
+            pipeline.run(jobs, _hash_block, _store, spb * VHD_SECTOR_SIZE,
+                         alignment=VHD_SECTOR_SIZE, readers=readers)
+        finally:
+            for vhd in opened:
+                vhd.close()
 
     def get_max_virtual_size(self):
         header = self.vhd_context.header
@@ -282,50 +838,411 @@ class VHD(object):
 
         return chain_len.value
 
-    def io_write(self, buf, cur_sec, num_secs):
-        """Write sectors from an aligned buffer into a VHD."""
-        if not isinstance(buf, utils.AlignedBuffer):
-            raise exceptions.VHDInvalidBuffer("buf argument should be a AlignedBuffer"
-                    " instance")
-        ret = _call('vhd_io_write',
-                ctypes.pointer(self.vhd_context),
-                buf.get_pointer(),
-                ctypes.c_ulonglong(cur_sec),
-                ctypes.c_uint(num_secs))
+    def map_range(self, cur_sec, num_secs):
+        """Return a read-only buffer over sectors of a fixed VHD, without
+        copying them.  The data area of a fixed disk is a raw image, so
+        it is memory-mapped on first use and the buffer points into the
+        map; writes made through io_write() show through.  The buffer
+        is only valid until the VHD is closed.
+        """
+        ctx = self.vhd_context
+        if ctx.footer.type != VHD_DISK_TYPES['fixed']:
+            raise exceptions.VHDInvalidDiskType("Only fixed disks can be "
+                    "mapped")
+        size = ctx.footer.curr_size
+        offset = cur_sec * VHD_SECTOR_SIZE
+        length = num_secs * VHD_SECTOR_SIZE
+        if cur_sec < 0 or num_secs < 0 or offset + length > size:
+            raise exceptions.VHDReadError("Sectors %d-%d are past the end "
+                    "of the disk" % (cur_sec, cur_sec + num_secs))
+        if self._map is None:
+            self._map = mmap.mmap(ctx.fd, size, access=mmap.ACCESS_READ)
+        return buffer(self._map, offset, length)
+
+    def iter_extents(self, sparse=True, chunk_secs=None, depth=None):
+        """Generate (byte_offset, data) tuples covering the contents of
+        the VHD, in order.  With 'sparse', blocks that a dynamic disk
+        never allocated and all-zero sectors are left out, so only the
+        regions holding data are produced.
+
+        Reads are done by a separate thread into a pool of 'depth'
+        buffers of 'chunk_secs' sectors, so memory use doesn't grow with
+        the size of the disk.  'data' is a memoryview into one of those
+        buffers and is only valid until the next tuple is requested.
+        Fixed disks are served from map_range() instead, as buffers.
+        """
+        if chunk_secs is None:
+            chunk_secs = VHD_CONVERT_CHUNK_SECS
+        total_sectors = self.vhd_context.footer.curr_size // VHD_SECTOR_SIZE
+        if self.vhd_context.footer.type == VHD_DISK_TYPES['fixed']:
+            return self._iter_mapped_extents(total_sectors, sparse,
+                                             chunk_secs)
+
+        def _chunks():
+            for cur_sec, num_secs in _sector_extents(self, total_sectors,
+                                                     sparse):
+                end_sec = cur_sec + num_secs
+                while cur_sec < end_sec:
+                    num_secs_to_read = min(chunk_secs, end_sec - cur_sec)
+                    yield cur_sec, num_secs_to_read
+                    cur_sec += num_secs_to_read
+
+        def _read_chunk(buf, chunk):
+            cur_sec, num_secs_to_read = chunk
+            self.io_read(buf, cur_sec, num_secs_to_read)
+            if sparse:
+                return buf.nonzero_sector_runs(
+                        size=num_secs_to_read * VHD_SECTOR_SIZE,
+                        sector_size=VHD_SECTOR_SIZE)
+            return [(0, num_secs_to_read)]
+
+        items = pipeline.iterate(_chunks(), _read_chunk,
+                                 VHD_SECTOR_SIZE * chunk_secs, depth=depth,
+                                 alignment=VHD_SECTOR_SIZE)
+        return self._iter_runs(items)
+
+    def _iter_runs(self, items):
+        try:
+            for buf, chunk, runs in items:
+                for start, end in runs:
+                    yield ((chunk[0] + start) * VHD_SECTOR_SIZE,
+                           buf.view(start * VHD_SECTOR_SIZE,
+                                    (end - start) * VHD_SECTOR_SIZE))
+        finally:
+            items.close()
+
+    def _iter_mapped_extents(self, total_sectors, sparse, chunk_secs):
+        for cur_sec in xrange(0, total_sectors, chunk_secs):
+            num_secs = min(chunk_secs, total_sectors - cur_sec)
+            data = self.map_range(cur_sec, num_secs)
+            if not sparse:
+                yield cur_sec * VHD_SECTOR_SIZE, data
+                continue
+            runs = utils.nonzero_sector_runs(self._map,
+                    sector_size=VHD_SECTOR_SIZE,
+                    start=cur_sec * VHD_SECTOR_SIZE,
+                    size=num_secs * VHD_SECTOR_SIZE)
+            for start, end in runs:
+                yield ((cur_sec + start) * VHD_SECTOR_SIZE,
+                       buffer(data, start * VHD_SECTOR_SIZE,
+                              (end - start) * VHD_SECTOR_SIZE))
+
+    def _io_vector(self, fn_name, requests):
+        """Run a libvhd I/O function over a list of requests, resolving
+        the function and the context pointer only once.
+        """
+        fn = utils._get_function(fn_name)
+        if self.cache is not None:
+            if fn_name == 'vhd_io_read':
+                fn = self._cached_read_fn(fn)
+            else:
+                fn = self._invalidating_write_fn(fn)
+        if self.observer is not None:
+            fn = self._timed_fn(fn, 'read' if fn_name == 'vhd_io_read'
+                                else 'write')
+        if fn_name == 'vhd_io_write':
+            # Writes can move the footer and change its timestamps
+            self._header_info = None
+            self._footer_info = None
+        # Check every request before issuing any, so a bad one can't
+        # leave earlier ones done with their results lost
+        checked_buf = None
+        calls = []
+        for request in requests:
+            buf, cur_sec, num_secs = request[:3]
+            offset = request[3] if len(request) > 3 else 0
+            if buf is not checked_buf:
+                if not isinstance(buf, utils.AlignedBuffer):
+                    raise exceptions.VHDInvalidBuffer("buf argument should "
+                            "be a AlignedBuffer instance")
+                checked_buf = buf
+            if (offset < 0 or
+                    offset + num_secs * VHD_SECTOR_SIZE > buf.size):
+                raise exceptions.BufferInvalidSize("%d sectors at offset %d "
+                        "don't fit in the buffer" % (num_secs, offset))
+            calls.append((buf.buf_addr + offset, cur_sec, num_secs))
+        if fn_name == 'vhd_io_write' and not self._sidecar_dropped:
+            # The block manifest sidecar can't tell that sectors were
+            # rewritten in place
+            _drop_manifest_sidecar(self.filename)
+            self._sidecar_dropped = True
+        ctx_p = ctypes.pointer(self.vhd_context)
+        # The prototype converts plain ints on the way in
+        return [fn(ctx_p, addr, cur_sec, num_secs)
+                for addr, cur_sec, num_secs in calls]
+
+    def _timed_fn(self, io_fn, kind):
+        """Wrap an I/O function to report its latency to self.observer."""
+        observer = self.observer
+        op = self.observer_op
+        timer = time.time
+
+        def _timed(ctx_p, addr, cur_sec, num_secs):
+            start = timer()
+            ret = io_fn(ctx_p, addr, cur_sec, num_secs)
+            observer.io(op, kind, num_secs * VHD_SECTOR_SIZE,
+                        timer() - start)
+            return ret
+        return _timed
+
+    def _block_secs(self):
+        """Sectors per block; fixed disks get the default block size."""
+        return self.vhd_context.spb or 1 << (VHD_BLOCK_SHIFT - 9)
+
+    def _bat_entry(self, block):
+        """Return the current BAT entry of a block."""
+        ctx = self.vhd_context
+        if not ctx.bat.bat:
+            ret = _call('vhd_get_bat', ctypes.pointer(ctx))
+            if ret:
+                raise exceptions.VHDReadError("Error reading BAT: %d" % ret)
+        if block >= ctx.bat.entries:
+            return VHD_BAT_ENTRY_UNUSED
+        return ctypes.cast(ctx.bat.bat, ctypes.POINTER(ctypes.c_uint32))[block]
+
+    def _block_cache_key(self, block):
+        """Return the cache key holding a block as this VHD presents it.
+        A block a differencing disk hasn't allocated reads the same as in
+        its parent, so it is keyed by the parent's uuid and shared with
+        the parent's other children.
+        """
+        ctx = self.vhd_context
+        if (ctx.footer.type == VHD_DISK_TYPES['differencing'] and
+                self._bat_entry(block) == VHD_BAT_ENTRY_UNUSED):
+            return (_raw_field(ctx.header, 'prt_uuid'), block)
+        return (_raw_field(ctx.footer, 'uuid'), block)
+
+    def _cached_read_fn(self, read_fn):
+        """Wrap vhd_io_read so whole blocks are read through self.cache."""
+        block_secs = self._block_secs()
+        total_secs = self.vhd_context.footer.curr_size // VHD_SECTOR_SIZE
+        if self._block_buf is None:
+            self._block_buf = utils.AlignedBuffer(
+                    block_secs * VHD_SECTOR_SIZE, alignment=VHD_SECTOR_SIZE)
+        block_buf = self._block_buf
+
+        def _read(ctx_p, addr, cur_sec, num_secs):
+            end_sec = cur_sec + num_secs
+            while cur_sec < end_sec:
+                block = cur_sec // block_secs
+                block_sec = block * block_secs
+                key = self._block_cache_key(block)
+                data = self.cache.get(key)
+                if data is None:
+                    secs = min(block_secs, total_secs - block_sec)
+                    ret = read_fn(ctx_p, block_buf.buf_addr, block_sec, secs)
+                    if ret:
+                        return ret
+                    data = block_buf.read(size=secs * VHD_SECTOR_SIZE)
+                    self.cache.put(key, data)
+                secs = min(end_sec, block_sec + block_secs) - cur_sec
+                start = (cur_sec - block_sec) * VHD_SECTOR_SIZE
+                length = secs * VHD_SECTOR_SIZE
+                if start or length != len(data):
+                    data = data[start:start + length]
+                ctypes.memmove(addr, data, length)
+                addr += length
+                cur_sec += secs
+            return 0
+        return _read
+
+    def _invalidating_write_fn(self, write_fn):
+        """Wrap vhd_io_write to drop the cached blocks it overwrites."""
+        block_secs = self._block_secs()
+
+        def _write(ctx_p, addr, cur_sec, num_secs):
+            ret = write_fn(ctx_p, addr, cur_sec, num_secs)
+            uuid = _raw_field(self.vhd_context.footer, 'uuid')
+            first = cur_sec // block_secs
+            last = (cur_sec + num_secs - 1) // block_secs
+            for block in xrange(first, last + 1):
+                self.cache.invalidate((uuid, block))
+            return ret
+        return _write
+
+    def io_writev(self, requests):
+        """Write a batch of sector ranges into a VHD.  'requests' is a
+        list of (buf, cur_sec, num_secs[, offset]) tuples, taking the same
+        arguments as io_write().  All requests are issued; a list with the
+        libvhd return code of each is returned, 0 meaning success.
+        """
+        return self._io_vector('vhd_io_write', requests)
+
+    def io_readv(self, requests):
+        """Read a batch of sector ranges from a VHD.  'requests' is a
+        list of (buf, cur_sec, num_secs[, offset]) tuples, taking the same
+        arguments as io_read().  All requests are issued; a list with the
+        libvhd return code of each is returned, 0 meaning success.
+        """
+        return self._io_vector('vhd_io_read', requests)
+
+    def io_write(self, buf, cur_sec, num_secs, offset=0):
+        """Write sectors from an aligned buffer into a VHD.  'offset' is
+        the byte offset within the buffer to write from.
+        """
+        ret = self.io_writev([(buf, cur_sec, num_secs, offset)])[0]
         if not ret:
             return
-        errno = ctypes.get_errno()
-        raise exceptions.VHDWriteError("Error writing: %s" % errno)
-
-    def io_read(self, buf, cur_sec, num_secs):
-        """Read sectors from a VHD into an aligned buffer."""
-        if not isinstance(buf, utils.AlignedBuffer):
-            raise exceptions.VHDInvalidBuffer("buf argument should be a AlignedBuffer"
-                    " instance")
-        ret = _call('vhd_io_read',
-                ctypes.pointer(self.vhd_context),
-                buf.get_pointer(),
-                ctypes.c_ulonglong(cur_sec),
-                ctypes.c_uint(num_secs))
+        # libvhd returns -errno; errno itself isn't reliably set
+        raise exceptions.VHDWriteError("Error writing: %s" %
+                                       os.strerror(-ret))
+
+    def io_read(self, buf, cur_sec, num_secs, offset=0):
+        """Read sectors from a VHD into an aligned buffer.  'offset' is
+        the byte offset within the buffer to read into.
+        """
+        ret = self.io_readv([(buf, cur_sec, num_secs, offset)])[0]
         if not ret:
             return
-        errno = ctypes.get_errno()
-        raise exceptions.VHDReadError("Error reading: %s" % errno)
+        raise exceptions.VHDReadError("Error reading: %s" %
+                                      os.strerror(-ret))
 
     def __repr__(self):
         if self._closed:
             return "<%s: closed>" % self.filename
-        footer_values = self.get_footer()
         return "<%s: opened '%s', footer '%s'>" % (
-                self.filename, self.open_flags, footer_values)
+                self.filename, self.open_flags, self.get_footer())
+
+
+
+def _load_manifest_sidecar(filename, ident):
+    """Return a block manifest sidecar if it was written for the VHD
+    described by 'ident', else None.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    for name, value in ident.iteritems():
+        if data.get(name) != value:
+            return None
+    return data
+
+
+def _save_manifest_sidecar(filename, data):
+    """Write a sidecar atomically.  It is only a cache, so failing to
+    write it (on a read-only share, say) is not an error.
+    """
+    tmp = '%s.tmp.%d' % (filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            json.dump(data, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
 
 
+def _drop_manifest_sidecar(filename):
+    """Remove the block manifest sidecar of a VHD that had sectors
+    rewritten in place, which the sidecar can't detect.
+    """
+    try:
+        os.unlink(filename + VHD_MANIFEST_SUFFIX)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class VHDMetadata(object):
+    """The footer and header of a VHD, for listing images and walking
+    chains cheaply.
+
+    Unlike VHD, the file is not opened through libvhd: the footer and
+    header are read with two small reads and the file is closed again,
+    so the BAT is never loaded.  get_footer(), get_header() and the
+    other metadata methods behave as they do on a VHD.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with io.open(filename, 'rb', buffering=0) as f:
+            file_size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, file_size - VHD_SECTOR_SIZE))
+            data = f.read(VHD_SECTOR_SIZE)
+            if data[:8] != _FOOTER_COOKIE:
+                # As libvhd does, try the copy at the start
+                f.seek(0)
+                data = f.read(VHD_SECTOR_SIZE)
+            if len(data) < VHD_SECTOR_SIZE or data[:8] != _FOOTER_COOKIE:
+                raise exceptions.VHDOpenFailure("No VHD footer in %s" %
+                                                filename)
+            self.footer = _from_disk(VHDFooter, _BE_FOOTER, data)
+
+            if self.footer.type == VHD_DISK_TYPES['fixed']:
+                self.header = VHDHeader()
+            else:
+                f.seek(self.footer.data_offset)
+                data = f.read(ctypes.sizeof(VHDHeader))
+                if (len(data) < ctypes.sizeof(VHDHeader) or
+                        data[:8] != _HEADER_COOKIE):
+                    raise exceptions.VHDOpenFailure("No VHD header in %s" %
+                                                    filename)
+                self.header = _from_disk(VHDHeader, _BE_HEADER, data)
+        self._header_info = None
+        self._footer_info = None
+
+    def close(self):
+        """Nothing to release; kept so code can treat this like a VHD."""
 
-def vhd_create(filename, size, disk_type=None, create_flags=None):
-    """Create a new empty VHD file."""
+    def get_footer(self):
+        """Get the footer, as a VHDFooterInfo."""
+        if self._footer_info is None:
+            self._footer_info = VHDFooterInfo(self.footer)
+        return self._footer_info
+
+    def get_header(self):
+        """Get the header, as a VHDHeaderInfo."""
+        if self._header_info is None:
+            self._header_info = VHDHeaderInfo(self.header,
+                                              self._decode_parent_name())
+        return self._header_info
+
+    def _decode_parent_name(self):
+        if self.footer.type != VHD_DISK_TYPES['differencing']:
+            return None
+        name = _raw_field(self.header, 'prt_name').decode('utf-16-be')
+        return name.rstrip(u'\x00').encode('utf-8')
+
+    def get_parent_path(self):
+        """Return the path of a differencing disk's parent; see
+        VHD.get_parent_path().
+        """
+        return _find_parent_path(self.filename, self.footer, self.header,
+                                 self._decode_parent_name())
+
+    def get_max_virtual_size(self):
+        return self.header.max_bat_size << (VHD_BLOCK_SHIFT - 20)
+
+    def __repr__(self):
+        return "<%s: metadata, footer '%s'>" % (self.filename,
+                                                self.get_footer())
+
+
+def vhd_create(filename, size, disk_type=None, create_flags=None,
+        parent=None):
+    """Create a new empty VHD file.  Giving a 'parent' VHD creates a
+    differencing disk on top of it; 'size' may then be 0 to use the
+    parent's size.
+    """
 
     if disk_type is None:
-        disk_type = 'dynamic'
+        disk_type = 'differencing' if parent else 'dynamic'
+    if parent and disk_type != 'differencing':
+        raise exceptions.VHDInvalidDiskType("Only differencing disks "
+                "have a parent")
+    if disk_type == 'differencing' and not parent:
+        raise exceptions.VHDInvalidDiskType("Differencing disks need a "
+                "parent")
     if create_flags is None:
         create_flags = 0
 
@@ -341,101 +1258,674 @@ def vhd_create(filename, size, disk_type=None, create_flags=None):
     if size % VHD_SECTOR_SIZE:
         raise exceptions.VHDInvalidSize("size is not a multiple of %d" %
                 VHD_SECTOR_SIZE)
+    if parent:
+        return _call('vhd_snapshot', ctypes.c_char_p(filename),
+                ctypes.c_ulonglong(size),
+                ctypes.c_char_p(parent),
+                ctypes.c_ulonglong(0),
+                ctypes.c_uint(create_flags))
     return _call('vhd_create', ctypes.c_char_p(filename),
             ctypes.c_ulonglong(size),
             ctypes.c_int(disk_type),
             ctypes.c_uint(create_flags))
 
 
-def vhd_convert_from_raw(src_filename, dest_filename, disk_type=None,
-        sparse=False):
-    """Convert a RAW disk image to a VHD."""
-
+def _readinto_full(f, view):
+    """Fill a memoryview from a file-like object, stopping early only at
+    EOF.  Objects without readinto() are read with read() instead.
+    Returns the number of bytes read.
+    """
+    total = 0
+    size = len(view)
+    readinto = getattr(f, 'readinto', None)
+    while total < size:
+        if readinto is not None:
+            num = readinto(view[total:])
+        else:
+            data = f.read(size - total)
+            num = len(data)
+            view[total:total + num] = data
+        if not num:
+            break
+        total += num
+    return total
+
+
+def vhd_import_stream(src, dest_filename, size, disk_type=None,
+        sparse=True, chunk_secs=None, depth=None, observer=None):
+    """Write a RAW disk image read from the file-like object 'src' into
+    a new VHD.  'src' is only ever read forward, so pipes, sockets and
+    decompressors can be imported without a staging file.  It must hold
+    exactly 'size' bytes; a shorter or longer stream raises
+    VHDInvalidSize.  When 'sparse' is set, all-zero sectors are not
+    written.  Reads happen on a separate thread in chunks of
+    'chunk_secs' sectors, with up to 'depth' chunks in flight.
+    'observer' is an optional observer.Observer to report to.
+    """
+    _import_stream(src, dest_filename, size, disk_type, sparse,
+                   chunk_secs, depth, observer, 'import_stream')
+
+
+def _import_stream(src, dest_filename, size, disk_type, sparse, chunk_secs,
+        depth, observer, op):
     if disk_type is None:
         disk_type = 'dynamic'
+    if chunk_secs is None:
+        chunk_secs = VHD_CONVERT_CHUNK_SECS
+
+    vhd_size = size
+    if vhd_size % VHD_SECTOR_SIZE:
+        vhd_size += VHD_SECTOR_SIZE - (vhd_size % VHD_SECTOR_SIZE)
+    buf_size = VHD_SECTOR_SIZE * chunk_secs
+
+    def _read_chunk(buf, cur_sec):
+        offset = cur_sec * VHD_SECTOR_SIZE
+        want = min(buf_size, size - offset)
+        data_len = _readinto_full(src, buf.view(size=want))
+        if data_len < want:
+            raise exceptions.VHDInvalidSize("Stream ended after %d of %d "
+                    "bytes" % (offset + data_len, size))
+        if data_len % VHD_SECTOR_SIZE:
+            pad = VHD_SECTOR_SIZE - (data_len % VHD_SECTOR_SIZE)
+            buf.zero(offset=data_len, size=pad)
+            data_len += pad
+        if sparse:
+            return buf.nonzero_sector_runs(size=data_len,
+                    sector_size=VHD_SECTOR_SIZE)
+        return [(0, data_len / VHD_SECTOR_SIZE)]
+
+    def _write_chunk(buf, cur_sec, runs):
+        written = 0
+        for start, end in runs:
+            vhd.io_write(buf, cur_sec + start, end - start,
+                         offset=start * VHD_SECTOR_SIZE)
+            written += (end - start) * VHD_SECTOR_SIZE
+        if observer is not None:
+            offset = cur_sec * VHD_SECTOR_SIZE
+            chunk_len = min(buf_size, vhd_size - offset)
+            if written < chunk_len:
+                observer.skipped(op, chunk_len - written)
+            observer.progress(op, offset + chunk_len, vhd_size)
+
+    with vhd_observer.operation(observer, op, vhd_size):
+        ret = vhd_create(dest_filename, vhd_size, disk_type)
+        if ret:
+            raise exceptions.VHDCreateFailure("Error creating %s: %s" %
+                                              (dest_filename,
+                                               os.strerror(-ret)))
+        vhd = VHD(dest_filename, 'rdwr', observer=observer,
+                  observer_op=op)
+        try:
+            chunks = xrange(0, vhd_size / VHD_SECTOR_SIZE, chunk_secs)
+            pipeline.run(chunks, _read_chunk, _write_chunk, buf_size,
+                         depth=depth, alignment=VHD_SECTOR_SIZE)
+        finally:
+            vhd.close()
+        if src.read(1):
+            raise exceptions.VHDInvalidSize("Stream is longer than %d "
+                    "bytes" % size)
+
+
+def vhd_export_delta(src_filename, dest, depth=None, observer=None):
+    """Write the sectors a dynamic or differencing VHD holds itself, and
+    none that it inherits from its parents, to the file-like object
+    'dest' as a delta stream for vhd_apply_delta().  Only allocated
+    blocks are visited and only the sectors their bitmaps mark are
+    read, on a separate thread with up to 'depth' blocks in flight.
+    'dest' is only written forward.  'observer' is an optional
+    observer.Observer to report to.  Returns the number of bytes of
+    sector data written.
+    """
+    op = 'export_delta'
+    vhd = VHD(src_filename, observer=observer, observer_op=op)
+    try:
+        ctx = vhd.vhd_context
+        if ctx.footer.type == VHD_DISK_TYPES['fixed']:
+            raise exceptions.VHDInvalidDiskType("Fixed disks have no "
+                    "sector bitmaps to export a delta from")
+        size = ctx.footer.curr_size
+        spb = vhd._block_secs()
+        total_secs = size // VHD_SECTOR_SIZE
+        alloc_map = vhd.allocation_map()
+        blocks = [block for start, count in alloc_map.extents()
+                  for block in xrange(start, start + count)
+                  if block * spb < total_secs]
+        parent_uuid = '\x00' * 16
+        if ctx.footer.type == VHD_DISK_TYPES['differencing']:
+            parent_uuid = _raw_field(ctx.header, 'prt_uuid')
+
+        def _read_block(buf, block):
+            first_sec = block * spb
+            secs = min(spb, total_secs - first_sec)
+            bitmap = vhd.read_bitmap(block)
+            runs = [(start, end) for start, end, present in
+                    utils.bitmap_runs(bitmap, 0, secs) if present]
+            for start, end in runs:
+                vhd.io_read(buf, first_sec + start, end - start,
+                            offset=start * VHD_SECTOR_SIZE)
+            return runs
+
+        # Sectors written, and bytes of the disk the writer has got past
+        counts = [0, 0]
+
+        def _write_block(buf, block, runs):
+            first_sec = block * spb
+            written = 0
+            for start, end in runs:
+                dest.write(_DELTA_RECORD.pack(first_sec + start, end - start))
+                dest.write(buf.view(offset=start * VHD_SECTOR_SIZE,
+                                    size=(end - start) * VHD_SECTOR_SIZE))
+                written += end - start
+            counts[0] += written
+            if observer is not None:
+                end = min(first_sec + spb, total_secs) * VHD_SECTOR_SIZE
+                observer.skipped(op, end - counts[1] -
+                                 written * VHD_SECTOR_SIZE)
+                observer.progress(op, end, size)
+                counts[1] = end
+
+        with vhd_observer.operation(observer, op, size):
+            dest.write(_DELTA_HEADER.pack(_DELTA_MAGIC, _DELTA_VERSION, size,
+                                          _raw_field(ctx.footer, 'uuid'),
+                                          parent_uuid))
+            pipeline.run(blocks, _read_block, _write_block,
+                         spb * VHD_SECTOR_SIZE, depth=depth,
+                         alignment=VHD_SECTOR_SIZE)
+            dest.write(_DELTA_RECORD.pack(_DELTA_END, counts[0]))
+            if observer is not None and counts[1] < size:
+                observer.skipped(op, size - counts[1])
+                observer.progress(op, size, size)
+    finally:
+        vhd.close()
+    return counts[0] * VHD_SECTOR_SIZE
+
+
+def _read_exact(f, size):
+    data = bytearray(size)
+    if _readinto_full(f, memoryview(data)) < size:
+        raise exceptions.VHDInvalidDelta("Delta stream is truncated")
+    return str(data)
+
+
+def vhd_apply_delta(src, dest_filename, check_parent=True, chunk_secs=None,
+        observer=None):
+    """Write the sectors of a delta stream, read from the file-like
+    object 'src', into the existing VHD 'dest_filename', which must have
+    the same virtual size.  Sectors are written 'chunk_secs' at a time.
+
+    A delta taken from a differencing disk only makes sense on top of
+    that disk's parent, so with 'check_parent' set the destination must
+    be the parent itself or a child of it.  Raises VHDInvalidDelta if
+    it isn't, or if the stream is malformed or truncated.
+    """
+    op = 'apply_delta'
+    if chunk_secs is None:
+        chunk_secs = VHD_CONVERT_CHUNK_SECS
+    magic, version, size, _, parent_uuid = _DELTA_HEADER.unpack(
+            _read_exact(src, _DELTA_HEADER.size))
+    if magic != _DELTA_MAGIC:
+        raise exceptions.VHDInvalidDelta("Not a delta stream")
+    if version != _DELTA_VERSION:
+        raise exceptions.VHDInvalidDelta("Unsupported delta version %d" %
+                                         version)
+    total_secs = size // VHD_SECTOR_SIZE
+
+    vhd = VHD(dest_filename, 'rdwr', observer=observer, observer_op=op)
+    try:
+        ctx = vhd.vhd_context
+        if ctx.footer.curr_size != size:
+            raise exceptions.VHDInvalidSize("Delta is for a %d byte disk, "
+                    "%s is %d bytes" % (size, dest_filename,
+                                        ctx.footer.curr_size))
+        if check_parent and parent_uuid != '\x00' * 16:
+            bases = [_raw_field(ctx.footer, 'uuid')]
+            if ctx.footer.type == VHD_DISK_TYPES['differencing']:
+                bases.append(_raw_field(ctx.header, 'prt_uuid'))
+            if parent_uuid not in bases:
+                raise exceptions.VHDInvalidDelta("%s is not based on the "
+                        "delta's parent" % dest_filename)
+
+        buf = utils.AlignedBuffer(chunk_secs * VHD_SECTOR_SIZE,
+                                  alignment=VHD_SECTOR_SIZE)
+        written = 0
+        with vhd_observer.operation(observer, op, size):
+            while True:
+                cur_sec, num_secs = _DELTA_RECORD.unpack(
+                        _read_exact(src, _DELTA_RECORD.size))
+                if cur_sec == _DELTA_END:
+                    if num_secs != written:
+                        raise exceptions.VHDInvalidDelta("Delta stream "
+                                "ended after %d of %d sectors" %
+                                (written, num_secs))
+                    break
+                if cur_sec + num_secs > total_secs:
+                    raise exceptions.VHDInvalidDelta("Record for sectors "
+                            "%d-%d is past the end of the disk" %
+                            (cur_sec, cur_sec + num_secs - 1))
+                written += num_secs
+                while num_secs:
+                    count = min(num_secs, chunk_secs)
+                    view = buf.view(size=count * VHD_SECTOR_SIZE)
+                    if _readinto_full(src, view) < len(view):
+                        raise exceptions.VHDInvalidDelta("Delta stream is "
+                                "truncated")
+                    vhd.io_write(buf, cur_sec, count)
+                    cur_sec += count
+                    num_secs -= count
+                if observer is not None:
+                    observer.progress(op, cur_sec * VHD_SECTOR_SIZE, size)
+    finally:
+        vhd.close()
+        _drop_manifest_sidecar(dest_filename)
+
+
+def vhd_sync_export(src_filename, remote_manifest, dest, readers=None,
+        depth=None, sidecar=False, observer=None):
+    """Write a patch that brings a remote copy of a VHD up to date to
+    the file-like object 'dest', for vhd_sync_apply().
+
+    'remote_manifest' is a VHDBlockManifest of the remote copy, from
+    VHD.block_manifest() on the other side.  The local manifest is
+    taken with the same algorithm ('readers' and 'sidecar' are passed
+    on), hashing the whole disk unless 'sidecar' is True; only blocks
+    whose hashes differ go into the patch.  Blocks that
+    are now all zero, whether unallocated or not, are sent as a marker
+    rather than data.  Returns the number of bytes of block data
+    written.
+    """
+    op = 'sync_export'
+    vhd = VHD(src_filename, observer=observer, observer_op=op)
+    try:
+        manifest = vhd.block_manifest(algorithm=remote_manifest.algorithm,
+                                      readers=readers, sidecar=sidecar)
+        if manifest.size != remote_manifest.size:
+            raise exceptions.VHDInvalidSize("Local disk is %d bytes, "
+                    "remote is %d" % (manifest.size, remote_manifest.size))
+        spb = manifest.block_size // VHD_SECTOR_SIZE
+        total_secs = manifest.size // VHD_SECTOR_SIZE
+        zero_hashes = {}
+
+        def _is_zero(block, digest):
+            secs = min(spb, total_secs - block * spb)
+            if secs not in zero_hashes:
+                zero_hashes[secs] = hashlib.new(manifest.algorithm,
+                        utils._zeros(secs * VHD_SECTOR_SIZE)[
+                            :secs * VHD_SECTOR_SIZE]).hexdigest()
+            return digest == zero_hashes[secs]
+
+        jobs = [(block, _is_zero(block, manifest[block]))
+                for block in manifest.diff(remote_manifest)]
+
+        def _read_block(buf, job):
+            block, zero = job
+            if not zero:
+                vhd.io_read(buf, block * spb,
+                            min(spb, total_secs - block * spb))
+
+        # Records, bytes of data and bytes of changed blocks written
+        counts = [0, 0, 0]
+        changed_bytes = sum(min(spb, total_secs - block * spb)
+                            for block, _ in jobs) * VHD_SECTOR_SIZE
+
+        def _write_block(buf, job, _):
+            block, zero = job
+            digest = manifest[block].decode('hex')
+            block_len = min(spb, total_secs - block * spb) * VHD_SECTOR_SIZE
+            if zero:
+                dest.write(_SYNC_RECORD.pack(_SYNC_ZERO, block) + digest)
+                if observer is not None:
+                    observer.skipped(op, block_len)
+            else:
+                dest.write(_SYNC_RECORD.pack(_SYNC_DATA, block) + digest)
+                dest.write(buf.view(size=block_len))
+                counts[1] += block_len
+            counts[0] += 1
+            counts[2] += block_len
+            if observer is not None:
+                observer.progress(op, counts[2], changed_bytes)
+
+        with vhd_observer.operation(observer, op, changed_bytes):
+            dest.write(_SYNC_HEADER.pack(_SYNC_MAGIC, _SYNC_VERSION,
+                    manifest.size, manifest.block_size, manifest.algorithm,
+                    len(manifest[0].decode('hex')) if len(manifest) else 0))
+            pipeline.run(jobs, _read_block, _write_block,
+                         manifest.block_size, depth=depth,
+                         alignment=VHD_SECTOR_SIZE)
+            dest.write(_SYNC_RECORD.pack(_SYNC_END, counts[0]))
+    finally:
+        vhd.close()
+    return counts[1]
+
+
+def vhd_sync_apply(src, dest_filename, observer=None):
+    """Apply a patch from vhd_sync_export(), read from the file-like
+    object 'src', to the VHD 'dest_filename' it was made for.  Each
+    block's data is checked against the digest sent with it before it
+    is written.  Raises VHDInvalidDelta if the patch is malformed,
+    truncated or doesn't match the VHD.
+    """
+    op = 'sync_apply'
+    magic, version, size, block_size, algorithm, digest_size = \
+            _SYNC_HEADER.unpack(_read_exact(src, _SYNC_HEADER.size))
+    if magic != _SYNC_MAGIC:
+        raise exceptions.VHDInvalidDelta("Not a sync patch")
+    if version != _SYNC_VERSION:
+        raise exceptions.VHDInvalidDelta("Unsupported patch version %d" %
+                                         version)
+    algorithm = algorithm.rstrip('\x00')
+    total_secs = size // VHD_SECTOR_SIZE
+    spb = block_size // VHD_SECTOR_SIZE
+
+    vhd = VHD(dest_filename, 'rdwr', observer=observer, observer_op=op)
+    try:
+        ctx = vhd.vhd_context
+        if ctx.footer.curr_size != size:
+            raise exceptions.VHDInvalidSize("Patch is for a %d byte disk, "
+                    "%s is %d bytes" % (size, dest_filename,
+                                        ctx.footer.curr_size))
+        if vhd._block_secs() != spb:
+            raise exceptions.VHDInvalidDelta("Patch is for %d byte blocks" %
+                                             block_size)
+        dynamic = ctx.footer.type == VHD_DISK_TYPES['dynamic']
+        buf = utils.AlignedBuffer(block_size, alignment=VHD_SECTOR_SIZE)
+        records = 0
+        done = 0
+        with vhd_observer.operation(observer, op):
+            while True:
+                kind, block = _SYNC_RECORD.unpack(
+                        _read_exact(src, _SYNC_RECORD.size))
+                if kind == _SYNC_END:
+                    if block != records:
+                        raise exceptions.VHDInvalidDelta("Patch ended after "
+                                "%d of %d blocks" % (records, block))
+                    break
+                if kind not in (_SYNC_DATA, _SYNC_ZERO) or \
+                        block * spb >= total_secs:
+                    raise exceptions.VHDInvalidDelta("Bad patch record for "
+                            "block %d" % block)
+                digest = _read_exact(src, digest_size)
+                secs = min(spb, total_secs - block * spb)
+                view = buf.view(size=secs * VHD_SECTOR_SIZE)
+                if kind == _SYNC_DATA:
+                    if _readinto_full(src, view) < len(view):
+                        raise exceptions.VHDInvalidDelta("Patch is "
+                                "truncated")
+                else:
+                    buf.zero(size=len(view))
+                if hashlib.new(algorithm, view).digest() != digest:
+                    raise exceptions.VHDInvalidDelta("Block %d doesn't "
+                            "match its digest" % block)
+                # An unallocated block of a dynamic disk is already zero
+                if not (kind == _SYNC_ZERO and dynamic and
+                        vhd._bat_entry(block) == VHD_BAT_ENTRY_UNUSED):
+                    vhd.io_write(buf, block * spb, secs)
+                records += 1
+                done += len(view)
+                if observer is not None:
+                    observer.progress(op, done, None)
+    finally:
+        vhd.close()
+        _drop_manifest_sidecar(dest_filename)
 
-    size = os.stat(src_filename).st_size
-    if size % VHD_SECTOR_SIZE:
-        size += VHD_SECTOR_SIZE - (size % VHD_SECTOR_SIZE)
-
-    cur_sec = 0
-    num_secs_to_read = 4096
-    buf_size = VHD_SECTOR_SIZE * num_secs_to_read
-    buf = utils.AlignedBuffer(buf_size, alignment=VHD_SECTOR_SIZE)
-
-    all_zero_sector = '\x00' * VHD_SECTOR_SIZE
-
-    def _write_sectors(data, start, end, start_sec):
-        buf.write(data[start:end])
-        num_secs = (end - start) / VHD_SECTOR_SIZE
-        vhd.io_write(buf, start_sec, num_secs)
 
-    with open(src_filename, 'rb') as f:
-        fileno = f.fileno()
-        vhd_create(dest_filename, size, disk_type)
-        vhd = VHD(dest_filename, 'rdwr')
+def vhd_convert_from_raw(src_filename, dest_filename, disk_type=None,
+        sparse=False, chunk_secs=None, depth=None, observer=None):
+    """Convert a RAW disk image to a VHD.  The source is read in chunks
+    of 'chunk_secs' sectors on a separate thread, with up to 'depth'
+    chunks in flight, so that reading overlaps with writing the VHD.
+    'observer' is an optional observer.Observer to report to.
+    """
 
+    size = os.stat(src_filename).st_size
+    with io.open(src_filename, 'rb', buffering=0) as f:
+        _import_stream(f, dest_filename, size, disk_type, sparse,
+                       chunk_secs, depth, observer, 'convert_from_raw')
+
+
+def _open_chain(filename, ancestor=None):
+    """Open a VHD and its ancestors, read-only.  Returns a list of VHD
+    objects, the given VHD first.  The list runs to the base, or stops
+    short of 'ancestor' if one is given.
+    """
+    chain = [VHD(filename)]
+    stop = None
+    if ancestor is not None:
+        stop = os.path.realpath(ancestor)
+    try:
         while True:
-            data = os.read(fileno, buf_size)
-            if len(data) == 0:
+            if (chain[-1].vhd_context.footer.type !=
+                    VHD_DISK_TYPES['differencing']):
+                if stop is not None:
+                    raise exceptions.VHDException("%s is not an ancestor "
+                            "of %s" % (ancestor, filename))
                 break
-            data_len = len(data)
-            if (data_len < buf_size and
-                    data_len % VHD_SECTOR_SIZE):
-                pad = VHD_SECTOR_SIZE - (data_len % VHD_SECTOR_SIZE)
-                data += '\x00' * pad
-                data_len += pad
-
-            max_num = data_len / VHD_SECTOR_SIZE
-
-            if not sparse:
-                _write_sectors(data, 0, data_len)
-                cur_sec += max_num
-                continue
-
-            non_zero_start = None
-            for i in xrange(max_num):
-                beginning = i * VHD_SECTOR_SIZE
-                ending = beginning + VHD_SECTOR_SIZE
-                sector = data[beginning:ending]
-                if sector == all_zero_sector:
-                    if non_zero_start is not None:
-                        # We can write the previous sectors
-                        _write_sectors(data, non_zero_start, non_zero_end,
-                                start_sec)
-                        non_zero_start = None
-                else:
-                    if non_zero_start is None:
-                        # First non-zero sector
-                        non_zero_start = beginning
-                        start_sec = cur_sec
-                    non_zero_end = ending
-                cur_sec += 1
-            if non_zero_start is not None:
-                _write_sectors(data, non_zero_start, non_zero_end, start_sec)
-        vhd.close()
-
+            parent = chain[-1].get_parent_path()
+            if os.path.realpath(parent) == stop:
+                break
+            chain.append(VHD(parent))
+    except Exception:
+        for vhd in chain:
+            vhd.close()
+        raise
+    return chain
+
+
+def _or_bitmaps(bitmaps):
+    """Return the union of equally sized sector bitmaps."""
+    value = 0
+    for bitmap in bitmaps:
+        value |= int(binascii.hexlify(bitmap), 16)
+    return binascii.unhexlify('%0*x' % (2 * len(bitmaps[0]), value))
+
+
+def _copy_chain(src_filename, ancestor, dest_filename, sparse, readers,
+        depth, observer, op):
+    """Copy the data held by a VHD and its ancestors (up to, but not
+    including, 'ancestor') into the existing VHD 'dest_filename'.
+    """
+    if readers is None:
+        readers = VHD_FLATTEN_READERS
+
+    chain = _open_chain(src_filename, ancestor)
+    try:
+        paths = [vhd.filename for vhd in chain]
+        size = chain[0].vhd_context.footer.curr_size
+        spb = chain[0]._block_secs()
+        maps = [vhd.allocation_map() for vhd in chain]
+        fixed = [vhd.vhd_context.footer.type == VHD_DISK_TYPES['fixed']
+                 for vhd in chain]
+    finally:
+        for vhd in chain:
+            vhd.close()
+    total_secs = size // VHD_SECTOR_SIZE
+    num_blocks = -(-total_secs // spb)
+
+    def _blocks():
+        for block in xrange(num_blocks):
+            levels = [i for i, alloc_map in enumerate(maps)
+                      if block < len(alloc_map) and
+                      alloc_map.is_allocated(block)]
+            if levels:
+                yield block, levels
+
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def _reader_chain():
+        vhds = getattr(local, 'vhds', None)
+        if vhds is None:
+            vhds = local.vhds = [VHD(path, observer=observer,
+                                     observer_op=op) for path in paths]
+            with opened_lock:
+                opened.extend(vhds)
+        return vhds
+
+    def _read_block(buf, job):
+        block, levels = job
+        vhds = _reader_chain()
+        first_sec = block * spb
+        secs = min(spb, total_secs - first_sec)
+        from_fixed = any(fixed[i] for i in levels)
+        if from_fixed:
+            runs = [(0, secs)]
+        else:
+            bitmap = _or_bitmaps([vhds[i].read_bitmap(block)
+                                  for i in levels])
+            runs = [(start, end) for start, end, present in
+                    utils.bitmap_runs(bitmap, 0, secs) if present]
+        owner = vhds[levels[0]]
+        for start, end in runs:
+            owner.io_read(buf, first_sec + start, end - start,
+                          offset=start * VHD_SECTOR_SIZE)
+        if sparse or from_fixed:
+            runs = [(start + run_start, start + run_end)
+                    for start, end in runs
+                    for run_start, run_end in buf.nonzero_sector_runs(
+                            size=(end - start) * VHD_SECTOR_SIZE,
+                            sector_size=VHD_SECTOR_SIZE,
+                            offset=start * VHD_SECTOR_SIZE)]
+        return runs
+
+    # Bytes of the disk the writer has got past
+    done = [0]
+
+    def _write_block(buf, job, runs):
+        first_sec = job[0] * spb
+        written = 0
+        for start, end in runs:
+            dest.io_write(buf, first_sec + start, end - start,
+                          offset=start * VHD_SECTOR_SIZE)
+            written += (end - start) * VHD_SECTOR_SIZE
+        if observer is not None:
+            end = min(first_sec + spb, total_secs) * VHD_SECTOR_SIZE
+            observer.skipped(op, end - done[0] - written)
+            observer.progress(op, end, size)
+            done[0] = end
+
+    with vhd_observer.operation(observer, op, size):
+        dest = VHD(dest_filename, 'rdwr', observer=observer,
+                   observer_op=op)
+        try:
+            pipeline.run(_blocks(), _read_block, _write_block,
+                         spb * VHD_SECTOR_SIZE, depth=depth,
+                         alignment=VHD_SECTOR_SIZE, readers=readers)
+        finally:
+            dest.close()
+            for vhd in opened:
+                vhd.close()
+        if observer is not None and done[0] < size:
+            observer.skipped(op, size - done[0])
+            observer.progress(op, size, size)
+
+
+def vhd_flatten(src_filename, dest_filename, disk_type=None, sparse=False,
+        readers=None, depth=None, observer=None):
+    """Copy the disk that a VHD and its chain of parents present into a
+    new, standalone VHD.
+
+    Which blocks hold data is worked out from the BATs of the whole
+    chain first, so blocks no level has allocated are never touched.
+    For the others, the sector bitmaps of the levels allocating the
+    block are merged and only the sectors some level holds are copied,
+    reading from the level closest to 'src_filename' that allocates the
+    block.  Fixed disks have no bitmaps, so their blocks are scanned for
+    zeros instead.  With 'sparse', zero sectors are never written.
+
+    Blocks are read by 'readers' threads, each with its own handles on
+    the chain, and written in order by the calling thread.  'observer'
+    is an optional observer.Observer to report to; an exception raised
+    from its progress() stops the copy.
+    """
 
-def vhd_convert_to_raw(src_filename, dest_filename, sparse=False):
-    """Convert a VHD disk image to RAW."""
+    if disk_type is None:
+        disk_type = 'dynamic'
 
-    vhd = VHD(src_filename, 'rdonly')
+    vhd = VHD(src_filename)
+    size = vhd.vhd_context.footer.curr_size
+    vhd.close()
+    ret = vhd_create(dest_filename, size, disk_type)
+    if ret:
+        raise exceptions.VHDCreateFailure("Error creating %s: %s" %
+                                          (dest_filename, os.strerror(-ret)))
+    _copy_chain(src_filename, None, dest_filename, sparse, readers, depth,
+                observer, 'flatten')
+
+
+def vhd_coalesce(src_filename, ancestor_filename=None, readers=None,
+        depth=None, observer=None):
+    """Write the data that a differencing VHD and its ancestors above
+    'ancestor_filename' hold into that ancestor, which defaults to the
+    VHD's parent.  The copy works as in vhd_flatten(), except that it
+    stops at the ancestor; as with vhd-util, the VHDs above it are left
+    as they are.
+
+    The ancestor is written in place block by block, so a coalesce that
+    is stopped part way leaves it partly updated.  The VHDs above still
+    present the same disk until they are removed.
+    """
+    if ancestor_filename is None:
+        vhd = VHD(src_filename)
+        try:
+            ancestor_filename = vhd.get_parent_path()
+        finally:
+            vhd.close()
+    _copy_chain(src_filename, ancestor_filename, ancestor_filename, False,
+                readers, depth, observer, 'coalesce')
+
+
+def _sector_extents(vhd, total_sectors, sparse):
+    """Return (start_sector, num_sectors) tuples covering the parts of a
+    VHD that need to be read.  Unless 'sparse' is set, that's the whole
+    disk.  Otherwise the blocks that a dynamic disk has never allocated
+    are left out.  Unallocated blocks of a differencing disk may be
+    backed by its parent, so they are always read.
+    """
+    if (not sparse or
+            vhd.vhd_context.footer.type != VHD_DISK_TYPES['dynamic']):
+        return [(0, total_sectors)]
+
+    alloc_map = vhd.allocation_map()
+    spb = alloc_map.spb
+    extents = []
+    for block, num_blocks in alloc_map.extents():
+        start_sec = block * spb
+        if start_sec >= total_sectors:
+            break
+        num_secs = min(num_blocks * spb, total_sectors - start_sec)
+        extents.append((start_sec, num_secs))
+    return extents
+
+
+def vhd_convert_to_raw(src_filename, dest_filename, sparse=False,
+        chunk_secs=None, depth=None, observer=None):
+    """Convert a VHD disk image to RAW.  When 'sparse' is set, unallocated
+    blocks and all-zero sectors are not written, leaving holes in the
+    destination file.  The VHD is read with VHD.iter_extents(), which
+    overlaps reading with writing the raw file.  'observer' is an
+    optional observer.Observer to report to.
+    """
+
+    op = 'convert_to_raw'
+    vhd = VHD(src_filename, 'rdonly', observer=observer, observer_op=op)
     file_size = vhd.get_footer()['curr_size']
-    total_sectors = file_size / VHD_SECTOR_SIZE
-
-    with open(dest_filename, 'wb') as f:
-        fileno = f.fileno()
-        cur_sec = 0
-        num_secs_to_read = 4096
-        buf_size = VHD_SECTOR_SIZE * num_secs_to_read
-        buf = utils.AlignedBuffer(buf_size, alignment=VHD_SECTOR_SIZE)
-
-        while cur_sec < total_sectors:
-            if cur_sec + num_secs_to_read > total_sectors:
-                num_secs_to_read = total_sectors - cur_sec
-            vhd.io_read(buf, cur_sec, num_secs_to_read)
-            data = buf.read()
-            total_bytes = num_secs_to_read * VHD_SECTOR_SIZE
-            os.write(fileno, data)
-            cur_sec += num_secs_to_read
+
+    with vhd_observer.operation(observer, op, file_size):
+        with open(dest_filename, 'wb') as f:
+            fileno = f.fileno()
+            done = 0
+            for offset, data in vhd.iter_extents(sparse=sparse,
+                    chunk_secs=chunk_secs, depth=depth):
+                os.lseek(fileno, offset, os.SEEK_SET)
+                os.write(fileno, data)
+                if observer is not None:
+                    if offset > done:
+                        observer.skipped(op, offset - done)
+                    done = offset + len(data)
+                    observer.progress(op, done, file_size)
+            # Extends the file over any trailing hole
+            os.ftruncate(fileno, file_size)
+            if observer is not None and done < file_size:
+                observer.skipped(op, file_size - done)
+                observer.progress(op, file_size, file_size)
     vhd.close()
@@ -0,0 +1,202 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+Progress and performance reporting for long-running operations.
+
+The converters, vhd_flatten(), vhdutils.coalesce(), the delta functions
+vhd_export_delta() and vhd_apply_delta() and the sync functions
+vhd_sync_export() and vhd_sync_apply() take an optional 'observer'.
+Its begin() and end() bracket the operation, progress() and skipped()
+report how far the copy has got, and io() reports every
+io_read/io_write done on the VHDs involved with its latency.  Without
+an observer, none of this costs more than an 'is None' test per chunk.
+"""
+
+import contextlib
+import threading
+import time
+
+
+class Observer(object):
+    """Receives events from long-running operations.  Subclass it and
+    override the methods of interest; these do nothing.
+
+    'op' is the name of the operation: 'import_stream',
+    'convert_from_raw', 'convert_to_raw', 'flatten', 'coalesce',
+    'export_delta', 'apply_delta', 'sync_export' or 'sync_apply'.
+    Events may come from several threads at once.
+    """
+
+    def begin(self, op, total_bytes):
+        """An operation that will cover 'total_bytes' of virtual disk
+        has started; 'total_bytes' is None if that isn't known.
+        """
+
+    def progress(self, op, done_bytes, total_bytes):
+        """'done_bytes' of the disk have been dealt with so far.  An
+        exception raised here stops the operation, which re-raises it.
+        """
+
+    def skipped(self, op, num_bytes):
+        """'num_bytes' were not copied because they are zero or
+        unallocated.  Skipped bytes count towards progress too.
+        """
+
+    def io(self, op, kind, num_bytes, seconds):
+        """A VHD 'read' or 'write' of 'num_bytes' done for 'op' took
+        'seconds'.  'op' is None for a VHD opened outside an operation.
+        """
+
+    def end(self, op, error=None):
+        """An operation has finished, or failed with 'error'."""
+
+
+class ProgressCallback(Observer):
+    """Calls callback(op, done_bytes, total_bytes) on progress."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def progress(self, op, done_bytes, total_bytes):
+        self.callback(op, done_bytes, total_bytes)
+
+
+class LatencyHistogram(object):
+    """Latencies counted in power-of-two microsecond buckets: bucket n
+    holds latencies of at least 2**(n-1) and less than 2**n us.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """Upper bound, in seconds, of the bucket holding the given
+        percentile, or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return (1 << bucket) / 1e6
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.total / self.count,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max,
+                # Keyed by the bucket's exclusive upper bound
+                'buckets_us': dict((1 << b, n)
+                                   for b, n in self.buckets.iteritems())}
+
+
+def _histograms():
+    return {'read': LatencyHistogram(), 'write': LatencyHistogram()}
+
+
+class StatsObserver(Observer):
+    """Collects the duration, byte counts and throughput of each
+    operation, and read and write latency histograms of each, keyed by
+    operation and then by 'read' or 'write'.  A later run of an
+    operation replaces the figures of an earlier one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.latency = {}
+
+    def begin(self, op, total_bytes):
+        with self._lock:
+            self.operations[op] = {'total_bytes': total_bytes,
+                                   'done_bytes': 0,
+                                   'skipped_bytes': 0,
+                                   'started': time.time(),
+                                   'seconds': None,
+                                   'error': None}
+            self.latency[op] = _histograms()
+
+    def progress(self, op, done_bytes, total_bytes):
+        with self._lock:
+            self.operations[op]['done_bytes'] = done_bytes
+
+    def skipped(self, op, num_bytes):
+        with self._lock:
+            self.operations[op]['skipped_bytes'] += num_bytes
+
+    def io(self, op, kind, num_bytes, seconds):
+        with self._lock:
+            histograms = self.latency.get(op)
+            if histograms is None:
+                histograms = self.latency[op] = _histograms()
+            histograms[kind].record(seconds)
+
+    def end(self, op, error=None):
+        with self._lock:
+            stats = self.operations[op]
+            stats['seconds'] = time.time() - stats['started']
+            if error is not None:
+                stats['error'] = repr(error)
+
+    def summary(self):
+        """Return everything collected as a dict of plain values."""
+        with self._lock:
+            operations = {}
+            for op, stats in self.operations.iteritems():
+                stats = dict(stats)
+                seconds = stats['seconds']
+                if seconds:
+                    stats['bytes_per_sec'] = stats['done_bytes'] / seconds
+                operations[op] = stats
+            latency = {}
+            for op, histograms in self.latency.iteritems():
+                latency[op] = dict((kind, hist.summary()) for kind, hist
+                                   in histograms.iteritems())
+            return {'operations': operations, 'latency': latency}
+
+
+@contextlib.contextmanager
+def operation(observer, op, total_bytes=None):
+    """Bracket the body with observer.begin() and observer.end()."""
+    if observer is None:
+        yield
+        return
+    observer.begin(op, total_bytes)
+    try:
+        yield
+    except BaseException as e:
+        observer.end(op, error=e)
+        raise
+    observer.end(op)
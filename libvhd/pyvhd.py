@@ -0,0 +1,630 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+A pure-Python implementation of the parts of libvhd.so this package uses.
+
+PyLibVHD provides the libvhd entry points (vhd_open, vhd_io_read, ...)
+with the same arguments and return codes, and fills in the VHDContext
+the way libvhd does, so the VHD class and everything built on it work
+unchanged on hosts without blktap.  utils._get_libvhd_handle() falls
+back to it when libvhd.so isn't installed.
+
+Fixed, dynamic and differencing disks are supported.  The BAT lives in
+an array('I') that the context points at, and sector bitmaps are read
+on demand and kept per block.  New disks get the batmap libvhd expects
+after the BAT of anything tap 1.1 or later created; it is left empty,
+which only means no block is known to be full.  The vhd-util entry
+points (check, coalesce) raise VHDUtilNotSupported.
+"""
+
+import array
+import ctypes
+import errno
+import io
+import os
+import struct
+import threading
+import time
+import uuid
+
+from libvhd import (VHD_SECTOR_SIZE, VHD_BLOCK_SHIFT, VHD_BAT_ENTRY_UNUSED,
+                    VHD_DISK_TYPES, VHD_OPEN_FLAGS, VHD_PLATFORM_CODES)
+import utils.exceptions as exceptions
+import utils.utils as utils
+
+# 'conectix' footer, big-endian; see the VHD format specification
+_FOOTER_FMT = '>8sIIQI4sIIQQIII16sBB426s'
+# 'cxsparse' header, with the parent locators left as one blob
+_HEADER_FMT = '>8sQQIIII16sII512s192s256s'
+_LOCATOR_FMT = '>IIIIQ'
+# 'tdbatmap' header, in the sector after the BAT
+_BATMAP_HEADER_FMT = '>8sQIII'
+_NUM_LOCATORS = 8
+# Bytes of UTF-16 the header has for the parent's name
+_PRT_NAME_SIZE = 512
+
+_FOOTER_COOKIE = 'conectix'
+_HEADER_COOKIE = 'cxsparse'
+_FF_VERSION = 0x00010000
+_HDR_VERSION = 0x00010000
+_FEATURES_RESERVED = 0x00000002
+_CREATOR_APP = 'tap\x00'
+_CREATOR_VERSION = 0x00010003
+_DATA_OFFSET_NONE = 0xFFFFFFFFFFFFFFFF
+_BATMAP_COOKIE = 'tdbatmap'
+_BATMAP_VERSION = 0x00010002
+
+# VHD timestamps count seconds from 2000-01-01 00:00:00 UTC
+_VHD_EPOCH = 946684800
+
+_BLOCK_SIZE = 1 << VHD_BLOCK_SHIFT
+_MAX_CHS_SECTORS = 65535 * 16 * 255
+
+_FIXED = VHD_DISK_TYPES['fixed']
+_DYNAMIC = VHD_DISK_TYPES['dynamic']
+_DIFFERENCING = VHD_DISK_TYPES['differencing']
+
+
+def _vhd_time(secs=None):
+    if secs is None:
+        secs = time.time()
+    return max(0, int(secs) - _VHD_EPOCH) & 0xFFFFFFFF
+
+
+def _checksum(data, offset):
+    """One's complement of the byte sum of a footer or header, skipping
+    the 4-byte checksum field at 'offset'.
+    """
+    total = sum(bytearray(data[:offset])) + sum(bytearray(data[offset + 4:]))
+    return ~total & 0xFFFFFFFF
+
+
+def _geometry(size):
+    """CHS geometry for a disk of 'size' bytes, as packed in the footer."""
+    total = min(size // VHD_SECTOR_SIZE, _MAX_CHS_SECTORS)
+    if total >= 65535 * 16 * 63:
+        spt, heads = 255, 16
+        cth = total // spt
+    else:
+        spt = 17
+        cth = total // spt
+        heads = max((cth + 1023) // 1024, 4)
+        if cth >= heads * 1024 or heads > 16:
+            spt, heads = 31, 16
+            cth = total // spt
+        if cth >= heads * 1024:
+            spt, heads = 63, 16
+            cth = total // spt
+    return ((cth // heads) << 16) | (heads << 8) | spt
+
+
+def _set_raw(struct_obj, name, data):
+    """Copy raw bytes into a char array field; assigning the attribute
+    would stop at the first NUL.
+    """
+    field = getattr(type(struct_obj), name)
+    data = data[:field.size]
+    ctypes.memmove(ctypes.addressof(struct_obj) + field.offset, data,
+                   len(data))
+
+
+def _address(arg):
+    if isinstance(arg, (int, long)):
+        return arg
+    if isinstance(arg, ctypes.c_void_p):
+        return arg.value
+    return ctypes.addressof(arg.contents)
+
+
+def _value(arg):
+    return getattr(arg, 'value', arg)
+
+
+def _memory(addr, size):
+    """A writable memoryview of 'size' bytes at 'addr'."""
+    return memoryview((ctypes.c_char * size).from_address(addr))
+
+
+def _pack_footer(size, disk_type, disk_uuid, timestamp=None):
+    if disk_type == _FIXED:
+        data_offset = _DATA_OFFSET_NONE
+    else:
+        data_offset = VHD_SECTOR_SIZE
+    fields = [_FOOTER_COOKIE, _FEATURES_RESERVED, _FF_VERSION, data_offset,
+              _vhd_time(timestamp), _CREATOR_APP, _CREATOR_VERSION, 0,
+              size, size, _geometry(size), disk_type, 0, disk_uuid, 0, 0,
+              '']
+    raw = struct.pack(_FOOTER_FMT, *fields)
+    fields[12] = _checksum(raw, 64)
+    return struct.pack(_FOOTER_FMT, *fields)
+
+
+def _pack_header(table_offset, max_bat_size, prt_uuid='', prt_ts=0,
+                 prt_name='', locators=()):
+    locs = ''.join(struct.pack(_LOCATOR_FMT, *loc) for loc in locators)
+    fields = [_HEADER_COOKIE, _DATA_OFFSET_NONE, table_offset, _HDR_VERSION,
+              max_bat_size, _BLOCK_SIZE, 0, prt_uuid, prt_ts, 0,
+              prt_name.encode('utf-16-be'), locs, '']
+    raw = struct.pack(_HEADER_FMT, *fields)
+    fields[6] = _checksum(raw, 36)
+    return struct.pack(_HEADER_FMT, *fields)
+
+
+def _pack_batmap_header(batmap_offset, batmap):
+    checksum = ~sum(bytearray(batmap)) & 0xFFFFFFFF
+    return struct.pack(_BATMAP_HEADER_FMT, _BATMAP_COOKIE, batmap_offset,
+                       len(batmap) // VHD_SECTOR_SIZE, _BATMAP_VERSION,
+                       checksum).ljust(VHD_SECTOR_SIZE, '\x00')
+
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def create(filename, size, disk_type, parent=None):
+    """Write a new, empty VHD.  A differencing disk records 'parent' by
+    uuid, by file name, as vhd_snapshot does, and with a MACX (file URL)
+    locator relative to the new file.
+    """
+    prt_name = u''
+    if parent is not None:
+        prt_name = os.path.basename(parent).decode('utf-8')
+        if len(prt_name.encode('utf-16-be')) > _PRT_NAME_SIZE:
+            raise IOError(errno.ENAMETOOLONG, "Parent name doesn't fit "
+                          "in the header", parent)
+    disk_uuid = uuid.uuid4().bytes
+    footer = _pack_footer(size, disk_type, disk_uuid)
+    with io.open(filename, 'wb') as f:
+        if disk_type == _FIXED:
+            f.truncate(size)
+            f.seek(size)
+            f.write(footer)
+            return
+
+        max_bat_size = -(-size // _BLOCK_SIZE)
+        table_offset = 3 * VHD_SECTOR_SIZE
+        bat_bytes = _round_up(max_bat_size * 4, VHD_SECTOR_SIZE)
+        batmap_header_offset = table_offset + bat_bytes
+        batmap = '\x00' * _round_up(-(-max_bat_size // 8), VHD_SECTOR_SIZE)
+        end = batmap_header_offset + VHD_SECTOR_SIZE + len(batmap)
+        prt_uuid = ''
+        prt_ts = 0
+        locators = []
+        locator_data = ''
+        if parent is not None:
+            parent_image = _Image(parent, False)
+            try:
+                prt_uuid = parent_image.uuid
+            finally:
+                parent_image.close()
+            prt_ts = _vhd_time(os.stat(parent).st_mtime)
+            rel = os.path.relpath(os.path.abspath(parent),
+                                  os.path.dirname(os.path.abspath(filename)))
+            url = 'file://./' + rel.replace(os.sep, '/')
+            space = _round_up(len(url), VHD_SECTOR_SIZE)
+            locators.append((VHD_PLATFORM_CODES['PLAT_CODE_MACX'], space,
+                             len(url), 0, end))
+            locator_data = url.ljust(space, '\x00')
+            end += space
+
+        header = _pack_header(table_offset, max_bat_size, prt_uuid, prt_ts,
+                              prt_name, locators)
+        f.write(footer)
+        f.write(header)
+        f.write('\xff' * (max_bat_size * 4))
+        f.seek(batmap_header_offset)
+        f.write(_pack_batmap_header(batmap_header_offset + VHD_SECTOR_SIZE,
+                                    batmap))
+        f.write(batmap)
+        f.seek(end - len(locator_data))
+        f.write(locator_data)
+        f.seek(end)
+        f.write(footer)
+
+
+class _Image(object):
+    """An open VHD file and the metadata needed to do I/O on it."""
+
+    def __init__(self, filename, writable):
+        self.filename = filename
+        self.writable = writable
+        self.lock = threading.RLock()
+        self.parent = None
+        self.bitmaps = {}
+        self.f = io.open(filename, 'r+b' if writable else 'rb', buffering=0)
+        try:
+            self._load()
+        except Exception:
+            self.f.close()
+            raise
+
+    def _load(self):
+        file_size = os.fstat(self.f.fileno()).st_size
+        if file_size < VHD_SECTOR_SIZE:
+            raise IOError(errno.EINVAL, "Too small for a VHD", self.filename)
+        self.footer_offset = file_size - VHD_SECTOR_SIZE
+        self.footer_raw = self.pread(self.footer_offset, VHD_SECTOR_SIZE)
+        footer = struct.unpack(_FOOTER_FMT, self.footer_raw)
+        if footer[0] != _FOOTER_COOKIE:
+            # libvhd falls back to the copy at the start of dynamic disks
+            self.footer_raw = self.pread(0, VHD_SECTOR_SIZE)
+            footer = struct.unpack(_FOOTER_FMT, self.footer_raw)
+            if footer[0] != _FOOTER_COOKIE:
+                raise IOError(errno.EINVAL, "No VHD footer", self.filename)
+        self.footer = footer
+        self.disk_type = footer[11]
+        self.size = footer[9]
+        self.uuid = footer[13]
+        self.total_secs = self.size // VHD_SECTOR_SIZE
+
+        self.header_raw = None
+        self.header = None
+        self.bat = array.array('I')
+        self.spb = 0
+        self.bm_secs = 0
+        if self.disk_type == _FIXED:
+            return
+        if self.disk_type not in (_DYNAMIC, _DIFFERENCING):
+            raise IOError(errno.EINVAL, "Unknown disk type %d" %
+                          self.disk_type, self.filename)
+        self.header_raw = self.pread(footer[3], 2 * VHD_SECTOR_SIZE)
+        self.header = struct.unpack(_HEADER_FMT, self.header_raw)
+        if self.header[0] != _HEADER_COOKIE:
+            raise IOError(errno.EINVAL, "No VHD header", self.filename)
+        self.spb = self.header[5] // VHD_SECTOR_SIZE
+        self.bm_secs = -(-self.spb // (8 * VHD_SECTOR_SIZE))
+        self.table_offset = self.header[2]
+        self.bat.fromstring(self.pread(self.table_offset,
+                                       self.header[4] * self.bat.itemsize))
+        self.bat.byteswap()
+
+    def close(self):
+        if self.parent is not None:
+            self.parent.close()
+            self.parent = None
+        self.f.close()
+
+    def pread(self, offset, size):
+        """Return 'size' bytes from 'offset', zero-filled past EOF."""
+        buf = bytearray(size)
+        self.preadinto(memoryview(buf), offset)
+        return str(buf)
+
+    def preadinto(self, view, offset):
+        # os.pread would save the lock, but Python 2 doesn't have it
+        with self.lock:
+            self.f.seek(offset)
+            total = 0
+            size = len(view)
+            while total < size:
+                num = self.f.readinto(view[total:])
+                if not num:
+                    view[total:] = utils._zeros(size - total)[:size - total]
+                    break
+                total += num
+
+    def pwrite(self, data, offset):
+        with self.lock:
+            self.f.seek(offset)
+            self.f.write(data)
+
+    def locators(self):
+        locs = self.header[11]
+        size = struct.calcsize(_LOCATOR_FMT)
+        return [struct.unpack(_LOCATOR_FMT, locs[i * size:(i + 1) * size])
+                for i in xrange(_NUM_LOCATORS)]
+
+    def parent_name(self):
+        return self.header[10].decode('utf-16-be').rstrip(u'\x00')
+
+    def parent_path(self):
+        """Find the parent from its MACX locator, else from its name,
+        relative to this file's directory.
+        """
+        base = os.path.dirname(os.path.abspath(self.filename))
+        candidates = []
+        for code, space, length, _, offset in self.locators():
+            if code == VHD_PLATFORM_CODES['PLAT_CODE_MACX'] and length:
+                url = self.pread(offset, length).rstrip('\x00')
+                if url.startswith('file://'):
+                    url = url[len('file://'):]
+                candidates.append(url)
+        candidates.append(self.parent_name().encode('utf-8'))
+        for path in candidates:
+            path = os.path.join(base, path)
+            if os.path.exists(path):
+                return os.path.normpath(path)
+        raise IOError(errno.ENOENT, "Parent not found", self.filename)
+
+    def get_parent(self):
+        with self.lock:
+            if self.parent is None:
+                parent = _Image(self.parent_path(), False)
+                if parent.uuid != self.header[7]:
+                    parent.close()
+                    raise IOError(errno.EINVAL, "Parent uuid mismatch",
+                                  self.filename)
+                self.parent = parent
+            return self.parent
+
+    def chain_depth(self):
+        depth = 1
+        image = self
+        while image.disk_type == _DIFFERENCING:
+            image = image.get_parent()
+            depth += 1
+        return depth
+
+    def bitmap(self, block):
+        """The sector bitmap of an allocated block, as a str."""
+        bitmap = self.bitmaps.get(block)
+        if bitmap is None:
+            bitmap = self.pread(self.bat[block] * VHD_SECTOR_SIZE,
+                                self.bm_secs * VHD_SECTOR_SIZE)
+            self.bitmaps[block] = bitmap
+        return bitmap
+
+    def read(self, sec, num_secs, view):
+        if self.disk_type == _FIXED:
+            self.preadinto(view, sec * VHD_SECTOR_SIZE)
+            return
+        spb = self.spb
+        pos = 0
+        while num_secs:
+            block, block_sec = divmod(sec, spb)
+            count = min(num_secs, spb - block_sec)
+            part = view[pos:pos + count * VHD_SECTOR_SIZE]
+            entry = self.bat[block]
+            if entry == VHD_BAT_ENTRY_UNUSED:
+                self._read_absent(sec, count, part)
+            else:
+                data_sec = entry + self.bm_secs
+                runs = utils.bitmap_runs(self.bitmap(block), block_sec,
+                                         block_sec + count)
+                for start, end, present in runs:
+                    sub = part[(start - block_sec) * VHD_SECTOR_SIZE:
+                               (end - block_sec) * VHD_SECTOR_SIZE]
+                    if present:
+                        self.preadinto(sub,
+                                (data_sec + start) * VHD_SECTOR_SIZE)
+                    else:
+                        self._read_absent(block * spb + start, end - start,
+                                          sub)
+            sec += count
+            num_secs -= count
+            pos += count * VHD_SECTOR_SIZE
+
+    def _read_absent(self, sec, num_secs, view):
+        """Fill in sectors this file doesn't hold."""
+        if self.disk_type == _DIFFERENCING:
+            self.get_parent().read(sec, num_secs, view)
+        else:
+            size = len(view)
+            view[:] = utils._zeros(size)[:size]
+
+    def write(self, sec, num_secs, view):
+        if self.disk_type == _FIXED:
+            self.pwrite(view, sec * VHD_SECTOR_SIZE)
+            return
+        spb = self.spb
+        pos = 0
+        while num_secs:
+            block, block_sec = divmod(sec, spb)
+            count = min(num_secs, spb - block_sec)
+            with self.lock:
+                entry = self.bat[block]
+                if entry == VHD_BAT_ENTRY_UNUSED:
+                    entry = self._allocate_block(block)
+                self.pwrite(view[pos:pos + count * VHD_SECTOR_SIZE],
+                            (entry + self.bm_secs + block_sec) *
+                            VHD_SECTOR_SIZE)
+                bitmap = self.bitmap(block)
+                new_bitmap = utils.bitmap_set(bitmap, block_sec,
+                                              block_sec + count)
+                if new_bitmap != bitmap:
+                    self.pwrite(new_bitmap, entry * VHD_SECTOR_SIZE)
+                    self.bitmaps[block] = new_bitmap
+            sec += count
+            num_secs -= count
+            pos += count * VHD_SECTOR_SIZE
+
+    def _allocate_block(self, block):
+        """Put a new block where the footer is and move the footer past
+        it.  The data area is left as a hole; the bitmap says no sector
+        has been written.
+        """
+        entry = _round_up(self.footer_offset, VHD_SECTOR_SIZE) // \
+                VHD_SECTOR_SIZE
+        bitmap = '\x00' * (self.bm_secs * VHD_SECTOR_SIZE)
+        self.footer_offset = (entry + self.bm_secs + self.spb) * \
+                VHD_SECTOR_SIZE
+        self.pwrite(bitmap, entry * VHD_SECTOR_SIZE)
+        self.pwrite(self.footer_raw, self.footer_offset)
+        self.bat[block] = entry
+        self.bitmaps[block] = bitmap
+        self.pwrite(struct.pack('>I', entry),
+                    self.table_offset + block * self.bat.itemsize)
+        return entry
+
+
+def _not_supported(fn_name):
+    """An entry point vhd-util provides and this module doesn't."""
+    def _unsupported(self, *args):
+        raise exceptions.VHDUtilNotSupported("%s is not supported without "
+                                             "libvhd.so" % fn_name)
+    _unsupported.__name__ = fn_name
+    return _unsupported
+
+
+class PyLibVHD(object):
+    """Drop-in for the libvhd.so handle.  Each entry point takes the
+    same arguments as its C counterpart and returns 0 or a negative
+    errno.
+    """
+
+    def __init__(self):
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def _image(self, ctx_p):
+        return self._images[_address(ctx_p)]
+
+    def vhd_create(self, name, size, disk_type, flags):
+        try:
+            create(_value(name), _value(size), _value(disk_type))
+        except (IOError, OSError) as e:
+            return -e.errno
+        return 0
+
+    def vhd_snapshot(self, name, size, parent, mbytes, flags):
+        parent = _value(parent)
+        try:
+            if not _value(size):
+                image = _Image(parent, False)
+                size = image.size
+                image.close()
+            create(_value(name), _value(size), _DIFFERENCING, parent=parent)
+        except (IOError, OSError) as e:
+            return -e.errno
+        return 0
+
+    def vhd_open(self, ctx_p, name, flags):
+        name = _value(name)
+        flags = _value(flags)
+        writable = bool(flags & VHD_OPEN_FLAGS['rdwr'])
+        try:
+            image = _Image(name, writable)
+        except (IOError, OSError) as e:
+            return -(e.errno or errno.EINVAL)
+
+        ctx = ctx_p.contents
+        ctypes.memmove(ctypes.addressof(ctx.footer), image.footer_raw,
+                       VHD_SECTOR_SIZE)
+        footer = ctx.footer
+        (_, footer.features, footer.ff_version, footer.data_offset,
+         footer.timestamp, _, footer.crtr_ver, footer.crtr_os,
+         footer.orig_size, footer.curr_size, footer.geometry, footer.type,
+         footer.checksum, _, _, _, _) = image.footer
+        if image.header is not None:
+            header = ctx.header
+            ctypes.memmove(ctypes.addressof(header), image.header_raw,
+                           ctypes.sizeof(header))
+            (_, header.data_offset, header.table_offset, header.hdr_ver,
+             header.max_bat_size, header.block_size, header.checksum, _,
+             header.prt_ts, header.res1, _, _, _) = image.header
+            for i, loc in enumerate(image.locators()):
+                (header.loc[i].code, header.loc[i].data_space,
+                 header.loc[i].data_len, header.loc[i].res,
+                 header.loc[i].data_offset) = loc
+        ctx.fd = image.f.fileno()
+        ctx.file = name
+        ctx.oflags = flags
+        ctx.spb = image.spb
+        ctx.bm_secs = image.bm_secs
+        ctx.bat.spb = image.spb
+        ctx.bat.entries = len(image.bat)
+        if len(image.bat):
+            ctx.bat.bat = image.bat.buffer_info()[0]
+        with self._lock:
+            self._images[ctypes.addressof(ctx)] = image
+        return 0
+
+    def vhd_close(self, ctx_p):
+        with self._lock:
+            image = self._images.pop(_address(ctx_p), None)
+        if image is not None:
+            image.close()
+
+    def vhd_get_bat(self, ctx_p):
+        # Read at open time
+        return 0
+
+    def vhd_chain_depth(self, ctx_p, depth_p):
+        try:
+            depth = self._image(ctx_p).chain_depth()
+        except (IOError, OSError) as e:
+            return -e.errno
+        ctypes.cast(depth_p, ctypes.POINTER(ctypes.c_int))[0] = depth
+        return 0
+
+    def vhd_header_decode_parent(self, ctx_p, header_p, buf_pp):
+        image = self._image(ctx_p)
+        if image.disk_type != _DIFFERENCING:
+            return -errno.EINVAL
+        name = image.parent_name().encode('utf-8')
+        # Kept alive by the image, like libvhd's malloc'ed copy
+        image.parent_name_buf = ctypes.create_string_buffer(name, 512)
+        ctypes.cast(buf_pp, ctypes.POINTER(ctypes.c_void_p))[0] = \
+                ctypes.addressof(image.parent_name_buf)
+        return 0
+
+    def vhd_read_bitmap(self, ctx_p, block, buf_pp):
+        image = self._image(ctx_p)
+        block = _value(block)
+        if (image.disk_type == _FIXED or block >= len(image.bat) or
+                image.bat[block] == VHD_BAT_ENTRY_UNUSED):
+            return -errno.EINVAL
+        with image.lock:
+            bitmap = image.bitmap(block)
+        # The caller releases it with free()
+        addr = utils._malloc(len(bitmap))
+        if not addr:
+            return -errno.ENOMEM
+        ctypes.memmove(addr, bitmap, len(bitmap))
+        ctypes.cast(buf_pp, ctypes.POINTER(ctypes.c_void_p))[0] = addr
+        return 0
+
+    def _check_io(self, image, sec, num_secs):
+        if sec + num_secs > image.total_secs:
+            return -errno.EINVAL
+        return 0
+
+    def vhd_io_read(self, ctx_p, buf, sec, num_secs):
+        image = self._image(ctx_p)
+        sec = _value(sec)
+        num_secs = _value(num_secs)
+        ret = self._check_io(image, sec, num_secs)
+        if ret:
+            return ret
+        try:
+            image.read(sec, num_secs,
+                       _memory(_address(buf), num_secs * VHD_SECTOR_SIZE))
+        except (IOError, OSError) as e:
+            return -e.errno
+        return 0
+
+    def vhd_io_write(self, ctx_p, buf, sec, num_secs):
+        image = self._image(ctx_p)
+        if not image.writable:
+            return -errno.EPERM
+        sec = _value(sec)
+        num_secs = _value(num_secs)
+        ret = self._check_io(image, sec, num_secs)
+        if ret:
+            return ret
+        try:
+            image.write(sec, num_secs,
+                        _memory(_address(buf), num_secs * VHD_SECTOR_SIZE))
+        except (IOError, OSError) as e:
+            return -e.errno
+        return 0
+
+    vhd_util_check_vhd = _not_supported('vhd_util_check_vhd')
+    vhd_util_check_parents = _not_supported('vhd_util_check_parents')
+    vhd_util_coalesce_out = _not_supported('vhd_util_coalesce_out')
+    vhd_util_coalesce_ancestor = _not_supported('vhd_util_coalesce_ancestor')
+    vhd_util_coalesce_parent = _not_supported('vhd_util_coalesce_parent')
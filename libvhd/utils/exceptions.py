@@ -110,6 +110,12 @@ class VHDReadError(VHDException):
         super(VHDReadError, self).__init__(message)
 
 
+class VHDCreateFailure(VHDException):
+
+    def __init__(self, message=None):
+        super(VHDCreateFailure, self).__init__(message)
+
+
 class VHDOpenFailure(VHDException):
 
     def __init__(self, message=None):
@@ -122,6 +128,12 @@ class VHDInvalidBuffer(VHDException):
         super(VHDInvalidBuffer, self).__init__(message)
 
 
+class VHDInvalidDelta(VHDException):
+
+    def __init__(self, message=None):
+        super(VHDInvalidDelta, self).__init__(message)
+
+
 #
 # Exceptions for VHD utility operations
 #
@@ -158,6 +170,40 @@ class VHDUtilCoalesceError(VHDUtilException):
         super(VHDUtilCoalesceError, self).__init__(message)
 
 
+class VHDUtilCoalesceCancelled(VHDUtilException):
+
+    def __init__(self, message=None):
+        super(VHDUtilCoalesceCancelled, self).__init__(message)
+
+
+class VHDUtilCoalesceTimeout(VHDUtilCoalesceCancelled):
+
+    def __init__(self, message=None):
+        super(VHDUtilCoalesceTimeout, self).__init__(message)
+
+
+class VHDUtilNotSupported(VHDUtilException):
+
+    def __init__(self, message=None):
+        super(VHDUtilNotSupported, self).__init__(message)
+
+
+class VHDUtilCheckError(VHDUtilException):
+
+    def __init__(self, errcode=0, message=None):
+        if (errcode >= 0) and (errcode < len(ERRNO)):
+            self.err_msg = ERRNO[errcode]
+        else:
+            self.err_msg = ERRNO[0]
+        self.errcode = errcode
+
+        if message is None:
+            message = "Error: %s(%d) - %s" % \
+                      (self.err_msg.mnemonic, self.err_msg.code,
+                       self.err_msg.description)
+        super(VHDUtilCheckError, self).__init__(message)
+
+
 #
 # Exceptions for AlignedBuffer operations
 #
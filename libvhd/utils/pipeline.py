@@ -0,0 +1,165 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+"""
+Overlap the read and write sides of a copy using reader threads.
+
+ctypes drops the GIL around libvhd calls and os.read/os.write drop it
+around the system calls, so a reader thread filling one buffer while the
+caller drains another keeps both devices busy.
+"""
+
+import itertools
+import Queue
+import sys
+import threading
+
+from libvhd.utils.utils import AlignedBuffer
+
+DEFAULT_DEPTH = 2
+
+
+class BufferPool(object):
+    """A fixed set of AlignedBuffers that can be borrowed and returned.
+    get() blocks while every buffer is in use.
+    """
+
+    def __init__(self, count, size, alignment=None):
+        self._free = Queue.Queue()
+        for _ in xrange(count):
+            self._free.put(AlignedBuffer(size, alignment=alignment))
+
+    def get(self, timeout=None):
+        return self._free.get(timeout=timeout)
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+_DONE = object()
+
+
+def run(jobs, read_fn, write_fn, buf_size, depth=None, alignment=None,
+        readers=1):
+    """Copy data through a pool of 'depth' aligned buffers of 'buf_size'
+    bytes.
+
+    A reader thread takes each job from the 'jobs' iterable, borrows a
+    buffer and calls read_fn(buf, job).  The calling thread then calls
+    write_fn(buf, job, result) with whatever read_fn returned, in job
+    order, and gives the buffer back to the pool.  An exception from
+    either side stops the pipeline and is re-raised in the caller.
+
+    With more than one reader, jobs are read concurrently and still
+    written in order; read_fn must then be safe to call from several
+    threads at once.
+    """
+    items = iterate(jobs, read_fn, buf_size, depth=depth,
+                    alignment=alignment, readers=readers)
+    try:
+        for buf, job, result in items:
+            write_fn(buf, job, result)
+    finally:
+        items.close()
+
+
+def iterate(jobs, read_fn, buf_size, depth=None, alignment=None,
+        readers=1):
+    """Generator form of run(): yields (buf, job, result) tuples in job
+    order instead of calling a write function.  The buffer goes back to
+    the pool when the next tuple is requested, so the caller must be
+    done with it by then.  Closing the generator early stops the
+    readers.
+    """
+    if readers < 1:
+        raise ValueError("readers must be >= 1")
+    if depth is None:
+        depth = max(DEFAULT_DEPTH, 2 * readers)
+    if depth < 1:
+        raise ValueError("depth must be >= 1")
+    return _iterate(jobs, read_fn, buf_size, depth, alignment, readers)
+
+
+def _iterate(jobs, read_fn, buf_size, depth, alignment, readers):
+    pool = BufferPool(depth, buf_size, alignment=alignment)
+    # The pool bounds how far the readers can get ahead
+    filled = Queue.Queue()
+    stop = threading.Event()
+    jobs = iter(jobs)
+    jobs_lock = threading.Lock()
+    counter = itertools.count()
+
+    def _reader():
+        try:
+            while True:
+                buf = pool.get()
+                if stop.is_set():
+                    return
+                # Jobs are handed out in the order buffers are, so the
+                # oldest job never waits for a buffer held by a newer one
+                with jobs_lock:
+                    try:
+                        job = next(jobs)
+                    except StopIteration:
+                        pool.put(buf)
+                        break
+                    seq = next(counter)
+                filled.put((seq, buf, job, read_fn(buf, job)))
+                if stop.is_set():
+                    return
+            filled.put((None, None, _DONE, None))
+        except Exception:
+            filled.put((None, None, _DONE, sys.exc_info()))
+
+    threads = []
+    for i in xrange(readers):
+        thread = threading.Thread(target=_reader,
+                                  name='libvhd-reader-%d' % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    finished = False
+    try:
+        # Results can arrive out of order; hold them until their turn
+        pending = {}
+        next_seq = 0
+        running = readers
+        while running:
+            seq, buf, job, result = filled.get()
+            if job is _DONE:
+                if result is not None:
+                    raise result[0], result[1], result[2]
+                running -= 1
+                continue
+            pending[seq] = (buf, job, result)
+            while next_seq in pending:
+                buf, job, result = pending.pop(next_seq)
+                next_seq += 1
+                yield buf, job, result
+                pool.put(buf)
+        finished = True
+    finally:
+        if not finished:
+            stop.set()
+            # Wake any reader waiting on the pool; it sees 'stop' before
+            # touching what it gets back.
+            for thread in threads:
+                while thread.is_alive():
+                    pool.put(None)
+                    thread.join(0.1)
+    for thread in threads:
+        thread.join()
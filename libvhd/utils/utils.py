@@ -16,18 +16,87 @@
 #    permissions and limitations under the License.
 
 import ctypes
+import ctypes.util
+import errno
+import logging
 from libvhd.utils import exceptions
+import os
+import re
 import uuid
 
+LOG = logging.getLogger(__name__)
+
+_LIBVHD_NAME = "libvhd.so"
 _libvhd_handle = None
+_libc_handle = None
+
+_zero_bytes = ''
+
+# Signatures of the libvhd entry points we use, as (restype, argtypes).
+# Structures are passed by pointer, so they are declared as c_void_p;
+# that also accepts the pointer() and byref() of any structure.
+_c_int = ctypes.c_int
+_c_uint = ctypes.c_uint
+_c_ulonglong = ctypes.c_ulonglong
+_c_void_p = ctypes.c_void_p
+_c_char_p = ctypes.c_char_p
+_PROTOTYPES = {
+    'vhd_open': (_c_int, [_c_void_p, _c_char_p, _c_int]),
+    'vhd_close': (None, [_c_void_p]),
+    'vhd_create': (_c_int, [_c_char_p, _c_ulonglong, _c_int, _c_uint]),
+    'vhd_snapshot': (_c_int, [_c_char_p, _c_ulonglong, _c_char_p,
+                              _c_ulonglong, _c_uint]),
+    'vhd_header_decode_parent': (_c_int, [_c_void_p, _c_void_p, _c_void_p]),
+    'vhd_chain_depth': (_c_int, [_c_void_p, _c_void_p]),
+    'vhd_get_bat': (_c_int, [_c_void_p]),
+    'vhd_read_bitmap': (_c_int, [_c_void_p, _c_uint, _c_void_p]),
+    'vhd_io_read': (_c_int, [_c_void_p, _c_void_p, _c_ulonglong, _c_uint]),
+    'vhd_io_write': (_c_int, [_c_void_p, _c_void_p, _c_ulonglong, _c_uint]),
+    'vhd_util_coalesce_out': (_c_int, [_c_char_p, _c_char_p, _c_int,
+                                       _c_int]),
+    'vhd_util_coalesce_ancestor': (_c_int, [_c_char_p, _c_char_p, _c_int,
+                                            _c_int]),
+    'vhd_util_coalesce_parent': (_c_int, [_c_char_p, _c_int, _c_int,
+                                          _c_char_p]),
+    'vhd_util_check_vhd': (_c_int, [_c_void_p, _c_char_p]),
+    'vhd_util_check_parents': (_c_int, [_c_void_p, _c_char_p]),
+}
+
+# Bound functions, valid for the handle they were resolved from
+_functions = {}
+_functions_handle = None
+
+def _libvhd_missing(e):
+    """Whether CDLL failed because libvhd.so isn't installed, rather than
+    because it, or a library it needs, is broken.
+    """
+    message = str(e)
+    return (message.startswith(_LIBVHD_NAME + ':') and
+            os.strerror(errno.ENOENT) in message)
 
 def _get_libvhd_handle():
     global _libvhd_handle
     if _libvhd_handle is None:
-        _libvhd_handle = ctypes.cdll.LoadLibrary("libvhd.so")
+        try:
+            _libvhd_handle = ctypes.CDLL(_LIBVHD_NAME, use_errno=True)
+        except OSError as e:
+            if not _libvhd_missing(e):
+                raise
+            # No blktap on this host
+            LOG.warning("%s not found, using the pure-Python backend",
+                        _LIBVHD_NAME)
+            from libvhd import pyvhd
+            _libvhd_handle = pyvhd.PyLibVHD()
     return _libvhd_handle
 
 
+def _get_libc_handle():
+    global _libc_handle
+    if _libc_handle is None:
+        _libc_handle = ctypes.CDLL(ctypes.util.find_library("c"))
+    return _libc_handle
+
+
 class AlignedBuffer(object):
     def __init__(self, size, alignment=None):
         if alignment is None:
@@ -42,18 +111,19 @@ class AlignedBuffer(object):
         self.size = size
         buf_size = self._alignment + self.size - 1
 
-        self.buf = ctypes.create_string_buffer(buf_size)
+        # The bytearray owns the memory; the ctypes array gives libvhd a
+        # pointer to it and the memoryview gives Python copy-free access.
+        self._data = bytearray(buf_size)
+        self.buf = (ctypes.c_char * buf_size).from_buffer(self._data)
         self.buf_addr = ctypes.addressof(self.buf)
         if self.buf_addr % self._alignment:
             self.buf_addr += self._alignment - (self.buf_addr % self._alignment)
+        self._start = self.buf_addr - ctypes.addressof(self.buf)
+        self._view = memoryview(self._data)[self._start:
+                                            self._start + self.size]
 
-    def get_pointer(self, offset=0, size=None):
-        """Return a pointer into the aligned buffer at an offset, where
-        the offset defaults to 0.  An optional size can be specified to
-        ensure that the resulting pointer is at least size bytes from the
-        end of the buffer.
-        """
-
+    def _check_range(self, offset, size):
+        """Validate an offset and optional size, returning the size."""
         if offset < 0:
             raise exceptions.BufferInvalidOffset("Offset must be >= 0")
         diff = self.size - offset
@@ -66,34 +136,196 @@ class AlignedBuffer(object):
             raise exceptions.BufferInvalidSize("Size must be >= 0")
         elif size > diff:
             raise exceptions.BufferInvalidSize("Size too large for given offset")
+        return size
 
+    def get_pointer(self, offset=0, size=None):
+        """Return a pointer into the aligned buffer at an offset, where
+        the offset defaults to 0.  An optional size can be specified to
+        ensure that the resulting pointer is at least size bytes from the
+        end of the buffer.
+        """
+        size = self._check_range(offset, size)
         t = ctypes.c_char * size
         return ctypes.pointer(t.from_address(self.buf_addr + offset))
 
+    def view(self, offset=0, size=None):
+        """Return a writable memoryview of the aligned buffer at an offset,
+        where the offset defaults to 0.  Size defaults to the rest of the
+        buffer.  The view shares memory with the buffer, so it can be
+        handed to readinto() or os.write() without copying.
+        """
+        size = self._check_range(offset, size)
+        return self._view[offset:offset + size]
+
     def write(self, data, offset=0):
         """Write data into the aligned buffer at a specific offset,
         where the offset defaults to 0.
         """
-        p = self.get_pointer(offset=offset)
-        p.contents.raw = data
+        self.view(offset=offset, size=len(data))[:] = data
 
     def read(self, offset=0, size=None):
         """Return data from the buffer at a specific offset.  An optional
         size can be specified to limit the data returned.  Size will
         default to the rest of the buffer.
         """
-        p = self.get_pointer(offset=offset, size=size)
-        return p.contents.raw
+        size = self._check_range(offset, size)
+        return buffer(self._data, self._start + offset, size)[:]
 
+    def zero(self, offset=0, size=None):
+        """Zero the buffer from an offset, by default all of it."""
+        size = self._check_range(offset, size)
+        self._view[offset:offset + size] = memoryview(_zeros(size))[:size]
+
+    def nonzero_sector_runs(self, size=None, sector_size=512, offset=0):
+        """Return the non-zero sector runs of the 'size' bytes of the
+        buffer from 'offset', numbering sectors from there.  See
+        nonzero_sector_runs().
+        """
+        size = self._check_range(offset, size)
+        return nonzero_sector_runs(self._data, sector_size,
+                                   start=self._start + offset, size=size)
+
+
+def _get_function(fn_name):
+    """Return a libvhd function with its prototype declared.  Functions
+    are resolved once and cached; hot loops should hold on to the result
+    instead of going through _call().
+    """
+    global _functions_handle
+    libvhd_handle = _get_libvhd_handle()
+    if libvhd_handle is not _functions_handle:
+        _functions.clear()
+        _functions_handle = libvhd_handle
+    try:
+        return _functions[fn_name]
+    except KeyError:
+        pass
+    fn = getattr(libvhd_handle, fn_name)
+    prototype = _PROTOTYPES.get(fn_name)
+    if prototype is not None:
+        try:
+            fn.restype, fn.argtypes = prototype
+        except AttributeError:
+            # A library implemented in Python takes arguments as given
+            pass
+    _functions[fn_name] = fn
+    return fn
 
 def _call(fn_name, *args):
     """Call a function in libvhd.so"""
-    libvhd_handle =_get_libvhd_handle()
-    fn = getattr(libvhd_handle, fn_name)
-    return fn(*args)
+    ret = _get_function(fn_name)(*args)
+    # Results come back as Python values, even from callables that don't
+    # apply a restype.
+    if isinstance(ret, ctypes._SimpleCData):
+        ret = ret.value
+    return ret
+
+def _free(ptr):
+    """Release memory that libvhd allocated on our behalf."""
+    _get_libc_handle().free(ptr)
+
+def _malloc(size):
+    """Allocate memory that _free() can release; returns the address."""
+    malloc = _get_libc_handle().malloc
+    malloc.restype = ctypes.c_void_p
+    malloc.argtypes = [ctypes.c_size_t]
+    return malloc(size)
+
+def bitmap_test(bitmap, bit):
+    """Return True if 'bit' is set in a VHD sector bitmap.  VHD bitmaps
+    are big-endian: bit 0 is the most significant bit of the first byte.
+    """
+    return bool(ord(bitmap[bit >> 3]) & (0x80 >> (bit & 7)))
+
+_bitmap_run_re = re.compile('\xff+|\x00+|[\x01-\xfe]')
+
+def bitmap_runs(bitmap, start, end):
+    """Return a list of (first, last, is_set) tuples splitting bits
+    [start, end) of a VHD sector bitmap into runs of equal bits, where
+    'last' is exclusive.  Whole bytes of set or clear bits are taken in
+    one step.
+    """
+    runs = []
+    for m in _bitmap_run_re.finditer(bitmap, start >> 3, (end + 7) >> 3):
+        lo = max(m.start() << 3, start)
+        hi = min(m.end() << 3, end)
+        byte = ord(bitmap[m.start()])
+        if byte in (0, 0xff):
+            bits = [(lo, hi, byte == 0xff)]
+        else:
+            bits = [(bit, bit + 1, bool(byte & (0x80 >> (bit & 7))))
+                    for bit in xrange(lo, hi)]
+        for first, last, is_set in bits:
+            if runs and runs[-1][2] == is_set:
+                runs[-1] = (runs[-1][0], last, is_set)
+            else:
+                runs.append((first, last, is_set))
+    return runs
+
+def bitmap_set(bitmap, start, end):
+    """Return a copy of a VHD sector bitmap with bits [start, end) set."""
+    data = bytearray(bitmap)
+    first = -(-start // 8)
+    last = end // 8
+    if first < last:
+        data[first:last] = '\xff' * (last - first)
+        partial = range(start, first * 8) + range(last * 8, end)
+    else:
+        partial = xrange(start, end)
+    for bit in partial:
+        data[bit >> 3] |= 0x80 >> (bit & 7)
+    return str(data)
+
+def _zeros(size):
+    """Return a shared all-zero string of at least 'size' bytes."""
+    global _zero_bytes
+    if len(_zero_bytes) < size:
+        _zero_bytes = '\x00' * size
+    return _zero_bytes
+
+def nonzero_sector_runs(data, sector_size=512, start=0, size=None):
+    """Return a list of (start, end) sector ranges of 'data' that contain
+    any non-zero bytes, where 'end' is exclusive.  'data' may be a str or
+    a bytearray.  Only the 'size' bytes from byte offset 'start' are
+    examined and sectors are numbered from there; 'size' defaults to the
+    rest of 'data' and must be a multiple of sector_size.
+
+    Ranges are classified in bulk: memcmp against zeroes finds all-zero
+    ranges, and a range without a single sector-sized zero window can't
+    contain a zero sector.  Mixed ranges are split in half, so the work
+    grows with the number of zero/non-zero boundaries, not the number of
+    sectors.
+    """
+    if size is None:
+        size = len(data) - start
+    num_sectors = size // sector_size
+    zeros = _zeros(size)
+    zero_sector = buffer(zeros, 0, sector_size)
+    runs = []
+    pending = [(0, num_sectors)]
+    while pending:
+        lo, hi = pending.pop()
+        if lo == hi:
+            continue
+        offset = start + lo * sector_size
+        length = (hi - lo) * sector_size
+        if buffer(data, offset, length) == buffer(zeros, 0, length):
+            continue
+        if hi - lo == 1 or data.find(zero_sector, offset,
+                                     offset + length) == -1:
+            if runs and runs[-1][1] == lo:
+                runs[-1] = (runs[-1][0], hi)
+            else:
+                runs.append((lo, hi))
+            continue
+        mid = (lo + hi) // 2
+        # Upper half first so that runs come off the stack in order
+        pending.append((mid, hi))
+        pending.append((lo, mid))
+    return runs
 
 def uuid_unparse(uuid_t):
     """Convert raw bytes from uuid_t to a formatted string.
     uuid_t must be an array of 16 c_char"""
-    data = [str.format("%x" % ord(c)) for c in uuid_t]
+    data = [str.format("%02x" % ord(c)) for c in uuid_t]
     return uuid.UUID("".join(data))
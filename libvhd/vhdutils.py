@@ -16,10 +16,21 @@
 #    implied. See the License for the specific language governing
 #    permissions and limitations under the License.
 
+import array
 import ctypes
+import io
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
 import utils.exceptions as exceptions
+import utils.utils as utils
 from utils.utils import _call
 from libvhd import ListHead
+import libvhd
+import observer as vhd_observer
 
 
 class VHDUtilCheckOptions(ctypes.Structure):
@@ -49,10 +60,7 @@ class VHDUtilCheckCtx(ctypes.Structure):
         ('primary_footer_missing', ctypes.c_int)]
 
 
-def coalesce(name, output=None, ancestor=None, step_parent=None, sparse=False):
-    """Coalesce the VHD given by 'name'.
-    Exactly one of 'output', 'ancestor', or 'step_parent' is required.
-    """
+def _check_coalesce_args(name, output, ancestor, step_parent):
     if name is None:
         raise exceptions.VHDUtilMissingArgument("'name' must be specified")
 
@@ -68,34 +76,264 @@ def coalesce(name, output=None, ancestor=None, step_parent=None, sparse=False):
         raise exceptions.VHDUtilMutuallyExclusiveArguments(
             "Exactly one of 'output', 'ancestor', or 'step_parent' is required.")
 
+
+def coalesce(name, output=None, ancestor=None, step_parent=None, sparse=False,
+             observer=None):
+    """Coalesce the VHD given by 'name'.
+    Exactly one of 'output', 'ancestor', or 'step_parent' is required.
+    libvhd gives no progress, so an 'observer' only sees begin() and
+    end().
+    """
+    _check_coalesce_args(name, output, ancestor, step_parent)
+
     sparse_i = 0
     if sparse:
         sparse_i = 1
 
-    ret = None
-    if output:
-        ret = _call('vhd_util_coalesce_out',
-                    ctypes.c_char_p(name), ctypes.c_char_p(output),
-                    ctypes.c_int(sparse_i), ctypes.c_int(0))
-    elif ancestor:
-        ret = _call('vhd_util_coalesce_ancestor',
-                    ctypes.c_char_p(name), ctypes.c_char_p(ancestor),
-                    ctypes.c_int(sparse_i), ctypes.c_int(0))
-    elif step_parent:
-        ret = _call('vhd_util_coalesce_parent',
-                    ctypes.c_char_p(name), ctypes.c_int(sparse_i),
-                    ctypes.c_int(0), ctypes.c_char_p(step_parent))
+    with vhd_observer.operation(observer, 'coalesce'):
+        ret = None
+        if output:
+            ret = _call('vhd_util_coalesce_out',
+                        ctypes.c_char_p(name), ctypes.c_char_p(output),
+                        ctypes.c_int(sparse_i), ctypes.c_int(0))
+        elif ancestor:
+            ret = _call('vhd_util_coalesce_ancestor',
+                        ctypes.c_char_p(name), ctypes.c_char_p(ancestor),
+                        ctypes.c_int(sparse_i), ctypes.c_int(0))
+        elif step_parent:
+            ret = _call('vhd_util_coalesce_parent',
+                        ctypes.c_char_p(name), ctypes.c_int(sparse_i),
+                        ctypes.c_int(0), ctypes.c_char_p(step_parent))
+
+        if ret != 0:
+            raise exceptions.VHDUtilCoalesceError(errcode=abs(ret))
+
+class _CoalesceJobObserver(vhd_observer.Observer):
+    """Tracks a job's progress, passes events on to the caller's
+    observer, and stops the copy when the job is cancelled or out of
+    time.
+    """
+
+    def __init__(self, job, observer):
+        self.job = job
+        self.observer = observer
+
+    def begin(self, op, total_bytes):
+        self.job.total_bytes = total_bytes
+        if self.observer is not None:
+            self.observer.begin(op, total_bytes)
+
+    def progress(self, op, done_bytes, total_bytes):
+        self.job.done_bytes = done_bytes
+        if self.observer is not None:
+            self.observer.progress(op, done_bytes, total_bytes)
+        self.job._check_stop()
+
+    def skipped(self, op, num_bytes):
+        if self.observer is not None:
+            self.observer.skipped(op, num_bytes)
+
+    def io(self, op, kind, num_bytes, seconds):
+        if self.observer is not None:
+            self.observer.io(op, kind, num_bytes, seconds)
+
+    def end(self, op, error=None):
+        if self.observer is not None:
+            self.observer.end(op, error=error)
+
+
+def _coalesce_in_child(conn, name, step_parent, sparse):
+    try:
+        coalesce(name, step_parent=step_parent, sparse=sparse)
+    except exceptions.BaseException as e:
+        conn.send(str(e))
+    else:
+        conn.send(None)
+
+
+class VHDUtilCoalesceJob(object):
+    """A coalesce running in the background; see start_coalesce()."""
+
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    TIMED_OUT = 'timed out'
+
+    # How often a coalesce in a child process is checked on
+    poll_interval = 0.1
+
+    def __init__(self, name, output=None, ancestor=None, step_parent=None,
+                 sparse=False, timeout=None, observer=None, readers=None):
+        _check_coalesce_args(name, output, ancestor, step_parent)
+        self.name = name
+        self.output = output
+        self.ancestor = ancestor
+        self.step_parent = step_parent
+        self.sparse = sparse
+        self.readers = readers
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        self.done_bytes = 0
+        self.total_bytes = None
+        self.error = None
+        self._observer = _CoalesceJobObserver(self, observer)
+        self._state = self.RUNNING
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='libvhd-coalesce')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_stop(self):
+        if self._cancel.is_set():
+            raise exceptions.VHDUtilCoalesceCancelled("Coalesce of %s "
+                    "cancelled" % self.name)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise exceptions.VHDUtilCoalesceTimeout("Coalesce of %s ran "
+                    "out of time" % self.name)
+
+    def _run(self):
+        try:
+            self._check_stop()
+            if self.output:
+                libvhd.vhd_flatten(self.name, self.output,
+                                   sparse=self.sparse, readers=self.readers,
+                                   observer=self._observer)
+            elif self.ancestor:
+                libvhd.vhd_coalesce(self.name, self.ancestor,
+                                    readers=self.readers,
+                                    observer=self._observer)
+            else:
+                self._run_in_child()
+            self._state = self.DONE
+        except exceptions.VHDUtilCoalesceTimeout as e:
+            self.error = e
+            self._state = self.TIMED_OUT
+        except exceptions.VHDUtilCoalesceCancelled as e:
+            self.error = e
+            self._state = self.CANCELLED
+        except Exception as e:
+            self.error = e
+            self._state = self.FAILED
+        finally:
+            self._done.set()
+
+    def _run_in_child(self):
+        """Re-parenting has no Python implementation, so vhd-util's
+        coalesce runs in a child process.  It can't stop cooperatively;
+        cancelling or running out of time kills the child.
+        """
+        parent_conn, child_conn = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=_coalesce_in_child,
+                args=(child_conn, self.name, self.step_parent, self.sparse))
+        proc.daemon = True
+        with vhd_observer.operation(self._observer, 'coalesce'):
+            proc.start()
+            try:
+                while proc.is_alive():
+                    proc.join(self.poll_interval)
+                    if proc.is_alive():
+                        self._check_stop()
+            finally:
+                if proc.is_alive():
+                    proc.terminate()
+                    proc.join()
+            if not parent_conn.poll():
+                raise exceptions.VHDUtilCoalesceError(message="Coalesce "
+                        "process exited with %s" % proc.exitcode)
+            message = parent_conn.recv()
+            if message is not None:
+                raise exceptions.VHDUtilCoalesceError(message=message)
+
+    def status(self):
+        """Return one of RUNNING, DONE, FAILED, CANCELLED or TIMED_OUT."""
+        return self._state
+
+    def done(self):
+        return self._done.is_set()
+
+    def progress(self):
+        """Return (done_bytes, total_bytes); total_bytes is None until
+        known, and for coalesces run by vhd-util.
+        """
+        return self.done_bytes, self.total_bytes
+
+    def cancel(self):
+        """Ask the coalesce to stop.  It does so between blocks; use
+        wait() to find out when it has.
+        """
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        """Wait for the coalesce to finish; returns whether it has."""
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the coalesce and raise its error if it didn't
+        succeed.
+        """
+        if not self.wait(timeout):
+            raise exceptions.VHDUtilException("Coalesce of %s is still "
+                    "running" % self.name)
+        if self.error is not None:
+            raise self.error
+
+
+def start_coalesce(name, output=None, ancestor=None, step_parent=None,
+                   sparse=False, timeout=None, observer=None, readers=None):
+    """Start a coalesce on a background thread and return a
+    VHDUtilCoalesceJob for it.  The arguments are those of coalesce().
+
+    Coalescing to 'output' or into an 'ancestor' is done by the chunked
+    copy in libvhd.vhd_flatten() and libvhd.vhd_coalesce(), which can
+    report progress, be cancelled with the job's cancel() and stop
+    itself after 'timeout' seconds.  Coalescing onto a 'step_parent'
+    runs vhd-util in a child process, which is killed instead.
+    """
+    return VHDUtilCoalesceJob(name, output=output, ancestor=ancestor,
+                              step_parent=step_parent, sparse=sparse,
+                              timeout=timeout, observer=observer,
+                              readers=readers)
 
-    if ret != 0:
-        raise exceptions.VHDUtilCoalesceError(errcode=ret.value)
 
 def _set_bool_opt(obj, attr, bool_val):
     val = 1 if bool_val else 0
     setattr(obj, attr, ctypes.c_char(chr(val)))
 
+def _read_stats(vhd_check_ctx):
+    """Return the entries libvhd added to the stats list as dicts, freeing
+    them as we go.
+    """
+    head_addr = ctypes.addressof(vhd_check_ctx.stats)
+    next_offset = VHDUtilCheckStats.next.offset
+    stats = []
+    node = vhd_check_ctx.stats.next
+    while node and ctypes.addressof(node.contents) != head_addr:
+        entry_addr = ctypes.addressof(node.contents) - next_offset
+        entry = VHDUtilCheckStats.from_address(entry_addr)
+        stats.append({'name': entry.name,
+                      'secs_total': entry.secs_total,
+                      'secs_allocated': entry.secs_allocated,
+                      'secs_written': entry.secs_written})
+        node = entry.next.next
+        for field in ('name', 'bitmap'):
+            ptr = ctypes.c_void_p.from_address(
+                    entry_addr + getattr(VHDUtilCheckStats, field).offset)
+            if ptr.value:
+                utils._free(ptr)
+        utils._free(ctypes.c_void_p(entry_addr))
+    return stats
+
 def check(name, ignore_missing_primary_footers=False, ignore_parent_uuids=False,
           ignore_timestamps=False, skip_bat_overlap_check=False,
-          check_parents=False, check_bitmaps=False):
+          check_parents=False, check_bitmaps=False, stats=False):
+    """Check the VHD given by 'name', raising VHDUtilCheckError if it is
+    invalid.  With 'stats', a list of dicts with the 'name', 'secs_total',
+    'secs_allocated' and 'secs_written' that libvhd collected is returned.
+    """
 
     if name is None:
         raise exceptions.VHDUtilMissingArgument("'name' must be specified")
@@ -105,21 +343,26 @@ def check(name, ignore_missing_primary_footers=False, ignore_parent_uuids=False,
             "Cannot specify 'check_bitmaps' as True when "
             "'no_bat_overlap_check' is also True")
 
+    if skip_bat_overlap_check and stats:
+        raise exceptions.VHDUtilMutuallyExclusiveArguments(
+            "Cannot specify 'stats' as True when "
+            "'no_bat_overlap_check' is also True")
+
     o = VHDUtilCheckOptions()
     _set_bool_opt(o, 'ignore_footer', ignore_missing_primary_footers)
     _set_bool_opt(o, 'ignore_parent_uuid', ignore_parent_uuids)
     _set_bool_opt(o, 'ignore_timestamps', ignore_timestamps)
     _set_bool_opt(o, 'check_data', check_bitmaps)
     _set_bool_opt(o, 'no_check_bat', skip_bat_overlap_check)
-    _set_bool_opt(o, 'collect_stats', False)
-
-    list_head = ListHead()
-    setattr(list_head, 'next', ctypes.pointer(list_head))
-    setattr(list_head, 'prev', ctypes.pointer(list_head))
+    _set_bool_opt(o, 'collect_stats', stats)
 
     vhd_check_ctx = VHDUtilCheckCtx()
     setattr(vhd_check_ctx, 'opts', o)
-    setattr(vhd_check_ctx, 'stats', list_head)
+    # An empty list points at itself, so this must be the head inside
+    # the context rather than a copy of one.
+    list_head = vhd_check_ctx.stats
+    setattr(list_head, 'next', ctypes.pointer(list_head))
+    setattr(list_head, 'prev', ctypes.pointer(list_head))
 
     ret = _call('vhd_util_check_vhd',
                 ctypes.pointer(vhd_check_ctx),
@@ -131,5 +374,377 @@ def check(name, ignore_missing_primary_footers=False, ignore_parent_uuids=False,
                         ctypes.pointer(vhd_check_ctx),
                         ctypes.c_char_p(name))
 
+    collected = _read_stats(vhd_check_ctx)
+
     if ret != 0:
-        raise exceptions.VHDUtilCheckError(errcode=ret.value)
+        raise exceptions.VHDUtilCheckError(errcode=abs(ret))
+
+    if stats:
+        return collected
+
+
+class VHDUtilCheckResult(object):
+    """Outcome of checking one VHD with check_many()."""
+
+    def __init__(self, name, ok, errcode=0, message=None, stats=None):
+        self.name = name
+        self.ok = ok
+        self.errcode = errcode
+        self.message = message
+        self.stats = stats or []
+
+    def __repr__(self):
+        if self.ok:
+            return "<VHDUtilCheckResult %s: ok>" % self.name
+        return "<VHDUtilCheckResult %s: failed (%s) %s>" % (
+                self.name, self.errcode, self.message)
+
+
+def _check_one(args):
+    name, kwargs = args
+    try:
+        collected = check(name, **kwargs)
+    except exceptions.VHDUtilCheckError as e:
+        return VHDUtilCheckResult(name, False, errcode=e.errcode,
+                                  message=str(e))
+    except exceptions.VHDUtilNotSupported:
+        # Not something wrong with this VHD
+        raise
+    except Exception as e:
+        return VHDUtilCheckResult(name, False, errcode=None,
+                                  message="%s: %s" % (type(e).__name__, e))
+    return VHDUtilCheckResult(name, True, stats=collected)
+
+
+def check_many(names, workers=None, **kwargs):
+    """Check many VHDs across a pool of 'workers' processes, which
+    defaults to the number of CPUs.  Takes the same keyword arguments as
+    check() and collects stats unless skip_bat_overlap_check is set.
+
+    Returns a VHDUtilCheckResult per name, in the order given.  Failures
+    are reported in the results rather than raised, except for
+    VHDUtilNotSupported when there is no libvhd.so to check with.
+    """
+    kwargs.setdefault('stats', not kwargs.get('skip_bat_overlap_check'))
+    jobs = [(name, kwargs) for name in names]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(jobs) <= 1:
+        return map(_check_one, jobs)
+
+    # Recycle workers now and then to bound anything libvhd leaks
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1000)
+    try:
+        return pool.map(_check_one, jobs,
+                        chunksize=max(1, len(jobs) // (workers * 8)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Partitions of the block range handed to each verify() worker
+VERIFY_PARTITIONS_PER_WORKER = 4
+# Bytes of block data verify() reads at a time with check_data
+_VERIFY_READ_SIZE = 1 << 20
+
+_SECTOR = libvhd.VHD_SECTOR_SIZE
+_FOOTER_CHECKSUM_OFFSET = 64
+_HEADER_CHECKSUM_OFFSET = 36
+# The batmap header blktap keeps in the sector after the BAT
+_BATMAP_COOKIE = 'tdbatmap'
+_BATMAP_HEADER_FMT = '>8sQII'
+
+
+class VHDUtilVerifyReport(object):
+    """Everything verify() found wrong with a VHD.
+
+    'problems' is a list of dicts, each with a 'check' naming what
+    failed and a 'message'; problems with a block also have its number
+    as 'block', and overlaps name the other region as 'other'.
+    """
+
+    def __init__(self, name, problems, blocks_checked=0):
+        self.name = name
+        self.problems = problems
+        self.blocks_checked = blocks_checked
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def to_dict(self):
+        return {'name': self.name,
+                'ok': self.ok,
+                'blocks_checked': self.blocks_checked,
+                'problems': self.problems}
+
+    def __repr__(self):
+        if self.ok:
+            return "<VHDUtilVerifyReport %s: ok>" % self.name
+        return "<VHDUtilVerifyReport %s: %d problems>" % (
+                self.name, len(self.problems))
+
+
+def _problem(check, message, **details):
+    details['check'] = check
+    details['message'] = message
+    return details
+
+
+def _checksum(data, offset):
+    """One's complement of the byte sum of a footer or header, skipping
+    the checksum field at 'offset'.
+    """
+    total = sum(bytearray(data[:offset])) + sum(bytearray(data[offset + 4:]))
+    return ~total & 0xFFFFFFFF
+
+
+def _stored_checksum(data, offset):
+    return struct.unpack_from('>I', data, offset)[0]
+
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _verify_blocks(args):
+    """Check the bitmaps, and with 'check_data' read the data, of a
+    partition of the allocated blocks.  Runs in a verify() worker.
+    """
+    name, blocks, spb, bm_secs, total_secs, check_data = args
+    problems = []
+    with io.open(name, 'rb') as f:
+        for block, entry, full in blocks:
+            offset = entry * _SECTOR
+            secs = min(spb, total_secs - block * spb)
+            try:
+                bitmap = _read_at(f, offset, bm_secs * _SECTOR)
+                if full and any(not present for _, _, present in
+                        utils.bitmap_runs(bitmap, 0, secs)):
+                    problems.append(_problem('batmap_not_full',
+                            "Block %d is full in the batmap but not in "
+                            "its bitmap" % block, block=block))
+                if secs < spb and any(present for _, _, present in
+                        utils.bitmap_runs(bitmap, secs, spb)):
+                    problems.append(_problem('bitmap_past_end',
+                            "Block %d has sectors past the end of the "
+                            "disk marked" % block, block=block))
+                if not check_data:
+                    continue
+                data_offset = offset + bm_secs * _SECTOR
+                for pos in xrange(0, secs * _SECTOR, _VERIFY_READ_SIZE):
+                    _read_at(f, data_offset + pos,
+                             min(secs * _SECTOR - pos, _VERIFY_READ_SIZE))
+            except (IOError, OSError) as e:
+                problems.append(_problem('block_unreadable',
+                        "Error reading block %d: %s" % (block, e),
+                        block=block))
+    return problems
+
+
+def _find_overlaps(regions):
+    """Return a problem for every region of the file that starts before
+    the one with the furthest end so far; sorting makes this
+    O(n log n) rather than comparing every pair.  'regions' are
+    (start, end, label, block) tuples.
+    """
+    problems = []
+    furthest = None
+    for region in sorted(regions):
+        start, end, label, block = region
+        if furthest is not None and start < furthest[1]:
+            problems.append(_problem('overlap', "%s overlaps %s" % (
+                    label, furthest[2]), block=block, other=furthest[2]))
+        if furthest is None or end > furthest[1]:
+            furthest = region
+    return problems
+
+
+def verify(name, workers=None, check_data=False):
+    """Verify the structure of the VHD given by 'name' and return a
+    VHDUtilVerifyReport listing every problem found, rather than raising
+    on the first as check() does.
+
+    The footer, its copy and the header are checked, then the BAT and
+    the batmap, if there is one, are read once.  Entries past the end of
+    the disk or the file are reported, and overlaps between blocks, the
+    BAT, the batmap, the header and the parent locators are found in one
+    sorted sweep.  The bitmap of every allocated block is then checked,
+    by a pool of 'workers' processes (the number of CPUs by default)
+    each taking a range of blocks: blocks the batmap has as full must
+    have every sector marked, and no sector past the end of the disk may
+    be.  With 'check_data' every data sector is read as well, to find
+    any the storage can no longer return.  libvhd isn't used, so images
+    it can't open can still be verified.
+    """
+    if name is None:
+        raise exceptions.VHDUtilMissingArgument("'name' must be specified")
+
+    problems = []
+    with io.open(name, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        footer_offset = max(0, file_size - _SECTOR)
+        raw_footer = _read_at(f, footer_offset, _SECTOR)
+        footer_copy = _read_at(f, 0, _SECTOR)
+        if len(raw_footer) < _SECTOR or raw_footer[:8] != 'conectix':
+            problems.append(_problem('footer_missing',
+                    "No footer at the end of the file"))
+            if footer_copy[:8] != 'conectix' or len(footer_copy) < _SECTOR:
+                return VHDUtilVerifyReport(name, problems)
+            raw_footer = footer_copy
+        elif footer_copy != raw_footer and \
+                footer_copy[:8] == 'conectix':
+            problems.append(_problem('footer_copy_mismatch',
+                    "The footer copy differs from the footer"))
+        if _checksum(raw_footer, _FOOTER_CHECKSUM_OFFSET) != \
+                _stored_checksum(raw_footer, _FOOTER_CHECKSUM_OFFSET):
+            problems.append(_problem('footer_checksum',
+                    "Bad footer checksum"))
+        footer = libvhd._from_disk(libvhd.VHDFooter, libvhd._BE_FOOTER,
+                                   raw_footer)
+        total_secs = footer.curr_size // _SECTOR
+
+        if footer.type == libvhd.VHD_DISK_TYPES['fixed']:
+            if footer_offset < footer.curr_size:
+                problems.append(_problem('data_truncated',
+                        "The file is too short for the disk size"))
+            return VHDUtilVerifyReport(name, problems)
+        if footer.type not in (libvhd.VHD_DISK_TYPES['dynamic'],
+                               libvhd.VHD_DISK_TYPES['differencing']):
+            problems.append(_problem('disk_type',
+                    "Unknown disk type %d" % footer.type))
+            return VHDUtilVerifyReport(name, problems)
+
+        header_size = ctypes.sizeof(libvhd.VHDHeader)
+        raw_header = _read_at(f, footer.data_offset, header_size)
+        if len(raw_header) < header_size or raw_header[:8] != 'cxsparse':
+            problems.append(_problem('header_missing',
+                    "No header at offset %d" % footer.data_offset))
+            return VHDUtilVerifyReport(name, problems)
+        if _checksum(raw_header, _HEADER_CHECKSUM_OFFSET) != \
+                _stored_checksum(raw_header, _HEADER_CHECKSUM_OFFSET):
+            problems.append(_problem('header_checksum',
+                    "Bad header checksum"))
+        header = libvhd._from_disk(libvhd.VHDHeader, libvhd._BE_HEADER,
+                                   raw_header)
+        spb = header.block_size // _SECTOR
+        if not spb or header.block_size % _SECTOR:
+            problems.append(_problem('block_size',
+                    "Bad block size %d" % header.block_size))
+            return VHDUtilVerifyReport(name, problems)
+        bm_secs = -(-spb // (8 * _SECTOR))
+        num_blocks = -(-total_secs // spb)
+        if header.max_bat_size < num_blocks:
+            problems.append(_problem('bat_too_small',
+                    "The BAT has %d entries for %d blocks" %
+                    (header.max_bat_size, num_blocks)))
+
+        bat_size = header.max_bat_size * 4
+        raw_bat = _read_at(f, header.table_offset, bat_size)
+        if len(raw_bat) < bat_size:
+            problems.append(_problem('bat_truncated', "The BAT is cut short"))
+
+        batmap = None
+        batmap_regions = []
+        batmap_header_offset = header.table_offset + \
+                -(-bat_size // _SECTOR) * _SECTOR
+        batmap_header_size = struct.calcsize(_BATMAP_HEADER_FMT)
+        raw_batmap_header = _read_at(f, batmap_header_offset,
+                                     batmap_header_size)
+        if (len(raw_batmap_header) == batmap_header_size and
+                raw_batmap_header[:8] == _BATMAP_COOKIE):
+            _, batmap_offset, batmap_secs, _ = struct.unpack(
+                    _BATMAP_HEADER_FMT, raw_batmap_header)
+            batmap = _read_at(f, batmap_offset, batmap_secs * _SECTOR)
+            if len(batmap) < batmap_secs * _SECTOR:
+                problems.append(_problem('batmap_truncated',
+                        "The batmap is cut short"))
+                batmap = None
+            elif len(batmap) * 8 < num_blocks:
+                problems.append(_problem('batmap_too_small',
+                        "The batmap has %d bits for %d blocks" %
+                        (len(batmap) * 8, num_blocks)))
+            batmap_regions = [
+                    (batmap_header_offset, batmap_header_offset + _SECTOR,
+                     'batmap header', None),
+                    (batmap_offset, batmap_offset + batmap_secs * _SECTOR,
+                     'batmap', None)]
+    bat = array.array('I')
+    bat.fromstring(raw_bat[:len(raw_bat) // 4 * 4])
+    if sys.byteorder == 'little':
+        bat.byteswap()
+
+    regions = [(0, _SECTOR, 'footer copy', None),
+               (footer.data_offset, footer.data_offset + header_size,
+                'header', None),
+               (header.table_offset, header.table_offset + bat_size,
+                'BAT', None)] + batmap_regions
+    for i, loc in enumerate(header.loc):
+        if not loc.code:
+            continue
+        # As libvhd reads it: small values count sectors, others bytes
+        if loc.data_space < _SECTOR:
+            space = loc.data_space * _SECTOR
+        elif loc.data_space % _SECTOR == 0:
+            space = loc.data_space
+        else:
+            problems.append(_problem('locator_size',
+                    "Locator %d has a bad size %d" % (i, loc.data_space)))
+            continue
+        regions.append((loc.data_offset, loc.data_offset + space,
+                        'locator %d' % i, None))
+
+    full = set()
+    if batmap is not None:
+        for first, last, is_set in utils.bitmap_runs(
+                batmap, 0, min(num_blocks, len(batmap) * 8)):
+            if is_set:
+                full.update(xrange(first, last))
+
+    block_bytes = (bm_secs + spb) * _SECTOR
+    allocated = []
+    for block, entry in enumerate(bat):
+        if entry == libvhd.VHD_BAT_ENTRY_UNUSED:
+            if block in full:
+                problems.append(_problem('batmap_unallocated',
+                        "Block %d is full in the batmap but not "
+                        "allocated" % block, block=block))
+            continue
+        start = entry * _SECTOR
+        if block >= num_blocks:
+            problems.append(_problem('bat_entry_past_end',
+                    "Block %d is past the end of the disk" % block,
+                    block=block))
+            continue
+        if start + block_bytes > footer_offset:
+            problems.append(_problem('block_out_of_range',
+                    "Block %d at offset %d runs into the footer or past "
+                    "the end of the file" % (block, start), block=block))
+            continue
+        regions.append((start, start + block_bytes, 'block %d' % block,
+                        block))
+        allocated.append((block, entry, block in full))
+    problems.extend(_find_overlaps(regions))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    partitions = max(1, workers * VERIFY_PARTITIONS_PER_WORKER)
+    step = max(1, -(-len(allocated) // partitions))
+    jobs = [(name, allocated[i:i + step], spb, bm_secs, total_secs,
+             check_data) for i in xrange(0, len(allocated), step)]
+    if workers <= 1 or len(jobs) <= 1:
+        results = map(_verify_blocks, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            results = pool.map(_verify_blocks, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    for block_problems in results:
+        problems.extend(block_problems)
+
+    problems.sort(key=lambda problem: (problem.get('block', -1),
+                                       problem['check']))
+    return VHDUtilVerifyReport(name, problems, len(allocated))
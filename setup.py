@@ -15,7 +15,10 @@
 #    implied. See the License for the specific language governing
 #    permissions and limitations under the License.
 
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 package_dir = {'' : 'libvhd'}
 
@@ -27,4 +30,9 @@ setup(name='python-libvhd',
         url='http://www.github.com/comstud/python-libvhd',
         packages=['libvhd'],
         provides=['libvhd'],
+        # libvhd.aio needs asyncio, which Python 2 only has as backports
+        extras_require={
+            'aio': ['trollius; python_version < "3.4"',
+                    'futures; python_version < "3.2"'],
+        },
         license='Apache 2.0')
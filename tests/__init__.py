@@ -1 +1,45 @@
 __author__ = 'eddie'
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+
+class PyVHDTestCase(unittest.TestCase):
+    """Runs against the pure-Python backend, with VHDs in a temp dir."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.backend = pyvhd.PyLibVHD()
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _write(self, filename, sec, data):
+        vhd = libvhd.VHD(filename, 'rdwr')
+        try:
+            buf = utils.AlignedBuffer(len(data))
+            buf.write(data)
+            vhd.io_write(buf, sec, len(data) // libvhd.VHD_SECTOR_SIZE)
+        finally:
+            vhd.close()
+
+    def _contents(self, filename):
+        vhd = libvhd.VHD(filename)
+        try:
+            size = vhd.get_footer().curr_size
+            buf = utils.AlignedBuffer(size)
+            vhd.io_read(buf, 0, size // libvhd.VHD_SECTOR_SIZE)
+            return buf.read()
+        finally:
+            vhd.close()
@@ -0,0 +1,210 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import libvhd.utils.pipeline as pipeline
+import libvhd.utils.utils as utils
+from libvhd import aio
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+
+
+class _InlineIO(object):
+    """Stands in for an IOExecutor, running calls in the calling thread
+    and returning their results; needs neither asyncio nor futures.
+    """
+
+    def __init__(self, buffers=1, max_io_secs=4):
+        self.max_io_secs = max_io_secs
+        self.buffers = pipeline.BufferPool(buffers, max_io_secs * SECTOR,
+                                           alignment=SECTOR)
+
+    def run(self, loop, fn, *args):
+        return fn(*args)
+
+
+class _WatchedLock(object):
+    """A lock that says when someone starts waiting for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = threading.Event()
+
+    def __enter__(self):
+        self.waiting.set()
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class TestAsyncVHDInline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.io = _InlineIO()
+
+    def _open(self, name):
+        filename = os.path.join(self.tmpdir, name)
+        libvhd.vhd_create(filename, 4 * MB)
+        vhd = libvhd.VHD(filename, 'rdwr')
+        self.addCleanup(vhd.close)
+        return aio.AsyncVHD(vhd, loop=object(), io_executor=self.io)
+
+    def test_write_and_read(self):
+        vhd = self._open('a.vhd')
+        # Larger than the pooled buffer
+        data = ''.join(chr(i) * SECTOR for i in xrange(10))
+
+        vhd.write(100, data)
+
+        self.assertEqual(data, vhd.read(100, 10))
+        self.assertEqual('\x00' * SECTOR, vhd.read(0, 1))
+
+    def test_bad_write_size(self):
+        vhd = self._open('a.vhd')
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize, vhd.write, 0, 'x')
+
+    def test_busy_vhd_holds_no_buffer(self):
+        slow = self._open('slow.vhd')
+        other = self._open('other.vhd')
+        slow._lock = _WatchedLock()
+        results = []
+
+        with slow._lock:
+            # Queued behind whatever holds the slow VHD's lock
+            queued = threading.Thread(
+                    target=lambda: results.append(slow.read(0, 1)))
+            queued.start()
+            self.assertTrue(slow._lock.waiting.wait(5))
+            reader = threading.Thread(
+                    target=lambda: results.append(other.read(0, 1)))
+            reader.start()
+            reader.join(5)
+            # Done with the only buffer while the slow VHD is still busy
+            self.assertFalse(reader.is_alive())
+        queued.join(5)
+
+        self.assertEqual(['\x00' * SECTOR] * 2, results)
+
+    def test_default_loop_needs_backports(self):
+        with mock.patch.object(aio, 'asyncio', None):
+            self.assertRaises(ImportError, aio.AsyncVHD, None)
+            self.assertRaises(ImportError, aio.IOExecutor)
+
+
+@unittest.skipIf(aio.asyncio is None or aio.futures is None,
+                 "needs the 'aio' extra: asyncio, or trollius and futures")
+class TestAsyncVHD(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = aio.asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.io = aio.IOExecutor(concurrency=2, max_io_secs=4)
+        self.addCleanup(self.io.shutdown)
+        self.filename = os.path.join(self.tmpdir, 'a.vhd')
+        libvhd.vhd_create(self.filename, 4 * MB)
+
+    def _wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def _open(self, flags='rdwr'):
+        vhd = self._wait(aio.AsyncVHD.open(self.filename, flags,
+                                           loop=self.loop,
+                                           io_executor=self.io))
+        self.addCleanup(vhd.vhd.close)
+        return vhd
+
+    def test_write_and_read(self):
+        vhd = self._open()
+        # Larger than one pooled buffer
+        data = ''.join(chr(i) * SECTOR for i in xrange(10))
+
+        self._wait(vhd.write(100, data))
+
+        self.assertEqual(data, self._wait(vhd.read(100, 10)))
+        self.assertEqual('\x00' * SECTOR, self._wait(vhd.read(0, 1)))
+
+    def test_runs_off_the_loop_thread(self):
+        vhd = self._open()
+        threads = []
+        real_read = vhd.vhd.io_read
+
+        def _io_read(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return real_read(*args, **kwargs)
+        vhd.vhd.io_read = _io_read
+
+        self._wait(vhd.read(0, 1))
+
+        self.assertNotEqual(threading.current_thread(), threads[0])
+
+    def test_concurrent_reads(self):
+        vhd = self._open()
+        self._wait(vhd.write(0, 'x' * (8 * SECTOR)))
+
+        reads = [vhd.read(i, 1) for i in xrange(8)]
+        results = self._wait(aio.asyncio.gather(*reads, loop=self.loop))
+
+        self.assertEqual(['x' * SECTOR] * 8, results)
+
+    def test_bad_write_size(self):
+        vhd = self._open()
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize, self._wait,
+                          vhd.write(0, 'x'))
+
+    def test_errors_reach_the_caller(self):
+        self.assertRaises(libvhd.exceptions.VHDOpenFailure, self._wait,
+                          aio.AsyncVHD.open(os.path.join(self.tmpdir, 'x'),
+                                            loop=self.loop,
+                                            io_executor=self.io))
+
+    def test_converters(self):
+        raw = os.path.join(self.tmpdir, 'a.raw')
+        vhd = self._open()
+        self._wait(vhd.write(3, 'y' * SECTOR))
+        self._wait(vhd.close())
+
+        self._wait(aio.vhd_convert_to_raw(self.filename, raw,
+                                          loop=self.loop))
+
+        with open(raw, 'rb') as f:
+            data = f.read()
+        self.assertEqual(4 * MB, len(data))
+        self.assertEqual('y' * SECTOR, data[3 * SECTOR:4 * SECTOR])
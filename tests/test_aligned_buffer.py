@@ -16,6 +16,7 @@
 #    permissions and limitations under the License.
 
 import ctypes
+import io
 import unittest
 from libvhd.utils.utils import AlignedBuffer
 import libvhd.utils.exceptions as exceptions
@@ -243,3 +244,80 @@ class TestAlignedBuffer(unittest.TestCase):
 
         self.assertRaises(exceptions.BufferInvalidOffset, buf.get_pointer,
                           offset=offset)
+
+    def test_view_shares_memory(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        view = buf.view()
+        view[0:5] = "Hello"
+
+        self.assertEqual(buf_size, len(view))
+        self.assertFalse(view.readonly)
+        self.assertEqual("Hello", buf.read(size=5))
+        self.assertEqual("Hello", buf.get_pointer(size=5).contents.raw)
+
+    def test_view_with_size_and_offset(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        expected = "Hello world!"
+        buf.write(expected)
+
+        offset = 6
+        size = 5
+        view = buf.view(offset=offset, size=size)
+
+        self.assertEqual(expected[offset:offset + size], view.tobytes())
+
+    def test_view_with_too_large_size(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        self.assertRaises(exceptions.BufferInvalidSize, buf.view,
+                          offset=10, size=11)
+
+    def test_write_too_large(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        self.assertRaises(exceptions.BufferInvalidSize, buf.write,
+                          'x' * 21)
+
+    def test_readinto_view(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        f = io.BytesIO("Hello world!")
+        num = f.readinto(buf.view(offset=2))
+
+        self.assertEqual(12, num)
+        self.assertEqual("\x00\x00Hello world!", buf.read(size=14))
+
+    def test_zero(self):
+        buf_size = 20
+
+        buf = AlignedBuffer(buf_size)
+
+        buf.write("Hello world!")
+        buf.zero(offset=5, size=3)
+
+        self.assertEqual("Hello\x00\x00\x00rld!", buf.read(size=12))
+
+    def test_nonzero_sector_runs(self):
+        buf_size = 2048
+
+        buf = AlignedBuffer(buf_size)
+
+        buf.write("x", offset=600)
+        buf.write("y", offset=2047)
+
+        self.assertEqual([(1, 2), (3, 4)], buf.nonzero_sector_runs())
+        self.assertEqual([(1, 2)], buf.nonzero_sector_runs(size=1024))
+        self.assertEqual([(0, 1), (2, 3)],
+                         buf.nonzero_sector_runs(offset=512))
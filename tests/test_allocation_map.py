@@ -0,0 +1,119 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+import array
+import ctypes
+import mock
+import unittest
+import libvhd.utils.utils as utils
+import libvhd.utils.exceptions as exceptions
+from libvhd import libvhd
+
+UNUSED = libvhd.VHD_BAT_ENTRY_UNUSED
+
+
+class TestAllocationMap(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_open.return_value = 0
+        self.mock_libvhd.vhd_read_bitmap.side_effect = self._read_bitmap
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.free_patcher = mock.patch.object(utils, '_free')
+        self.mock_free = self.free_patcher.start()
+        self.addCleanup(self.free_patcher.stop)
+
+        self.vhd = libvhd.VHD('fred.vhd')
+        self.addCleanup(self.vhd.close)
+        self.entries = [UNUSED, 3, 4104, UNUSED, UNUSED, 8205]
+        self.raw_bat = (ctypes.c_uint32 * len(self.entries))(*self.entries)
+        ctx = self.vhd.vhd_context
+        ctx.footer.type = libvhd.VHD_DISK_TYPES['dynamic']
+        ctx.spb = 4096
+        ctx.bm_secs = 1
+        ctx.bat.spb = 4096
+        ctx.bat.entries = len(self.entries)
+        ctx.bat.bat = ctypes.addressof(self.raw_bat)
+        self.bitmaps = []
+
+    def _read_bitmap(self, ctx_p, block, bufp):
+        bitmap = ctypes.create_string_buffer(chr(block.value) * 512, 512)
+        self.bitmaps.append(bitmap)
+        bufp._obj.value = ctypes.addressof(bitmap)
+        return 0
+
+    def test_bat_copied_into_array(self):
+        alloc_map = self.vhd.allocation_map()
+
+        self.assertIsInstance(alloc_map.bat, array.array)
+        self.assertEqual(self.entries, alloc_map.bat.tolist())
+        self.assertEqual(4096, alloc_map.spb)
+        self.assertEqual({}, alloc_map.bitmaps)
+        self.assertEqual(0, self.mock_libvhd.vhd_read_bitmap.call_count)
+
+    def test_extents(self):
+        alloc_map = self.vhd.allocation_map()
+
+        self.assertEqual(3, alloc_map.num_allocated())
+        self.assertEqual([(1, 2), (5, 1)], alloc_map.extents())
+        self.assertEqual([(0, 1), (3, 2)], alloc_map.unallocated_extents())
+        self.assertFalse(alloc_map.is_allocated(0))
+        self.assertTrue(alloc_map.is_allocated(2))
+
+    def test_extents_ignore_unaligned_ff_bytes(self):
+        # 0xffffff00 followed by 0x000000ff must not look like a hole
+        alloc_map = libvhd.VHDAllocationMap(
+                array.array('I', [0xffffff00, 0x000000ff, UNUSED]), 4096)
+
+        self.assertEqual([(0, 2)], alloc_map.extents())
+        self.assertEqual([(2, 1)], alloc_map.unallocated_extents())
+
+    def test_all_bitmaps(self):
+        alloc_map = self.vhd.allocation_map(bitmaps=True)
+
+        self.assertEqual([1, 2, 5], sorted(alloc_map.bitmaps))
+        self.assertEqual(chr(2) * 512, alloc_map.bitmaps[2])
+        self.assertEqual(3, self.mock_free.call_count)
+        # chr(2) sets bit 6 of every byte
+        self.assertTrue(alloc_map.sector_allocated(2, 6))
+        self.assertFalse(alloc_map.sector_allocated(2, 7))
+        self.assertFalse(alloc_map.sector_allocated(0, 6))
+
+    def test_selected_bitmaps(self):
+        alloc_map = self.vhd.allocation_map(bitmaps=[0, 5])
+
+        self.assertEqual([5], list(alloc_map.bitmaps))
+
+    def test_read_bitmap_error(self):
+        self.mock_libvhd.vhd_read_bitmap.side_effect = None
+        self.mock_libvhd.vhd_read_bitmap.return_value = -5
+
+        self.assertRaises(exceptions.VHDReadError, self.vhd.read_bitmap, 1)
+
+    def test_fixed_disk_fully_allocated(self):
+        ctx = self.vhd.vhd_context
+        ctx.footer.type = libvhd.VHD_DISK_TYPES['fixed']
+        ctx.footer.curr_size = 5 * 4096 * 512 + 512
+
+        alloc_map = self.vhd.allocation_map(bitmaps=True)
+
+        self.assertEqual(6, len(alloc_map))
+        self.assertEqual([(0, 6)], alloc_map.extents())
+        self.assertEqual({}, alloc_map.bitmaps)
@@ -0,0 +1,61 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import ctypes
+import mock
+import unittest
+import libvhd.utils.utils as utils
+
+
+class TestBindings(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prototype_declared(self):
+        fn = utils._get_function('vhd_io_read')
+
+        self.assertEqual(ctypes.c_int, fn.restype)
+        self.assertEqual([ctypes.c_void_p, ctypes.c_void_p,
+                          ctypes.c_ulonglong, ctypes.c_uint], fn.argtypes)
+
+    def test_function_resolved_once(self):
+        fn = utils._get_function('vhd_open')
+        self.mock_libvhd.vhd_open = mock.MagicMock()
+
+        self.assertIs(fn, utils._get_function('vhd_open'))
+
+    def test_cache_follows_handle(self):
+        fn = utils._get_function('vhd_open')
+        other_libvhd = mock.MagicMock()
+        with mock.patch.object(utils, '_get_libvhd_handle',
+                               return_value=other_libvhd):
+            self.assertIs(other_libvhd.vhd_open,
+                          utils._get_function('vhd_open'))
+        self.assertIs(fn, utils._get_function('vhd_open'))
+        self.assertIs(self.mock_libvhd.vhd_open, fn)
+
+    def test_call_returns_python_values(self):
+        self.mock_libvhd.vhd_create.return_value = ctypes.c_int(-22)
+
+        self.assertEqual(-22, utils._call('vhd_create', 'fred.vhd', 512,
+                                          3, 0))
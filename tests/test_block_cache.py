@@ -0,0 +1,151 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import ctypes
+import mock
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd.cache import BlockCache
+
+UNUSED = libvhd.VHD_BAT_ENTRY_UNUSED
+SECTOR = libvhd.VHD_SECTOR_SIZE
+SPB = 8
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = BlockCache(10)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'y' * 4)
+        self.assertEqual('x' * 4, cache.get('a'))
+        cache.put('c', 'z' * 4)
+
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual('x' * 4, cache.get('a'))
+        self.assertEqual(8, cache.bytes)
+        self.assertEqual(1, cache.evictions)
+
+    def test_oversized_entry_not_cached(self):
+        cache = BlockCache(3)
+        cache.put('a', 'x' * 4)
+
+        self.assertEqual(0, len(cache))
+
+    def test_counters(self):
+        cache = BlockCache(10)
+        cache.get('a')
+        cache.put('a', 'x')
+        cache.get('a')
+        cache.invalidate('a')
+        cache.get('a')
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(0, stats['bytes'])
+
+
+class TestVHDCache(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_open.side_effect = self._open
+        self.mock_libvhd.vhd_io_read.side_effect = self._io_read
+        self.mock_libvhd.vhd_io_write.return_value = 0
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Block 1 is allocated in every child, the rest come from the
+        # parent.  Children's uuids end in their name; the parent's
+        # uuid has a NUL in it.
+        self.bat = (ctypes.c_uint32 * 3)(UNUSED, 3, UNUSED)
+        self.cache = BlockCache(1 << 20)
+        self.child1 = libvhd.VHD('child1', cache=self.cache)
+        self.child2 = libvhd.VHD('child2', cache=self.cache)
+        self.addCleanup(self.child1.close)
+        self.addCleanup(self.child2.close)
+        self.buf = utils.AlignedBuffer(3 * SPB * SECTOR)
+
+    def _open(self, ctx_p, filename, flags):
+        filename = filename.value
+        ctx = ctx_p.contents
+        ctx.footer.type = libvhd.VHD_DISK_TYPES['differencing']
+        ctx.footer.curr_size = 3 * SPB * SECTOR
+        ctx.footer.uuid = 'uuid-' + filename
+        ctx.header.prt_uuid = 'par\x00ent'
+        ctx.spb = SPB
+        ctx.bat.entries = 3
+        ctx.bat.bat = ctypes.addressof(self.bat)
+        ctx.file = filename
+        return 0
+
+    def _io_read(self, ctx_p, addr, sec, num_secs):
+        name = ctx_p.contents.file
+        data = ''.join(('%s:%d' % (name, s)).ljust(SECTOR, '\x00')
+                       for s in xrange(sec, sec + num_secs))
+        ctypes.memmove(addr, data, len(data))
+        return 0
+
+    def test_repeat_read_hits_cache(self):
+        self.child1.io_read(self.buf, 1, 2)
+        self.child1.io_read(self.buf, 3, 2)
+
+        self.assertEqual(1, self.mock_libvhd.vhd_io_read.call_count)
+        self.assertEqual(1, self.cache.hits)
+        self.assertTrue(self.buf.read(size=SECTOR).startswith('child1:3'))
+
+    def test_children_share_parent_blocks(self):
+        self.child1.io_read(self.buf, 0, SPB)
+        self.child2.io_read(self.buf, 0, SPB)
+
+        self.assertEqual(1, self.mock_libvhd.vhd_io_read.call_count)
+        self.assertEqual(1, self.cache.hits)
+
+    def test_children_dont_share_own_blocks(self):
+        self.child1.io_read(self.buf, SPB, SPB)
+        self.child2.io_read(self.buf, SPB, SPB)
+
+        self.assertEqual(2, self.mock_libvhd.vhd_io_read.call_count)
+        self.assertEqual(0, self.cache.hits)
+
+    def test_read_spanning_blocks(self):
+        self.child1.io_read(self.buf, SPB - 1, 2, offset=SECTOR)
+
+        self.assertEqual(2, self.mock_libvhd.vhd_io_read.call_count)
+        expected = 'child1:%d' % (SPB - 1)
+        self.assertEqual(expected,
+                         self.buf.read(SECTOR, SECTOR)[:len(expected)])
+
+    def test_write_invalidates_own_blocks(self):
+        self.child1.io_read(self.buf, SPB, SPB)
+        self.child1.io_write(self.buf, SPB + 1, 1)
+        self.child1.io_read(self.buf, SPB, SPB)
+
+        self.assertEqual(2, self.mock_libvhd.vhd_io_read.call_count)
+
+    def test_no_cache(self):
+        vhd = libvhd.VHD('fred')
+        vhd.io_read(self.buf, 0, 1)
+        vhd.io_read(self.buf, 0, 1)
+
+        self.assertEqual(2, self.mock_libvhd.vhd_io_read.call_count)
+        vhd.close()
@@ -0,0 +1,216 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import hashlib
+import json
+import mock
+import os
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+import tests
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+SPB = 4096
+
+
+class TestBlockManifest(tests.PyVHDTestCase):
+
+    def setUp(self):
+        super(TestBlockManifest, self).setUp()
+        self.filename = self._path('a.vhd')
+        # Three blocks, the last one half covered
+        libvhd.vhd_create(self.filename, 5 * MB)
+        self._write(self.filename, 0, 'a' * SECTOR)
+        self._write(self.filename, 2 * SPB + 7, 'c' * 2 * SECTOR)
+
+    def _open(self, filename=None):
+        vhd = libvhd.VHD(filename or self.filename)
+        self.addCleanup(vhd.close)
+        return vhd
+
+    def _expected(self, filename=None):
+        """md5 of each block, read the slow way."""
+        vhd = self._open(filename)
+        total_secs = vhd.get_footer().curr_size // SECTOR
+        buf = utils.AlignedBuffer(SPB * SECTOR)
+        hashes = []
+        for sec in xrange(0, total_secs, SPB):
+            secs = min(SPB, total_secs - sec)
+            vhd.io_read(buf, sec, secs)
+            hashes.append(hashlib.md5(buf.read(size=secs * SECTOR))
+                          .hexdigest())
+        return hashes
+
+    def _read_blocks(self):
+        """Patch the backend to record which blocks get read."""
+        blocks = []
+        real_read = self.backend.vhd_io_read
+
+        def _io_read(ctx_p, buf, sec, num_secs):
+            blocks.append(sec // SPB)
+            return real_read(ctx_p, buf, sec, num_secs)
+        self._patch_backend('vhd_io_read', side_effect=_io_read)
+        return blocks
+
+    def _patch_backend(self, name, **kwargs):
+        patcher = mock.patch.object(self.backend, name, **kwargs)
+        mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Bound functions are cached by name
+        utils._functions.clear()
+        self.addCleanup(utils._functions.clear)
+        return mocked
+
+    def _touch(self):
+        # Make sure the mtime differs on coarse-grained filesystems
+        os.utime(self.filename, (1, 1))
+
+    def test_hashes(self):
+        manifest = self._open().block_manifest(sidecar=False)
+
+        self.assertEqual(self._expected(), manifest.hashes)
+        self.assertEqual('md5', manifest.algorithm)
+        self.assertEqual(SPB * SECTOR, manifest.block_size)
+        self.assertEqual(3, len(manifest))
+
+    def test_unallocated_blocks_not_read(self):
+        vhd = self._open()
+        blocks = self._read_blocks()
+
+        manifest = vhd.block_manifest(sidecar=False)
+
+        self.assertEqual([0, 2], sorted(blocks))
+        self.assertEqual(hashlib.md5('\x00' * SPB * SECTOR).hexdigest(),
+                         manifest[1])
+
+    def test_no_sidecar_reads_no_bitmaps(self):
+        vhd = self._open()
+        bitmap = self._patch_backend('vhd_read_bitmap')
+
+        manifest = vhd.block_manifest(sidecar=False,
+                                      unsafe_trust_bitmaps=True)
+
+        self.assertFalse(bitmap.called)
+        self.assertEqual(self._expected(), manifest.hashes)
+
+    def test_algorithm(self):
+        manifest = self._open().block_manifest(algorithm='sha1',
+                                               sidecar=False)
+
+        self.assertEqual(40, len(manifest[0]))
+
+    def test_sidecar_reused_while_unchanged(self):
+        first = self._open().block_manifest()
+        self.assertTrue(os.path.exists(self.filename + '.manifest'))
+        blocks = self._read_blocks()
+
+        bitmap = self._patch_backend('vhd_read_bitmap')
+        second = self._open().block_manifest()
+
+        self.assertEqual([], blocks)
+        self.assertFalse(bitmap.called)
+        self.assertEqual(first, second)
+
+    def _write_behind_sidecar(self, sec, data):
+        """Write as another program would, leaving the sidecar in place."""
+        with open(self.filename + '.manifest') as f:
+            sidecar = f.read()
+        self._write(self.filename, sec, data)
+        with open(self.filename + '.manifest', 'w') as f:
+            f.write(sidecar)
+        self._touch()
+
+    def test_write_drops_sidecar(self):
+        self._open().block_manifest()
+
+        self._write(self.filename, SPB, 'b' * SECTOR)
+
+        self.assertFalse(os.path.exists(self.filename + '.manifest'))
+
+    def test_changed_file_rehashed(self):
+        self._open().block_manifest()
+        # Rewrites an allocated sector, leaving BAT and bitmaps alone
+        self._write_behind_sidecar(0, 'z' * SECTOR)
+        blocks = self._read_blocks()
+
+        manifest = self._open().block_manifest()
+
+        self.assertEqual([0, 2], sorted(blocks))
+        self.assertEqual(self._expected(), manifest.hashes)
+
+    def test_trust_bitmaps_rehashes_changed_blocks(self):
+        self._open().block_manifest()
+        self._write_behind_sidecar(2 * SPB + 100, 'd' * SECTOR)
+        blocks = self._read_blocks()
+
+        manifest = self._open().block_manifest(unsafe_trust_bitmaps=True)
+
+        self.assertEqual([2], blocks)
+        self.assertEqual(self._expected(), manifest.hashes)
+
+    def test_sidecar_for_another_disk_ignored(self):
+        self._open().block_manifest()
+        with open(self.filename + '.manifest') as f:
+            data = json.load(f)
+        data['uuid'] = '00' * 16
+        data['mtime'] = os.stat(self.filename).st_mtime
+        with open(self.filename + '.manifest', 'w') as f:
+            json.dump(data, f)
+        blocks = self._read_blocks()
+
+        self._open().block_manifest()
+
+        self.assertEqual([0, 2], sorted(blocks))
+
+    def test_no_sidecar(self):
+        self._open().block_manifest(sidecar=False)
+
+        self.assertFalse(os.path.exists(self.filename + '.manifest'))
+
+    def test_differencing_includes_parent(self):
+        child = self._path('child.vhd')
+        libvhd.vhd_create(child, 0, parent=self.filename)
+        self._write(child, SPB, 'b' * SECTOR)
+
+        manifest = self._open(child).block_manifest()
+
+        self.assertEqual(self._expected(child), manifest.hashes)
+        self.assertEqual(manifest, self._open(child).block_manifest())
+
+    def test_fixed(self):
+        fixed = self._path('fixed.vhd')
+        libvhd.vhd_create(fixed, 3 * MB, disk_type='fixed')
+        self._write(fixed, SPB, 'f' * SECTOR)
+
+        manifest = self._open(fixed).block_manifest(readers=1)
+
+        self.assertEqual(self._expected(fixed), manifest.hashes)
+
+    def test_diff(self):
+        before = self._open().block_manifest(sidecar=False)
+        self._write(self.filename, SPB, 'b' * SECTOR)
+        after = self._open().block_manifest(sidecar=False)
+
+        self.assertEqual([1], before.diff(after))
+        self.assertEqual([], after.diff(after))
+        self.assertEqual(after, libvhd.VHDBlockManifest.from_dict(
+                after.to_dict()))
+        other = libvhd.VHDBlockManifest('sha1', after.block_size,
+                                        after.size, after.hashes)
+        self.assertRaises(libvhd.exceptions.VHDException, after.diff, other)
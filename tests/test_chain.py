@@ -0,0 +1,177 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import chain
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+
+
+class TestChainScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_file = os.path.join(self.tmpdir, 'chain.json')
+
+        # base <- mid <- leaf1, mid <- leaf2, plus a fixed disk
+        libvhd.vhd_create(self._path('base.vhd'), 4 * MB)
+        libvhd.vhd_create(self._path('mid.vhd'), 0,
+                          parent=self._path('base.vhd'))
+        libvhd.vhd_create(self._path('leaf1.vhd'), 0,
+                          parent=self._path('mid.vhd'))
+        libvhd.vhd_create(self._path('leaf2.vhd'), 0,
+                          parent=self._path('mid.vhd'))
+        libvhd.vhd_create(self._path('fixed.vhd'), 1 * MB,
+                          disk_type='fixed')
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _uuid(self, name):
+        vhd = libvhd.VHD(self._path(name))
+        try:
+            return utils.uuid_unparse(
+                    libvhd._raw_field(vhd.vhd_context.footer, 'uuid'))
+        finally:
+            vhd.close()
+
+    def test_read_info(self):
+        info = chain.read_info(self._path('mid.vhd'))
+
+        vhd = libvhd.VHD(self._path('mid.vhd'))
+        self.addCleanup(vhd.close)
+        header = vhd.get_header()
+        self.assertEqual(self._uuid('mid.vhd'), info.uuid)
+        self.assertEqual(header.prt_uuid, info.parent_uuid)
+        self.assertEqual(header.prt_name, info.parent_name)
+        self.assertEqual(libvhd.VHD_DISK_TYPES['differencing'],
+                         info.disk_type)
+        self.assertEqual(4 * MB, info.virtual_size)
+
+    def test_read_info_fixed(self):
+        info = chain.read_info(self._path('fixed.vhd'))
+
+        self.assertEqual(self._uuid('fixed.vhd'), info.uuid)
+        self.assertEqual(1 * MB, info.virtual_size)
+        self.assertIsNone(info.parent_uuid)
+
+    def test_graph(self):
+        index = chain.scan_directory(self.tmpdir)
+        base, mid = self._uuid('base.vhd'), self._uuid('mid.vhd')
+        leaf1 = self._uuid('leaf1.vhd')
+
+        self.assertEqual(5, len(index))
+        self.assertEqual(mid, index.parent(leaf1).uuid)
+        self.assertIsNone(index.parent(base))
+        self.assertEqual([self._path('leaf1.vhd'), self._path('leaf2.vhd')],
+                         [info.path for info in index.children(mid)])
+        self.assertEqual([leaf1, mid, base],
+                         [info.uuid for info in index.chain(leaf1)])
+        self.assertEqual([self._path('base.vhd'), self._path('fixed.vhd')],
+                         [info.path for info in index.roots()])
+        self.assertEqual(set(['fixed.vhd', 'leaf1.vhd', 'leaf2.vhd']),
+                         set(os.path.basename(info.path)
+                             for info in index.leaves()))
+        self.assertEqual([], index.orphans())
+        self.assertEqual({}, index.errors)
+
+    def test_depth_matches_libvhd(self):
+        index = chain.scan_directory(self.tmpdir)
+
+        for name in ('base.vhd', 'mid.vhd', 'leaf1.vhd', 'fixed.vhd'):
+            vhd = libvhd.VHD(self._path(name))
+            self.addCleanup(vhd.close)
+            self.assertEqual(vhd.get_chain_depth(),
+                             index.depth(self._uuid(name)))
+
+    def test_orphans_and_errors(self):
+        os.remove(self._path('base.vhd'))
+        with open(self._path('junk.vhd'), 'wb') as f:
+            f.write('x' * 2048)
+
+        index = chain.scan_directory(self.tmpdir)
+
+        self.assertEqual([self._path('mid.vhd')],
+                         [info.path for info in index.orphans()])
+        self.assertEqual([self._path('junk.vhd')], index.errors.keys())
+
+    def test_corrupt_parent_name(self):
+        # A lone low surrogate at the start of the header's prt_name
+        with open(self._path('leaf2.vhd'), 'r+b') as f:
+            f.seek(512 + 64)
+            f.write('\xdc\x00')
+
+        index = chain.scan_directory(self.tmpdir)
+
+        self.assertEqual([self._path('leaf2.vhd')], index.errors.keys())
+        self.assertIn('UnicodeDecodeError',
+                      index.errors[self._path('leaf2.vhd')])
+        self.assertEqual(4, len(index))
+
+    def test_cache_skips_unchanged_files(self):
+        chain.scan_directory(self.tmpdir, cache_file=self.cache_file)
+        with mock.patch.object(chain, 'read_info',
+                               wraps=chain.read_info) as read_info:
+            index = chain.scan_directory(self.tmpdir,
+                                         cache_file=self.cache_file)
+
+        self.assertFalse(read_info.called)
+        self.assertEqual(3, index.depth(self._uuid('leaf1.vhd')))
+
+    def test_cache_rereads_changed_files(self):
+        chain.scan_directory(self.tmpdir, cache_file=self.cache_file)
+        os.remove(self._path('leaf2.vhd'))
+        os.remove(self._path('leaf1.vhd'))
+        libvhd.vhd_create(self._path('leaf1.vhd'), 0,
+                          parent=self._path('base.vhd'))
+        # Make sure the mtime differs on coarse-grained filesystems
+        os.utime(self._path('leaf1.vhd'), (1, 1))
+
+        with mock.patch.object(chain, 'read_info',
+                               wraps=chain.read_info) as read_info:
+            index = chain.scan_directory(self.tmpdir,
+                                         cache_file=self.cache_file)
+
+        self.assertEqual([self._path('leaf1.vhd')],
+                         [call[0][0] for call in read_info.call_args_list])
+        self.assertEqual(4, len(index))
+        leaf1 = self._uuid('leaf1.vhd')
+        self.assertEqual(self._uuid('base.vhd'), index.parent(leaf1).uuid)
+        with open(self.cache_file) as f:
+            self.assertEqual(4, len(json.load(f)['entries']))
+
+    def test_corrupt_cache_is_ignored(self):
+        with open(self.cache_file, 'wb') as f:
+            f.write('{not json')
+
+        index = chain.scan_directory(self.tmpdir, cache_file=self.cache_file)
+
+        self.assertEqual(5, len(index))
@@ -49,3 +49,90 @@ class TestCheck(unittest.TestCase):
                               vhdutils.check, name='fred',
                               skip_bat_overlap_check=True,
                               check_bitmaps=True)
+
+
+class TestCheckStats(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_util_check_vhd.side_effect = self._check_vhd
+        self.mock_libvhd.vhd_util_check_parents.return_value = 0
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        free_patcher = mock.patch.object(utils, '_free')
+        self.mock_free = free_patcher.start()
+        self.addCleanup(free_patcher.stop)
+        self.entries = []
+
+    def _check_vhd(self, ctx_p, name):
+        name = name.value
+        if name.startswith('bad'):
+            return -22
+        ctx = ctx_p.contents
+        self.assertEqual('\x01', ctx.opts.collect_stats)
+        head = ctx.stats
+        self.assertEqual(ctypes.addressof(head),
+                         ctypes.addressof(head.next.contents))
+        for i in xrange(2):
+            entry = vhdutils.VHDUtilCheckStats()
+            entry.name = '%s-%d' % (name, i)
+            entry.secs_total = 100
+            entry.secs_allocated = 10 * i
+            entry.secs_written = 5 * i
+            # list_add_tail
+            entry.next.next = ctypes.pointer(head)
+            entry.next.prev = head.prev
+            head.prev.contents.next = ctypes.pointer(entry.next)
+            head.prev = ctypes.pointer(entry.next)
+            self.entries.append(entry)
+        return 0
+
+    def test_check_returns_stats(self):
+        stats = vhdutils.check('fred.vhd', stats=True)
+
+        self.assertEqual([{'name': 'fred.vhd-0', 'secs_total': 100,
+                           'secs_allocated': 0, 'secs_written': 0},
+                          {'name': 'fred.vhd-1', 'secs_total': 100,
+                           'secs_allocated': 10, 'secs_written': 5}],
+                         stats)
+        # Each entry and its name
+        self.assertEqual(4, self.mock_free.call_count)
+
+    def test_check_error(self):
+        try:
+            vhdutils.check('bad.vhd')
+        except exceptions.VHDUtilCheckError as e:
+            self.assertEqual(22, e.errcode)
+        else:
+            self.fail("VHDUtilCheckError not raised")
+
+    def test_check_many_inline(self):
+        results = vhdutils.check_many(['a.vhd', 'bad.vhd', 'b.vhd'],
+                                      workers=1)
+
+        self.assertEqual(['a.vhd', 'bad.vhd', 'b.vhd'],
+                         [r.name for r in results])
+        self.assertEqual([True, False, True], [r.ok for r in results])
+        self.assertEqual(22, results[1].errcode)
+        self.assertEqual(10, results[2].stats[1]['secs_allocated'])
+
+    def test_check_many_pool(self):
+        names = ['a.vhd', 'bad.vhd', 'b.vhd', 'c.vhd']
+        results = vhdutils.check_many(names, workers=2)
+
+        self.assertEqual(names, [r.name for r in results])
+        self.assertEqual([True, False, True, True],
+                         [r.ok for r in results])
+        self.assertEqual('c.vhd-1', results[3].stats[1]['name'])
+
+    def test_check_many_without_bat_check_skips_stats(self):
+        self.mock_libvhd.vhd_util_check_vhd.side_effect = None
+        self.mock_libvhd.vhd_util_check_vhd.return_value = 0
+
+        results = vhdutils.check_many(['a.vhd'], workers=1,
+                                      skip_bat_overlap_check=True)
+
+        self.assertTrue(results[0].ok)
+        self.assertEqual([], results[0].stats)
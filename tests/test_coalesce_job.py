@@ -0,0 +1,172 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import observer
+from libvhd import pyvhd
+from libvhd import vhdutils
+
+MB = 1 << 20
+SPB = 4096
+SECTOR = libvhd.VHD_SECTOR_SIZE
+
+
+class TestCoalesceJob(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.base = self._path('base.vhd')
+        self.leaf = self._path('leaf.vhd')
+        libvhd.vhd_create(self.base, 8 * MB)
+        self._write(self.base, [(0, 'a' * 1024), (3 * SPB, 'b' * 512)])
+        libvhd.vhd_create(self.leaf, 0, parent=self.base)
+        self._write(self.leaf, [(1, 'c' * 512), (2 * SPB, 'd' * 512)])
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _write(self, filename, writes):
+        vhd = libvhd.VHD(filename, 'rdwr')
+        buf = utils.AlignedBuffer(2 * SECTOR)
+        for sec, data in writes:
+            buf.write(data)
+            vhd.io_write(buf, sec, len(data) // SECTOR)
+        vhd.close()
+
+    def _raw(self, filename):
+        raw = filename + '.raw'
+        libvhd.vhd_convert_to_raw(filename, raw)
+        with open(raw, 'rb') as f:
+            return f.read()
+
+    def test_ancestor(self):
+        expected = self._raw(self.leaf)
+
+        job = vhdutils.start_coalesce(self.leaf, ancestor=self.base)
+        job.result(10)
+
+        self.assertEqual(job.DONE, job.status())
+        self.assertEqual((8 * MB, 8 * MB), job.progress())
+        self.assertEqual(expected, self._raw(self.base))
+
+    def test_output(self):
+        output = self._path('out.vhd')
+        stats = observer.StatsObserver()
+
+        job = vhdutils.start_coalesce(self.leaf, output=output,
+                                      sparse=True, observer=stats)
+        job.result(10)
+
+        self.assertEqual(self._raw(self.leaf), self._raw(output))
+        self.assertEqual(8 * MB, stats.summary()['operations']['flatten'][
+                'done_bytes'])
+
+    def test_cancel(self):
+        started = threading.Event()
+        resume = threading.Event()
+
+        class _Blocking(observer.Observer):
+            def progress(self, op, done_bytes, total_bytes):
+                started.set()
+                resume.wait(10)
+
+        job = vhdutils.start_coalesce(self.leaf, ancestor=self.base,
+                                      observer=_Blocking(), readers=1)
+        self.assertTrue(started.wait(10))
+        self.assertFalse(job.done())
+        self.assertEqual(job.RUNNING, job.status())
+        job.cancel()
+        resume.set()
+
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.CANCELLED, job.status())
+        self.assertRaises(libvhd.exceptions.VHDUtilCoalesceCancelled,
+                          job.result)
+
+    def test_timeout(self):
+        job = vhdutils.start_coalesce(self.leaf, ancestor=self.base,
+                                      timeout=0)
+
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.TIMED_OUT, job.status())
+        self.assertRaises(libvhd.exceptions.VHDUtilCoalesceTimeout,
+                          job.result)
+
+    def test_failure(self):
+        job = vhdutils.start_coalesce(self.base, ancestor=self.leaf)
+
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.FAILED, job.status())
+        self.assertRaises(libvhd.exceptions.VHDException, job.result)
+
+    def test_bad_arguments(self):
+        self.assertRaises(
+                libvhd.exceptions.VHDUtilMutuallyExclusiveArguments,
+                vhdutils.start_coalesce, self.leaf, output='a',
+                ancestor='b')
+
+
+class TestCoalesceJobStepParent(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_runs_vhd_util(self):
+        self.mock_libvhd.vhd_util_coalesce_parent.return_value = 0
+
+        job = vhdutils.start_coalesce('fred.vhd', step_parent='p.vhd')
+        job.result(10)
+
+        self.assertEqual(job.DONE, job.status())
+
+    def test_error(self):
+        self.mock_libvhd.vhd_util_coalesce_parent.return_value = -5
+
+        job = vhdutils.start_coalesce('fred.vhd', step_parent='p.vhd')
+
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.FAILED, job.status())
+        self.assertTrue('EIO' in str(job.error))
+
+    def test_cancel_kills_child(self):
+        self.mock_libvhd.vhd_util_coalesce_parent.side_effect = \
+                lambda *args: time.sleep(30)
+
+        job = vhdutils.start_coalesce('fred.vhd', step_parent='p.vhd')
+        job.cancel()
+
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.CANCELLED, job.status())
@@ -0,0 +1,95 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import ctypes
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+
+SECTOR = libvhd.VHD_SECTOR_SIZE
+
+
+class TestConvertFromRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.src = os.path.join(self.tmpdir, 'in.raw')
+        self.writes = []
+
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_create.return_value = 0
+        self.mock_libvhd.vhd_open.return_value = 0
+        self.mock_libvhd.vhd_io_write.side_effect = self._io_write
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _io_write(self, ctx_p, buf_p, sec, num_secs):
+        data = ctypes.string_at(buf_p, num_secs * SECTOR)
+        self.writes.append((sec, data))
+        return 0
+
+    def _make_src(self, data):
+        with open(self.src, 'wb') as f:
+            f.write(data)
+
+    def test_non_sparse_writes_everything(self):
+        data = 'a' * SECTOR + '\x00' * SECTOR + 'b' * 10
+        self._make_src(data)
+
+        libvhd.vhd_convert_from_raw(self.src, 'fred.vhd')
+
+        expected = data + '\x00' * (SECTOR - 10)
+        self.assertEqual([(0, expected)], self.writes)
+        create_args = self.mock_libvhd.vhd_create.call_args[0]
+        self.assertEqual(3 * SECTOR, create_args[1].value)
+
+    def test_sparse_writes_nonzero_runs(self):
+        data = ('\x00' * SECTOR + 'a' * (2 * SECTOR) + '\x00' * SECTOR +
+                'b' * 10)
+        self._make_src(data)
+
+        libvhd.vhd_convert_from_raw(self.src, 'fred.vhd', sparse=True)
+
+        self.assertEqual([(1, 'a' * (2 * SECTOR)),
+                          (4, 'b' * 10 + '\x00' * (SECTOR - 10))],
+                         self.writes)
+
+    def test_sparse_skips_zero_chunks(self):
+        chunk = 4096 * SECTOR
+        self._make_src('\x00' * chunk + 'c' * SECTOR)
+
+        libvhd.vhd_convert_from_raw(self.src, 'fred.vhd', sparse=True)
+
+        self.assertEqual([(4096, 'c' * SECTOR)], self.writes)
+
+    def test_chunk_size_and_depth(self):
+        data = 'a' * SECTOR + '\x00' * SECTOR + 'b' * (3 * SECTOR)
+        self._make_src(data)
+
+        libvhd.vhd_convert_from_raw(self.src, 'fred.vhd', sparse=True,
+                                    chunk_secs=2, depth=3)
+
+        self.assertEqual([(0, 'a' * SECTOR), (2, 'b' * (2 * SECTOR)),
+                          (4, 'b' * SECTOR)], self.writes)
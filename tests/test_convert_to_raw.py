@@ -0,0 +1,111 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+import ctypes
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+
+UNUSED = libvhd.VHD_BAT_ENTRY_UNUSED
+SPB = 4096
+BLOCK_SIZE = SPB * libvhd.VHD_SECTOR_SIZE
+
+
+class TestConvertToRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, 'out.raw')
+
+        # Block 1 holds data, block 2 is allocated but zero-filled and
+        # block 3 is only partially covered by the virtual size.
+        self.entries = [UNUSED, 3, 4104, 8205]
+        self.raw_bat = (ctypes.c_uint32 * len(self.entries))(*self.entries)
+        self.disk_type = libvhd.VHD_DISK_TYPES['dynamic']
+        self.size = 3 * BLOCK_SIZE + 1024
+        self.reads = []
+
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_open.side_effect = self._open
+        self.mock_libvhd.vhd_io_read.side_effect = self._io_read
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _open(self, ctx_p, filename, flags):
+        ctx = ctx_p.contents
+        ctx.footer.type = self.disk_type
+        ctx.footer.curr_size = self.size
+        ctx.spb = SPB
+        ctx.bat.spb = SPB
+        ctx.bat.entries = len(self.entries)
+        ctx.bat.bat = ctypes.addressof(self.raw_bat)
+        return 0
+
+    def _io_read(self, ctx_p, buf_p, sec, num_secs):
+        self.reads.append((sec, num_secs))
+        if sec // SPB in (1, 3):
+            data = 'x' * (num_secs * libvhd.VHD_SECTOR_SIZE)
+        else:
+            data = '\x00' * (num_secs * libvhd.VHD_SECTOR_SIZE)
+        ctypes.memmove(buf_p, data, len(data))
+        return 0
+
+    def _expected_output(self):
+        return ('\x00' * BLOCK_SIZE + 'x' * BLOCK_SIZE +
+                '\x00' * BLOCK_SIZE + 'x' * 1024)
+
+    def _read_output(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_non_sparse_reads_everything(self):
+        libvhd.vhd_convert_to_raw('fred.vhd', self.dest)
+
+        self.assertEqual([(0, SPB), (SPB, SPB), (2 * SPB, SPB),
+                          (3 * SPB, 2)], self.reads)
+        self.assertEqual(self._expected_output(), self._read_output())
+
+    def test_sparse_skips_unallocated_blocks(self):
+        libvhd.vhd_convert_to_raw('fred.vhd', self.dest, sparse=True)
+
+        self.assertEqual([(SPB, SPB), (2 * SPB, SPB), (3 * SPB, 2)],
+                         self.reads)
+        self.assertEqual(self._expected_output(), self._read_output())
+
+    def test_sparse_trailing_hole_extends_file(self):
+        self.entries[3] = UNUSED
+        self.raw_bat[3] = UNUSED
+
+        libvhd.vhd_convert_to_raw('fred.vhd', self.dest, sparse=True)
+
+        self.assertEqual([(SPB, SPB), (2 * SPB, SPB)], self.reads)
+        self.assertEqual(self.size, os.stat(self.dest).st_size)
+
+    def test_sparse_differencing_reads_unallocated_blocks(self):
+        self.disk_type = libvhd.VHD_DISK_TYPES['differencing']
+
+        libvhd.vhd_convert_to_raw('fred.vhd', self.dest, sparse=True)
+
+        self.assertEqual(4, len(self.reads))
+        self.assertEqual(self._expected_output(), self._read_output())
@@ -0,0 +1,142 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import io
+import mock
+from libvhd import libvhd
+from libvhd import observer as vhd_observer
+import tests
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+SPB = 4096
+
+
+class TestDelta(tests.PyVHDTestCase):
+
+    def setUp(self):
+        super(TestDelta, self).setUp()
+        self.parent = self._path('parent.vhd')
+        self.child = self._path('child.vhd')
+        # Five blocks, the last one half covered
+        libvhd.vhd_create(self.parent, 9 * MB)
+        self._write(self.parent, 0, 'p' * 8 * SECTOR)
+        self._write(self.parent, SPB, 'p' * 8 * SECTOR)
+        libvhd.vhd_create(self.child, 0, parent=self.parent)
+        self._write(self.child, 2, 'a' * 3 * SECTOR)
+        self._write(self.child, 20, 'b' * SECTOR)
+        self._write(self.child, 2 * SPB + 5, 'c' * 2 * SECTOR)
+        self._write(self.child, 4 * SPB + 10, 'd' * SECTOR)
+
+    def _export(self, filename=None):
+        stream = io.BytesIO()
+        data_len = libvhd.vhd_export_delta(filename or self.child, stream)
+        stream.seek(0)
+        return stream, data_len
+
+    def test_exports_only_child_sectors(self):
+        stream, data_len = self._export()
+
+        self.assertEqual(7 * SECTOR, data_len)
+        # Header, four records and the end record
+        self.assertEqual(52 + 5 * 16 + data_len, len(stream.getvalue()))
+        self.assertNotIn('p', stream.getvalue()[52:])
+
+    def test_apply_to_new_child_of_parent(self):
+        stream, _ = self._export()
+        restored = self._path('restored.vhd')
+        libvhd.vhd_create(restored, 0, parent=self.parent)
+
+        libvhd.vhd_apply_delta(stream, restored)
+
+        self.assertEqual(self._contents(self.child),
+                         self._contents(restored))
+
+    def test_apply_to_parent(self):
+        stream, _ = self._export()
+        expected = self._contents(self.child)
+
+        libvhd.vhd_apply_delta(stream, self.parent)
+
+        self.assertEqual(expected, self._contents(self.parent))
+
+    def test_dynamic_disk_delta_is_self_contained(self):
+        stream, data_len = self._export(self.parent)
+        copy = self._path('copy.vhd')
+        libvhd.vhd_create(copy, 9 * MB)
+
+        libvhd.vhd_apply_delta(stream, copy)
+
+        self.assertEqual(16 * SECTOR, data_len)
+        self.assertEqual(self._contents(self.parent), self._contents(copy))
+
+    def test_wrong_parent(self):
+        stream, _ = self._export()
+        other = self._path('other.vhd')
+        libvhd.vhd_create(other, 9 * MB)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDelta,
+                          libvhd.vhd_apply_delta, stream, other)
+        stream.seek(0)
+        libvhd.vhd_apply_delta(stream, other, check_parent=False)
+        self.assertEqual('a' * 3 * SECTOR,
+                         self._contents(other)[2 * SECTOR:5 * SECTOR])
+
+    def test_size_mismatch(self):
+        stream, _ = self._export()
+        other = self._path('other.vhd')
+        libvhd.vhd_create(other, 4 * MB)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize,
+                          libvhd.vhd_apply_delta, stream, other,
+                          check_parent=False)
+
+    def test_truncated(self):
+        stream, _ = self._export()
+        data = stream.getvalue()
+        restored = self._path('restored.vhd')
+        libvhd.vhd_create(restored, 0, parent=self.parent)
+
+        for length in (30, 70, len(data) - 20, len(data) - 16):
+            self.assertRaises(libvhd.exceptions.VHDInvalidDelta,
+                              libvhd.vhd_apply_delta,
+                              io.BytesIO(data[:length]), restored)
+
+    def test_not_a_delta(self):
+        self.assertRaises(libvhd.exceptions.VHDInvalidDelta,
+                          libvhd.vhd_apply_delta, io.BytesIO('x' * 100),
+                          self.parent)
+
+    def test_fixed_disk(self):
+        fixed = self._path('fixed.vhd')
+        libvhd.vhd_create(fixed, 1 * MB, disk_type='fixed')
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDiskType,
+                          self._export, fixed)
+
+    def test_observer(self):
+        observer = mock.Mock(spec=vhd_observer.Observer)
+
+        libvhd.vhd_export_delta(self.child, io.BytesIO(), observer=observer)
+
+        size = 9 * MB
+        self.assertEqual(mock.call('export_delta', size, size),
+                         observer.progress.call_args)
+        skipped = sum(call[0][1]
+                      for call in observer.skipped.call_args_list)
+        self.assertEqual(size - 7 * SECTOR, skipped)
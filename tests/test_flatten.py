@@ -0,0 +1,166 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+SPB = 4096
+SECTOR = libvhd.VHD_SECTOR_SIZE
+
+
+class TestFlatten(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buf = utils.AlignedBuffer(8 * SECTOR)
+        self.dest = self._path('flat.vhd')
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _write(self, name, writes):
+        vhd = libvhd.VHD(self._path(name), 'rdwr')
+        for sec, data in writes:
+            self.buf.write(data)
+            vhd.io_write(self.buf, sec, len(data) // SECTOR)
+        vhd.close()
+
+    def _make_chain(self, base_type='dynamic'):
+        libvhd.vhd_create(self._path('base.vhd'), 8 * MB, base_type)
+        self._write('base.vhd', [(0, 'a' * 1024), (SPB + 7, 'b' * 512)])
+        libvhd.vhd_create(self._path('mid.vhd'), 0,
+                          parent=self._path('base.vhd'))
+        self._write('mid.vhd', [(1, 'c' * 512), (3 * SPB, 'd' * 512)])
+        libvhd.vhd_create(self._path('leaf.vhd'), 0,
+                          parent=self._path('mid.vhd'))
+        self._write('leaf.vhd', [(3 * SPB + 1, 'e' * 512)])
+
+    def _raw(self, name):
+        raw = self._path(name + '.raw')
+        libvhd.vhd_convert_to_raw(self._path(name), raw)
+        with open(raw, 'rb') as f:
+            return f.read()
+
+    def _bitmaps(self, name):
+        vhd = libvhd.VHD(self._path(name))
+        try:
+            alloc_map = vhd.allocation_map(bitmaps=True)
+            return dict((block, [sec for sec in xrange(SPB)
+                                 if alloc_map.sector_allocated(block, sec)])
+                        for block in alloc_map.bitmaps)
+        finally:
+            vhd.close()
+
+    def test_matches_chain_contents(self):
+        self._make_chain()
+
+        libvhd.vhd_flatten(self._path('leaf.vhd'), self.dest)
+
+        self.assertEqual(self._raw('leaf.vhd'), self._raw('flat.vhd'))
+        vhd = libvhd.VHD(self.dest)
+        self.assertEqual(1, vhd.get_chain_depth())
+        vhd.close()
+
+    def test_copies_only_held_sectors(self):
+        self._make_chain()
+
+        libvhd.vhd_flatten(self._path('leaf.vhd'), self.dest, readers=2)
+
+        self.assertEqual({0: [0, 1], 1: [7], 3: [0, 1]},
+                         self._bitmaps('flat.vhd'))
+
+    def test_reads_from_closest_owner(self):
+        self._make_chain()
+        reads = []
+        real_read = libvhd.VHD.io_read
+
+        def _io_read(vhd, buf, cur_sec, num_secs, offset=0):
+            reads.append((os.path.basename(vhd.filename), cur_sec))
+            return real_read(vhd, buf, cur_sec, num_secs, offset=offset)
+
+        with mock.patch.object(libvhd.VHD, 'io_read', _io_read):
+            libvhd.vhd_flatten(self._path('leaf.vhd'), self.dest,
+                               readers=1)
+
+        self.assertEqual([('mid.vhd', 0), ('base.vhd', SPB + 7),
+                          ('leaf.vhd', 3 * SPB)], reads)
+
+    def test_create_failure(self):
+        self._make_chain()
+
+        self.assertRaises(libvhd.exceptions.VHDCreateFailure,
+                          libvhd.vhd_flatten, self._path('leaf.vhd'),
+                          self._path('missing/flat.vhd'))
+
+    def test_fixed_base(self):
+        self._make_chain('fixed')
+
+        libvhd.vhd_flatten(self._path('leaf.vhd'), self.dest)
+
+        self.assertEqual(self._raw('leaf.vhd'), self._raw('flat.vhd'))
+        self.assertEqual({0: [0, 1], 1: [7], 3: [0, 1]},
+                         self._bitmaps('flat.vhd'))
+
+    def test_missing_parent(self):
+        self._make_chain()
+        os.unlink(self._path('base.vhd'))
+
+        self.assertRaises(libvhd.exceptions.VHDOpenFailure,
+                          libvhd.vhd_flatten, self._path('leaf.vhd'),
+                          self.dest)
+
+
+class TestGetParentPath(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.mkdir(os.path.join(self.tmpdir, 'sub'))
+        self.parent = os.path.join(self.tmpdir, 'sub', 'parent.vhd')
+        self.child = os.path.join(self.tmpdir, 'child.vhd')
+        libvhd.vhd_create(self.parent, MB)
+        libvhd.vhd_create(self.child, 0, parent=self.parent)
+
+    def test_from_locator(self):
+        vhd = libvhd.VHD(self.child)
+        self.addCleanup(vhd.close)
+
+        self.assertEqual(self.parent, vhd.get_parent_path())
+
+    def test_not_differencing(self):
+        vhd = libvhd.VHD(self.parent)
+        self.addCleanup(vhd.close)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDiskType,
+                          vhd.get_parent_path)
@@ -0,0 +1,119 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+BLOCK_SIZE = 2 * MB
+
+
+class _ReadOnlyStream(object):
+    """A stream with read() only, like a urllib2 response."""
+
+    def __init__(self, data, max_read=1000):
+        self.data = data
+        self.pos = 0
+        self.max_read = max_read
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        size = min(size, self.max_read)
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+
+class TestImportStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dest = os.path.join(self.tmpdir, 'out.vhd')
+        self.data = ('\x00' * BLOCK_SIZE + 'a' * 1000 +
+                     '\x00' * (BLOCK_SIZE - 1000) + 'b' * 700)
+
+    def _read_back(self):
+        raw = os.path.join(self.tmpdir, 'out.raw')
+        libvhd.vhd_convert_to_raw(self.dest, raw)
+        with open(raw, 'rb') as f:
+            return f.read()
+
+    def _allocated_blocks(self):
+        vhd = libvhd.VHD(self.dest)
+        try:
+            return vhd.allocation_map().extents()
+        finally:
+            vhd.close()
+
+    def test_create_failure(self):
+        self.dest = os.path.join(self.tmpdir, 'missing', 'out.vhd')
+
+        self.assertRaises(libvhd.exceptions.VHDCreateFailure,
+                          libvhd.vhd_import_stream, _ReadOnlyStream(self.data),
+                          self.dest, len(self.data))
+
+    def test_from_pipe(self):
+        src = os.path.join(self.tmpdir, 'in.raw')
+        with open(src, 'wb') as f:
+            f.write(self.data)
+        proc = subprocess.Popen(['cat', src], stdout=subprocess.PIPE)
+
+        libvhd.vhd_import_stream(proc.stdout, self.dest, len(self.data))
+        proc.wait()
+
+        expected = self.data + '\x00' * (512 - 700 % 512)
+        self.assertEqual(expected, self._read_back())
+        # The all-zero first block was never written
+        self.assertEqual([(1, 2)], self._allocated_blocks())
+
+    def test_read_only_stream(self):
+        libvhd.vhd_import_stream(_ReadOnlyStream(self.data), self.dest,
+                                 len(self.data), chunk_secs=8)
+
+        self.assertEqual(self.data, self._read_back()[:len(self.data)])
+
+    def test_not_sparse(self):
+        libvhd.vhd_import_stream(_ReadOnlyStream(self.data), self.dest,
+                                 len(self.data), sparse=False)
+
+        self.assertEqual([(0, 3)], self._allocated_blocks())
+
+    def test_short_stream(self):
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize,
+                          libvhd.vhd_import_stream,
+                          _ReadOnlyStream(self.data), self.dest,
+                          len(self.data) + 512)
+
+    def test_long_stream(self):
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize,
+                          libvhd.vhd_import_stream,
+                          _ReadOnlyStream(self.data), self.dest,
+                          len(self.data) - 512)
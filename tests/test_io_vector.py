@@ -0,0 +1,113 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import ctypes
+import errno
+import mock
+import os
+import unittest
+import libvhd.utils.utils as utils
+import libvhd.utils.exceptions as exceptions
+from libvhd import libvhd
+
+SECTOR = libvhd.VHD_SECTOR_SIZE
+
+
+class TestIOVector(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_libvhd = mock.MagicMock()
+        self.mock_libvhd.vhd_open.return_value = 0
+        self.mock_libvhd.vhd_io_read.side_effect = self._io_read
+        self.mock_libvhd.vhd_io_write.return_value = 0
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.mock_libvhd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.vhd = libvhd.VHD('fred.vhd', 'rdwr')
+        self.addCleanup(self.vhd.close)
+        self.buf = utils.AlignedBuffer(4 * SECTOR)
+
+    def _io_read(self, ctx_p, buf_p, sec, num_secs):
+        if sec >= 100:
+            return -5
+        data = chr(ord('a') + sec) * (num_secs * SECTOR)
+        ctypes.memmove(buf_p, data, len(data))
+        return 0
+
+    def test_readv_fills_buffer_offsets(self):
+        results = self.vhd.io_readv([(self.buf, 0, 1),
+                                     (self.buf, 2, 2, SECTOR)])
+
+        self.assertEqual([0, 0], results)
+        self.assertEqual('a' * SECTOR + 'c' * (2 * SECTOR),
+                         self.buf.read(size=3 * SECTOR))
+        self.assertEqual(1, self.mock_libvhd.vhd_open.call_count)
+
+    def test_readv_reports_per_item_results(self):
+        results = self.vhd.io_readv([(self.buf, 100, 1),
+                                     (self.buf, 1, 1, SECTOR)])
+
+        self.assertEqual([-5, 0], results)
+        self.assertEqual('b' * SECTOR, self.buf.read(SECTOR, SECTOR))
+
+    def test_writev_calls_libvhd_per_item(self):
+        results = self.vhd.io_writev([(self.buf, 7, 1),
+                                      (self.buf, 9, 3, SECTOR)])
+
+        self.assertEqual([0, 0], results)
+        calls = self.mock_libvhd.vhd_io_write.call_args_list
+        self.assertEqual([(7, 1), (9, 3)],
+                         [c[0][2:] for c in calls])
+        self.assertEqual(self.buf.buf_addr + SECTOR, calls[1][0][1])
+
+    def test_invalid_buffer(self):
+        self.assertRaises(exceptions.VHDInvalidBuffer, self.vhd.io_readv,
+                          [(self.buf, 0, 1), ('fred', 1, 1)])
+
+    def test_request_past_end_of_buffer(self):
+        self.assertRaises(exceptions.BufferInvalidSize, self.vhd.io_readv,
+                          [(self.buf, 0, 2, 3 * SECTOR)])
+        self.assertEqual(0, self.mock_libvhd.vhd_io_read.call_count)
+
+    def test_bad_request_issues_nothing(self):
+        self.assertRaises(exceptions.BufferInvalidSize, self.vhd.io_writev,
+                          [(self.buf, 0, 1), (self.buf, 1, 1, 4 * SECTOR)])
+        self.assertRaises(exceptions.VHDInvalidBuffer, self.vhd.io_writev,
+                          [(self.buf, 0, 1), ('fred', 1, 1)])
+        self.assertEqual(0, self.mock_libvhd.vhd_io_write.call_count)
+
+    def test_io_read_raises_on_error(self):
+        with mock.patch.object(ctypes, 'get_errno', return_value=0):
+            try:
+                self.vhd.io_read(self.buf, 100, 1)
+            except exceptions.VHDReadError as e:
+                self.assertIn(os.strerror(errno.EIO), str(e))
+            else:
+                self.fail("VHDReadError not raised")
+
+    def test_io_write_raises_on_error(self):
+        self.mock_libvhd.vhd_io_write.return_value = -errno.ENOSPC
+        with mock.patch.object(ctypes, 'get_errno', return_value=0):
+            try:
+                self.vhd.io_write(self.buf, 0, 1)
+            except exceptions.VHDWriteError as e:
+                self.assertIn(os.strerror(errno.ENOSPC), str(e))
+            else:
+                self.fail("VHDWriteError not raised")
@@ -0,0 +1,110 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import libvhd.utils.utils as utils
+from libvhd.utils import pipeline
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+SPB = 4096
+
+
+class TestIterExtents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create(self, disk_type, writes):
+        filename = os.path.join(self.tmpdir, '%s.vhd' % disk_type)
+        libvhd.vhd_create(filename, 6 * MB, disk_type)
+        vhd = libvhd.VHD(filename, 'rdwr')
+        buf = utils.AlignedBuffer(8 * libvhd.VHD_SECTOR_SIZE)
+        for sec, data in writes:
+            buf.write(data)
+            vhd.io_write(buf, sec, len(data) // libvhd.VHD_SECTOR_SIZE)
+        vhd.close()
+        vhd = libvhd.VHD(filename)
+        self.addCleanup(vhd.close)
+        return vhd
+
+    def _collect(self, extents):
+        return [(offset, data[:] if isinstance(data, buffer)
+                 else data.tobytes()) for offset, data in extents]
+
+    def test_sparse_dynamic(self):
+        vhd = self._create('dynamic', [(SPB + 3, 'x' * 1024),
+                                       (SPB + 8, 'y' * 512),
+                                       (2 * SPB, '\x00' * 512)])
+
+        extents = self._collect(vhd.iter_extents(chunk_secs=8))
+
+        self.assertEqual([((SPB + 3) * 512, 'x' * 1024),
+                          ((SPB + 8) * 512, 'y' * 512)], extents)
+
+    def test_non_sparse_covers_disk(self):
+        vhd = self._create('dynamic', [(5, 'x' * 512)])
+
+        extents = self._collect(vhd.iter_extents(sparse=False))
+
+        self.assertEqual([0, 2 * MB, 4 * MB], [e[0] for e in extents])
+        data = ''.join(e[1] for e in extents)
+        self.assertEqual(6 * MB, len(data))
+        self.assertEqual('x' * 512, data[5 * 512:6 * 512])
+
+    def test_views_come_from_a_small_pool(self):
+        vhd = self._create('dynamic', [(i * 64, 'z' * 512)
+                                       for i in xrange(100)])
+
+        with mock.patch.object(pipeline, 'AlignedBuffer',
+                               wraps=utils.AlignedBuffer) as mock_buffer:
+            extents = list(vhd.iter_extents(chunk_secs=64, depth=2))
+
+        self.assertEqual(100, len(extents))
+        self.assertEqual(2, mock_buffer.call_count)
+
+    def test_early_exit_stops_reader(self):
+        vhd = self._create('dynamic', [(i * 64, 'z' * 512)
+                                       for i in xrange(100)])
+
+        extents = vhd.iter_extents(chunk_secs=64)
+        next(extents)
+        extents.close()
+
+        self.assertEqual(1, threading.active_count())
+
+    def test_fixed_disk_uses_map(self):
+        vhd = self._create('fixed', [(SPB + 1, 'f' * 512)])
+
+        extents = list(vhd.iter_extents())
+
+        self.assertEqual(1, len(extents))
+        self.assertTrue(isinstance(extents[0][1], buffer))
+        self.assertEqual([((SPB + 1) * 512, 'f' * 512)],
+                         self._collect(extents))
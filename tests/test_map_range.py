@@ -0,0 +1,96 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import hashlib
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+
+
+class TestMapRange(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.filename = os.path.join(self.tmpdir, 'fixed.vhd')
+        libvhd.vhd_create(self.filename, 2 * MB, 'fixed')
+        self.vhd = libvhd.VHD(self.filename, 'rdwr')
+        self.addCleanup(self.vhd.close)
+        self.buf = utils.AlignedBuffer(4 * libvhd.VHD_SECTOR_SIZE)
+        self.buf.write('a' * 1024 + 'b' * 1024)
+        self.vhd.io_write(self.buf, 10, 4)
+
+    def test_maps_sectors(self):
+        data = self.vhd.map_range(10, 4)
+
+        self.assertEqual(2048, len(data))
+        self.assertEqual('a' * 1024 + 'b' * 1024, data[:])
+        self.assertEqual(hashlib.sha1('b' * 1024).hexdigest(),
+                         hashlib.sha1(self.vhd.map_range(12, 2)).hexdigest())
+
+    def test_sees_later_writes(self):
+        data = self.vhd.map_range(0, 1)
+        self.buf.write('c' * 512)
+        self.vhd.io_write(self.buf, 0, 1)
+
+        self.assertEqual('c' * 512, data[:])
+
+    def test_past_end(self):
+        self.assertRaises(libvhd.exceptions.VHDReadError,
+                          self.vhd.map_range, 4095, 2)
+
+    def test_dynamic_disk(self):
+        filename = os.path.join(self.tmpdir, 'dynamic.vhd')
+        libvhd.vhd_create(filename, 2 * MB)
+        vhd = libvhd.VHD(filename)
+        self.addCleanup(vhd.close)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDiskType,
+                          vhd.map_range, 0, 1)
+
+    def test_close_releases_map(self):
+        self.vhd.map_range(0, 1)
+        mapping = self.vhd._map
+        self.vhd.close()
+
+        self.assertRaises(ValueError, mapping.find, 'a')
+
+    def test_convert_to_raw(self):
+        dest = os.path.join(self.tmpdir, 'out.raw')
+        self.vhd.close()
+
+        libvhd.vhd_convert_to_raw(self.filename, dest, sparse=True)
+
+        with open(dest, 'rb') as f:
+            data = f.read()
+        self.assertEqual(2 * MB, len(data))
+        self.assertEqual('\x00' * 5120 + 'a' * 1024 + 'b' * 1024,
+                         data[:7168])
+        self.assertEqual(2 * MB - 7168, data.count('\x00', 7168))
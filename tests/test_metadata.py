@@ -0,0 +1,138 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import gc
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.backend = pyvhd.PyLibVHD()
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.parent = os.path.join(self.tmpdir, 'parent.vhd')
+        self.child = os.path.join(self.tmpdir, 'child.vhd')
+        libvhd.vhd_create(self.parent, 4 * MB)
+        libvhd.vhd_create(self.child, 0, parent=self.parent)
+
+    def _open(self, filename, flags='rdonly'):
+        vhd = libvhd.VHD(filename, flags)
+        self.addCleanup(vhd.close)
+        return vhd
+
+    def test_cached(self):
+        vhd = self._open(self.child)
+
+        self.assertIs(vhd.get_header(), vhd.get_header())
+        self.assertIs(vhd.get_footer(), vhd.get_footer())
+
+    def test_parent_name_decoded_once(self):
+        vhd = self._open(self.child)
+        with mock.patch.object(self.backend, 'vhd_header_decode_parent',
+                               wraps=self.backend.vhd_header_decode_parent
+                               ) as decode:
+            # Bound functions are cached by name
+            utils._functions.clear()
+            self.addCleanup(utils._functions.clear)
+            header = vhd.get_header()
+
+            self.assertEqual('parent.vhd', header.prt_name)
+            self.assertEqual('parent.vhd', header['prt_name'])
+            self.assertEqual('parent.vhd', vhd.get_header().prt_name)
+            self.assertEqual(1, decode.call_count)
+
+    def test_mapping_access(self):
+        vhd = self._open(self.child)
+        header = vhd.get_header()
+        footer = vhd.get_footer()
+
+        self.assertEqual(4 * MB, footer['curr_size'])
+        self.assertEqual(footer.curr_size, footer.get('curr_size'))
+        self.assertIsNone(footer.get('nonsense'))
+        self.assertRaises(KeyError, lambda: footer['nonsense'])
+        self.assertRaises(AttributeError, getattr, footer, 'nonsense')
+        self.assertIn('type', footer)
+        self.assertEqual(len(libvhd.VHDHeader._fields_), len(header))
+        self.assertEqual(set(header.keys()), set(header.to_dict()))
+        self.assertEqual((1, 0), (header.hdr_ver.major,
+                                  header.hdr_ver.minor))
+        self.assertEqual(libvhd.VHD_PLATFORM_CODES['PLAT_CODE_MACX'],
+                         header['loc'][0]['code'])
+        self.assertIn('curr_size', repr(vhd))
+
+    def test_immutable(self):
+        footer = self._open(self.child).get_footer()
+
+        self.assertRaises(AttributeError, setattr, footer, 'curr_size', 1)
+        self.assertRaises(AttributeError, setattr, footer, 'other', 1)
+        self.assertRaises(AttributeError, delattr, footer, 'curr_size')
+        self.assertFalse(hasattr(footer, '__dict__'))
+
+    def test_write_invalidates(self):
+        vhd = self._open(self.child, 'rdwr')
+        header = vhd.get_header()
+        footer = vhd.get_footer()
+        buf = utils.AlignedBuffer(libvhd.VHD_SECTOR_SIZE)
+
+        vhd.io_read(buf, 0, 1)
+        self.assertIs(footer, vhd.get_footer())
+
+        vhd.io_write(buf, 0, 1)
+        self.assertIsNot(header, vhd.get_header())
+        self.assertIsNot(footer, vhd.get_footer())
+        self.assertEqual(footer.uuid, vhd.get_footer().uuid)
+
+    def test_snapshot_survives_close(self):
+        vhd = libvhd.VHD(self.child)
+        footer = vhd.get_footer()
+        header = vhd.get_header()
+        vhd.close()
+
+        self.assertEqual(4 * MB, footer.curr_size)
+        self.assertEqual('parent.vhd', header.prt_name)
+
+    def test_parent_name_of_temporary_vhd(self):
+        # The VHD is gone, and closed, before prt_name is read
+        self.assertEqual('parent.vhd',
+                         libvhd.VHD(self.child).get_header().prt_name)
+
+    def test_no_reference_cycle(self):
+        vhd = libvhd.VHD(self.child)
+        vhd.get_header()
+        ref = weakref.ref(vhd)
+        gc.disable()
+        self.addCleanup(gc.enable)
+
+        del vhd
+
+        self.assertIsNone(ref())
@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import random
+import unittest
+from libvhd.utils.utils import nonzero_sector_runs
+
+
+def _slow_runs(data, sector_size):
+    runs = []
+    start = None
+    num_sectors = len(data) // sector_size
+    for i in xrange(num_sectors):
+        sector = data[i * sector_size:(i + 1) * sector_size]
+        if sector.strip('\x00'):
+            if start is None:
+                start = i
+        elif start is not None:
+            runs.append((start, i))
+            start = None
+    if start is not None:
+        runs.append((start, num_sectors))
+    return runs
+
+
+class TestNonzeroSectorRuns(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], nonzero_sector_runs(''))
+
+    def test_all_zero(self):
+        self.assertEqual([], nonzero_sector_runs('\x00' * 4096))
+
+    def test_all_nonzero(self):
+        self.assertEqual([(0, 8)], nonzero_sector_runs('x' * 4096))
+
+    def test_single_byte_marks_sector(self):
+        data = bytearray(4096)
+        data[1535] = 'x'
+        self.assertEqual([(2, 3)], nonzero_sector_runs(str(data)))
+
+    def test_unaligned_zero_runs_do_not_split(self):
+        # A 512 byte zero run straddling a sector boundary isn't a
+        # zero sector.
+        data = bytearray('x' * 2048)
+        data[256:768] = '\x00' * 512
+        self.assertEqual([(0, 4)], nonzero_sector_runs(str(data)))
+
+    def test_multiple_runs(self):
+        data = ('x' * 512 + '\x00' * 1024 + '\x00' * 511 + 'y' +
+                '\x00' * 512 + 'z' * 512)
+        self.assertEqual([(0, 1), (3, 4), (5, 6)],
+                         nonzero_sector_runs(data))
+
+    def test_bytearray(self):
+        data = bytearray(2048)
+        data[600] = 'x'
+        self.assertEqual([(1, 2)], nonzero_sector_runs(data))
+
+    def test_other_sector_size(self):
+        data = '\x00' * 8 + 'x' + '\x00' * 7
+        self.assertEqual([(1, 2)], nonzero_sector_runs(data, 8))
+
+    def test_matches_per_sector_scan(self):
+        rand = random.Random(42)
+        for _ in xrange(50):
+            data = bytearray(64 * 64)
+            for _ in xrange(rand.randint(0, 40)):
+                data[rand.randrange(len(data))] = chr(rand.randint(1, 255))
+            data = str(data)
+            self.assertEqual(_slow_runs(data, 64),
+                             nonzero_sector_runs(data, 64))
@@ -0,0 +1,178 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import observer
+from libvhd import pyvhd
+from libvhd import vhdutils
+
+MB = 1 << 20
+BLOCK_SIZE = 2 * MB
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        hist = observer.LatencyHistogram()
+        for usec in [3] * 90 + [100] * 9 + [5000]:
+            hist.record(usec / 1e6)
+
+        self.assertEqual(100, hist.count)
+        self.assertEqual(4e-6, hist.percentile(50))
+        self.assertEqual(128e-6, hist.percentile(99))
+        self.assertEqual(8192e-6, hist.percentile(100))
+        summary = hist.summary()
+        self.assertEqual({4: 90, 128: 9, 8192: 1}, summary['buckets_us'])
+        self.assertEqual(5000e-6, summary['max'])
+
+    def test_empty(self):
+        hist = observer.LatencyHistogram()
+
+        self.assertEqual(None, hist.percentile(50))
+        self.assertEqual({'count': 0}, hist.summary())
+
+
+class TestOperationReporting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.raw = os.path.join(self.tmpdir, 'in.raw')
+        self.vhd = os.path.join(self.tmpdir, 'out.vhd')
+        # One block of data, then two empty ones
+        with open(self.raw, 'wb') as f:
+            f.write('x' * BLOCK_SIZE)
+            f.truncate(3 * BLOCK_SIZE)
+        self.stats = observer.StatsObserver()
+
+    def test_convert_from_raw(self):
+        progress = []
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd, sparse=True,
+                                    observer=self.stats)
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd, sparse=True,
+                observer=observer.ProgressCallback(
+                        lambda *args: progress.append(args)))
+
+        summary = self.stats.summary()
+        op = summary['operations']['convert_from_raw']
+        self.assertEqual(3 * BLOCK_SIZE, op['total_bytes'])
+        self.assertEqual(3 * BLOCK_SIZE, op['done_bytes'])
+        self.assertEqual(2 * BLOCK_SIZE, op['skipped_bytes'])
+        self.assertEqual(None, op['error'])
+        self.assertTrue(op['seconds'] >= 0)
+        self.assertEqual(
+                1, summary['latency']['convert_from_raw']['write']['count'])
+        self.assertEqual(
+                [('convert_from_raw', i * BLOCK_SIZE, 3 * BLOCK_SIZE)
+                 for i in (1, 2, 3)], progress)
+
+    def test_convert_to_raw(self):
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd, sparse=True)
+
+        libvhd.vhd_convert_to_raw(self.vhd, self.raw, sparse=True,
+                                  observer=self.stats)
+
+        summary = self.stats.summary()
+        op = summary['operations']['convert_to_raw']
+        self.assertEqual(3 * BLOCK_SIZE, op['done_bytes'])
+        self.assertEqual(2 * BLOCK_SIZE, op['skipped_bytes'])
+        self.assertEqual(
+                1, summary['latency']['convert_to_raw']['read']['count'])
+
+    def test_flatten(self):
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd, sparse=True)
+
+        libvhd.vhd_flatten(self.vhd, os.path.join(self.tmpdir, 'flat.vhd'),
+                           observer=self.stats)
+
+        op = self.stats.summary()['operations']['flatten']
+        self.assertEqual(3 * BLOCK_SIZE, op['done_bytes'])
+        self.assertEqual(2 * BLOCK_SIZE, op['skipped_bytes'])
+
+    def test_latency_per_operation(self):
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd, sparse=True)
+        raw_out = os.path.join(self.tmpdir, 'out.raw')
+        threads = [
+                threading.Thread(target=libvhd.vhd_convert_to_raw,
+                                 args=(self.vhd, raw_out),
+                                 kwargs={'observer': self.stats}),
+                threading.Thread(target=libvhd.vhd_flatten,
+                                 args=(self.vhd,
+                                       os.path.join(self.tmpdir, 'flat.vhd')),
+                                 kwargs={'observer': self.stats})]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        latency = self.stats.summary()['latency']
+        self.assertEqual(set(['convert_to_raw', 'flatten']), set(latency))
+        self.assertEqual(3, latency['convert_to_raw']['read']['count'])
+        self.assertEqual(0, latency['convert_to_raw']['write']['count'])
+        self.assertEqual(1, latency['flatten']['read']['count'])
+        self.assertEqual(1, latency['flatten']['write']['count'])
+
+    def test_error_reported(self):
+        stats = mock.Mock(spec=observer.Observer)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize,
+                          libvhd.vhd_import_stream, open(self.raw, 'rb'),
+                          self.vhd, 4 * BLOCK_SIZE, observer=stats)
+
+        stats.begin.assert_called_once_with('import_stream',
+                                            4 * BLOCK_SIZE)
+        error = stats.end.call_args[1]['error']
+        self.assertTrue(isinstance(error, libvhd.exceptions.VHDInvalidSize))
+
+    def test_no_observer_no_timing(self):
+        libvhd.vhd_convert_from_raw(self.raw, self.vhd)
+        vhd = libvhd.VHD(self.vhd)
+        self.addCleanup(vhd.close)
+        buf = utils.AlignedBuffer(512)
+
+        with mock.patch.object(libvhd.VHD, '_timed_fn') as mock_timed:
+            vhd.io_read(buf, 0, 1)
+        self.assertFalse(mock_timed.called)
+
+
+class TestCoalesceReporting(unittest.TestCase):
+
+    @mock.patch.object(utils, '_get_libvhd_handle')
+    def test_begin_and_end(self, mock_handle):
+        mock_handle.return_value.vhd_util_coalesce_out.return_value = -5
+        stats = mock.Mock(spec=observer.Observer)
+
+        self.assertRaises(libvhd.exceptions.VHDUtilCoalesceError,
+                          vhdutils.coalesce, 'fred.vhd', output='out.vhd',
+                          observer=stats)
+
+        stats.begin.assert_called_once_with('coalesce', None)
+        error = stats.end.call_args[1]['error']
+        self.assertTrue(isinstance(error,
+                                   libvhd.exceptions.VHDUtilCoalesceError))
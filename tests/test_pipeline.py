@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import threading
+import time
+import unittest
+from libvhd.utils import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_writes_in_job_order(self):
+        written = []
+
+        def _read(buf, job):
+            buf.write(chr(ord('a') + job) * 4)
+            return job * 10
+
+        def _write(buf, job, result):
+            written.append((job, result, buf.read(size=4)))
+
+        pipeline.run(xrange(5), _read, _write, 512, depth=3)
+
+        self.assertEqual([(i, i * 10, chr(ord('a') + i) * 4)
+                          for i in xrange(5)], written)
+
+    def test_reader_bounded_by_depth(self):
+        read = []
+        ahead = []
+
+        def _read(buf, job):
+            read.append(job)
+            return None
+
+        def _write(buf, job, result):
+            # The reader holds at most 'depth' buffers
+            ahead.append(len(read) - job)
+
+        pipeline.run(xrange(20), _read, _write, 512, depth=2)
+
+        self.assertTrue(max(ahead) <= 2)
+
+    def test_buffers_are_reused(self):
+        seen = set()
+
+        def _write(buf, job, result):
+            seen.add(id(buf))
+
+        pipeline.run(xrange(10), lambda buf, job: None, _write, 512,
+                     depth=3)
+
+        self.assertTrue(len(seen) <= 3)
+
+    def test_reader_exception_raised_in_caller(self):
+        written = []
+
+        def _read(buf, job):
+            if job == 3:
+                raise IOError("fail")
+
+        def _write(buf, job, result):
+            written.append(job)
+
+        self.assertRaises(IOError, pipeline.run, xrange(10), _read, _write,
+                          512)
+        self.assertEqual([0, 1, 2], written)
+
+    def test_writer_exception_stops_reader(self):
+        read = []
+
+        def _read(buf, job):
+            read.append(job)
+
+        def _write(buf, job, result):
+            raise IOError("fail")
+
+        self.assertRaises(IOError, pipeline.run, xrange(100), _read, _write,
+                          512, depth=2)
+        self.assertTrue(len(read) < 100)
+        self.assertEqual(1, threading.active_count())
+
+    def test_bad_depth(self):
+        self.assertRaises(ValueError, pipeline.run, [], None, None, 512,
+                          depth=0)
+
+    def test_readers_written_in_order(self):
+        written = []
+        threads = set()
+
+        def _read(buf, job):
+            threads.add(threading.current_thread().name)
+            # Later jobs finish first
+            time.sleep((20 - job) * 0.001)
+            buf.write(chr(ord('a') + job))
+            return job
+
+        def _write(buf, job, result):
+            written.append((job, result, buf.read(size=1)))
+
+        pipeline.run(xrange(20), _read, _write, 512, readers=4)
+
+        self.assertEqual([(i, i, chr(ord('a') + i)) for i in xrange(20)],
+                         written)
+        self.assertTrue(len(threads) > 1)
+
+    def test_readers_exception_stops_all(self):
+        def _read(buf, job):
+            if job == 5:
+                raise IOError("fail")
+
+        self.assertRaises(IOError, pipeline.run, xrange(1000), _read,
+                          lambda buf, job, result: None, 512, readers=3)
+        self.assertEqual(1, threading.active_count())
+
+    def test_iterate_close_stops_readers(self):
+        items = pipeline.iterate(xrange(1000), lambda buf, job: job, 512,
+                                 readers=3)
+        self.assertEqual(0, next(items)[1])
+        items.close()
+
+        self.assertEqual(1, threading.active_count())
+
+    def test_bad_readers(self):
+        self.assertRaises(ValueError, pipeline.run, [], None, None, 512,
+                          readers=0)
@@ -0,0 +1,306 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import ctypes
+import errno
+import mock
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+from libvhd import vhdutils
+
+MB = 1 << 20
+SPB = 4096
+UNUSED = libvhd.VHD_BAT_ENTRY_UNUSED
+
+
+class PyVHDTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=pyvhd.PyLibVHD())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buf = utils.AlignedBuffer(8 * libvhd.VHD_SECTOR_SIZE)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _open(self, name, flags='rdonly'):
+        vhd = libvhd.VHD(self._path(name), flags)
+        self.addCleanup(vhd.close)
+        return vhd
+
+    def _write(self, vhd, sec, data):
+        self.buf.write(data)
+        vhd.io_write(self.buf, sec, len(data) // libvhd.VHD_SECTOR_SIZE)
+
+    def _read(self, vhd, sec, num_secs):
+        vhd.io_read(self.buf, sec, num_secs)
+        return self.buf.read(size=num_secs * libvhd.VHD_SECTOR_SIZE)
+
+
+class TestPyVHDCreate(PyVHDTestCase):
+
+    def test_dynamic_layout(self):
+        libvhd.vhd_create(self._path('a.vhd'), 5 * MB)
+
+        with open(self._path('a.vhd'), 'rb') as f:
+            data = f.read()
+        # Footer copy, two sectors of header, one each of BAT, batmap
+        # header and batmap, and the footer
+        self.assertEqual(7 * 512, len(data))
+        self.assertEqual(data[:512], data[-512:])
+        self.assertEqual('conectix', data[:8])
+        self.assertEqual('cxsparse', data[512:520])
+        self.assertEqual('\xff' * 12, data[1536:1548])
+        self.assertEqual('\x00' * 4, data[1548:1552])
+        self.assertEqual('\x00' * 512, data[2560:3072])
+
+    def test_batmap(self):
+        # libvhd reads a batmap from any disk tap 1.1 or later created
+        libvhd.vhd_create(self._path('a.vhd'), 5 * MB)
+
+        with open(self._path('a.vhd'), 'rb') as f:
+            data = f.read()
+        crtr_app, crtr_ver = struct.unpack('>4sI', data[28:36])
+        self.assertEqual('tap\x00', crtr_app)
+        self.assertTrue(crtr_ver >= 0x00010001)
+        cookie, offset, secs, version, checksum = struct.unpack(
+                '>8sQIII', data[2048:2076])
+        self.assertEqual('tdbatmap', cookie)
+        self.assertEqual((2560, 1, 0x00010002), (offset, secs, version))
+        self.assertEqual(~0 & 0xFFFFFFFF, checksum)
+
+    def test_differencing_layout(self):
+        libvhd.vhd_create(self._path('parent.vhd'), 5 * MB)
+        libvhd.vhd_create(self._path('child.vhd'), 0,
+                          parent=self._path('parent.vhd'))
+
+        with open(self._path('child.vhd'), 'rb') as f:
+            data = f.read()
+        self.assertEqual('tdbatmap', data[2048:2056])
+        # The MACX locator follows the batmap
+        locator = struct.unpack('>IIIIQ', data[512 + 576:512 + 600])
+        self.assertEqual(libvhd.VHD_PLATFORM_CODES['PLAT_CODE_MACX'],
+                         locator[0])
+        self.assertEqual(3072, locator[4])
+        self.assertEqual('file://./parent.vhd', data[3072:3091])
+        self.assertTrue(vhdutils.verify(self._path('child.vhd'),
+                                        workers=1).ok)
+
+    def test_checksums(self):
+        libvhd.vhd_create(self._path('a.vhd'), 5 * MB)
+
+        with open(self._path('a.vhd'), 'rb') as f:
+            footer = f.read(512)
+            header = f.read(1024)
+        for raw, offset in ((footer, 64), (header, 36)):
+            checksum = struct.unpack('>I', raw[offset:offset + 4])[0]
+            self.assertEqual(checksum, pyvhd._checksum(raw, offset))
+
+    def test_fixed(self):
+        libvhd.vhd_create(self._path('a.vhd'), 3 * MB, 'fixed')
+
+        self.assertEqual(3 * MB + 512, os.path.getsize(self._path('a.vhd')))
+        vhd = self._open('a.vhd')
+        footer = vhd.get_footer()
+        self.assertEqual(libvhd.VHD_DISK_TYPES['fixed'], footer['type'])
+        self.assertEqual(3 * MB, footer['curr_size'])
+        self.assertEqual(2, len(vhd.allocation_map()))
+
+    def test_differencing_needs_parent(self):
+        self.assertRaises(libvhd.exceptions.VHDInvalidDiskType,
+                          libvhd.vhd_create, self._path('a.vhd'), MB,
+                          'differencing')
+
+
+class TestPyVHDIO(PyVHDTestCase):
+
+    def setUp(self):
+        super(TestPyVHDIO, self).setUp()
+        libvhd.vhd_create(self._path('a.vhd'), 8 * MB)
+
+    def test_open_fills_context(self):
+        vhd = self._open('a.vhd')
+        ctx = vhd.vhd_context
+
+        self.assertEqual(SPB, ctx.spb)
+        self.assertEqual(1, ctx.bm_secs)
+        self.assertEqual(4, ctx.bat.entries)
+        self.assertEqual(libvhd.VHD_DISK_TYPES['dynamic'],
+                         vhd.get_footer()['type'])
+        self.assertEqual(2 * MB, vhd.get_header()['block_size'])
+        self.assertEqual(1, vhd.get_chain_depth())
+
+    def test_open_missing_file(self):
+        self.assertRaises(libvhd.exceptions.VHDOpenFailure, libvhd.VHD,
+                          self._path('nope.vhd'))
+
+    def test_unwritten_sectors_read_as_zero(self):
+        vhd = self._open('a.vhd', 'rdwr')
+        self._write(vhd, SPB + 2, 'x' * 1024)
+
+        data = self._read(vhd, SPB, 8)
+
+        self.assertEqual('\x00' * 1024 + 'x' * 1024 + '\x00' * 2048, data)
+        self.assertEqual('\x00' * 4096, self._read(vhd, 0, 8))
+
+    def test_write_persists_and_allocates(self):
+        vhd = self._open('a.vhd', 'rdwr')
+        self._write(vhd, 3 * SPB + 9, 'y' * 512)
+        self._write(vhd, SPB - 1, 'z' * 1024)
+        vhd.close()
+
+        vhd = self._open('a.vhd')
+        alloc_map = vhd.allocation_map(bitmaps=True)
+        self.assertEqual([(0, 2), (3, 1)], alloc_map.extents())
+        self.assertTrue(alloc_map.sector_allocated(3, 9))
+        self.assertFalse(alloc_map.sector_allocated(3, 8))
+        self.assertTrue(alloc_map.sector_allocated(0, SPB - 1))
+        self.assertTrue(alloc_map.sector_allocated(1, 0))
+        self.assertEqual('y' * 512, self._read(vhd, 3 * SPB + 9, 1))
+        self.assertEqual('z' * 1024, self._read(vhd, SPB - 1, 2))
+
+    def test_write_read_only(self):
+        vhd = self._open('a.vhd')
+        self.buf.zero()
+        self.assertRaises(libvhd.exceptions.VHDWriteError, vhd.io_write,
+                          self.buf, 0, 1)
+
+    def test_read_past_end(self):
+        vhd = self._open('a.vhd')
+        self.assertEqual([-22], vhd.io_readv([(self.buf, 4 * SPB - 1, 2)]))
+
+
+class TestPyVHDDifferencing(PyVHDTestCase):
+
+    def setUp(self):
+        super(TestPyVHDDifferencing, self).setUp()
+        libvhd.vhd_create(self._path('parent.vhd'), 4 * MB)
+        parent = libvhd.VHD(self._path('parent.vhd'), 'rdwr')
+        self._write(parent, 0, 'p' * 4096)
+        parent.close()
+        libvhd.vhd_create(self._path('child.vhd'), 0,
+                          parent=self._path('parent.vhd'))
+
+    def test_header(self):
+        vhd = self._open('child.vhd')
+        parent = self._open('parent.vhd')
+
+        header = vhd.get_header()
+        # vhd_snapshot keeps only the file name
+        self.assertEqual('parent.vhd', header['prt_name'])
+        self.assertEqual(
+                libvhd.VHD_PLATFORM_CODES['PLAT_CODE_MACX'],
+                header['loc'][0]['code'])
+        self.assertEqual(libvhd._raw_field(parent.vhd_context.footer, 'uuid'),
+                         libvhd._raw_field(vhd.vhd_context.header,
+                                           'prt_uuid'))
+        self.assertEqual(4 * MB, vhd.get_footer()['curr_size'])
+        self.assertEqual(2, vhd.get_chain_depth())
+
+    def test_parent_name_too_long(self):
+        # 257 UTF-16 characters don't fit in the header; it's checked
+        # before the parent, which no filesystem could hold, is opened
+        parent = self._path('p' * 253 + '.vhd')
+
+        ret = libvhd.vhd_create(self._path('long.vhd'), 0, parent=parent)
+
+        self.assertEqual(-errno.ENAMETOOLONG, ret)
+        self.assertFalse(os.path.exists(self._path('long.vhd')))
+
+    def test_reads_through_to_parent(self):
+        vhd = self._open('child.vhd', 'rdwr')
+        self._write(vhd, 2, 'c' * 512)
+
+        self.assertEqual('pp' + 'c' + 'ppppp',
+                         self._read(vhd, 0, 8)[::512])
+        parent = self._open('parent.vhd')
+        self.assertEqual('p' * 8, self._read(parent, 0, 8)[::512])
+
+    def test_parent_found_after_move(self):
+        os.mkdir(self._path('moved'))
+        for name in ('parent.vhd', 'child.vhd'):
+            os.rename(self._path(name), self._path('moved/' + name))
+
+        vhd = self._open('moved/child.vhd')
+        self.assertEqual('p' * 8, self._read(vhd, 0, 8)[::512])
+
+
+class TestBackendSelection(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_libvhd_handle', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(utils.LOG, 'warning')
+    @mock.patch.object(ctypes, 'CDLL', side_effect=OSError(
+            'libvhd.so: cannot open shared object file: %s' %
+            os.strerror(errno.ENOENT)))
+    def test_falls_back_without_libvhd(self, mock_cdll, mock_warning):
+        self.assertIsInstance(utils._get_libvhd_handle(), pyvhd.PyLibVHD)
+        self.assertTrue(mock_warning.called)
+
+    @mock.patch.object(ctypes, 'CDLL', side_effect=OSError(
+            'libvhd.so: wrong ELF class: ELFCLASS32'))
+    def test_broken_libvhd_raises(self, mock_cdll):
+        self.assertRaises(OSError, utils._get_libvhd_handle)
+        self.assertIsNone(utils._libvhd_handle)
+
+    @mock.patch.object(ctypes, 'CDLL', side_effect=OSError(
+            'libblktapctl.so.1: cannot open shared object file: %s' %
+            os.strerror(errno.ENOENT)))
+    def test_libvhd_missing_dependency_raises(self, mock_cdll):
+        self.assertRaises(OSError, utils._get_libvhd_handle)
+
+    @mock.patch.object(ctypes, 'CDLL')
+    def test_prefers_libvhd(self, mock_cdll):
+        self.assertEqual(mock_cdll.return_value, utils._get_libvhd_handle())
+
+
+class TestVHDUtilNotSupported(PyVHDTestCase):
+
+    def setUp(self):
+        super(TestVHDUtilNotSupported, self).setUp()
+        utils._functions.clear()
+        self.addCleanup(utils._functions.clear)
+        libvhd.vhd_create(self._path('a.vhd'), MB)
+
+    def test_check(self):
+        self.assertRaises(vhdutils.exceptions.VHDUtilNotSupported,
+                          vhdutils.check, self._path('a.vhd'))
+
+    def test_check_many(self):
+        # Not reported as every VHD failing its check
+        self.assertRaises(vhdutils.exceptions.VHDUtilNotSupported,
+                          vhdutils.check_many,
+                          [self._path('a.vhd')] * 2, workers=1)
+
+    def test_coalesce(self):
+        self.assertRaises(vhdutils.exceptions.VHDUtilNotSupported,
+                          vhdutils.coalesce, self._path('a.vhd'),
+                          step_parent=self._path('b.vhd'))
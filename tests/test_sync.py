@@ -0,0 +1,159 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import io
+import json
+import os
+import shutil
+from libvhd import libvhd
+import tests
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+SPB = 4096
+BLOCK_SIZE = SPB * SECTOR
+
+
+class TestSync(tests.PyVHDTestCase):
+
+    def setUp(self):
+        super(TestSync, self).setUp()
+        self.src = self._path('src.vhd')
+        self.dest = self._path('dest.vhd')
+        # Five blocks, the last one half covered
+        libvhd.vhd_create(self.src, 9 * MB)
+        for block in (0, 1, 3, 4):
+            self._write(self.src, block * SPB + 1,
+                        chr(ord('a') + block) * 64 * SECTOR)
+        shutil.copy(self.src, self.dest)
+
+    def _remote_manifest(self):
+        vhd = libvhd.VHD(self.dest)
+        try:
+            manifest = vhd.block_manifest(sidecar=False)
+        finally:
+            vhd.close()
+        # As it would arrive over the wire
+        return libvhd.VHDBlockManifest.from_dict(
+                json.loads(json.dumps(manifest.to_dict())))
+
+    def _sync(self):
+        patch = io.BytesIO()
+        sent = libvhd.vhd_sync_export(self.src, self._remote_manifest(),
+                                      patch, sidecar=False)
+        patch.seek(0)
+        return patch, sent
+
+    def _change_src(self):
+        self._write(self.src, SPB + 1, 'B' * 2 * SECTOR)
+        self._write(self.src, 2 * SPB, 'c' * SECTOR)
+        self._write(self.src, 3 * SPB + 1, '\x00' * 64 * SECTOR)
+
+    def test_sends_only_changed_blocks(self):
+        self._change_src()
+
+        patch, sent = self._sync()
+        libvhd.vhd_sync_apply(patch, self.dest)
+
+        self.assertEqual(2 * BLOCK_SIZE, sent)
+        # Header, two data records, one zero record and the end record
+        self.assertEqual(44 + 3 * (9 + 16) + 9 + sent,
+                         len(patch.getvalue()))
+        self.assertEqual(self._contents(self.src), self._contents(self.dest))
+
+    def _rewrite_allocated_sector(self, **kwargs):
+        libvhd.vhd_sync_export(self.src, self._remote_manifest(),
+                               io.BytesIO(), **kwargs)
+        # Leaves the BAT and the sector bitmap as they were
+        self._write(self.src, 1, 'y' * SECTOR)
+
+        patch = io.BytesIO()
+        sent = libvhd.vhd_sync_export(self.src, self._remote_manifest(),
+                                      patch, **kwargs)
+        patch.seek(0)
+        libvhd.vhd_sync_apply(patch, self.dest)
+
+        self.assertEqual(BLOCK_SIZE, sent)
+        self.assertEqual(self._contents(self.src), self._contents(self.dest))
+
+    def test_rewritten_sector_sent(self):
+        self._rewrite_allocated_sector()
+
+    def test_rewritten_sector_sent_with_sidecar(self):
+        self._rewrite_allocated_sector(sidecar=True)
+
+    def test_up_to_date(self):
+        patch, sent = self._sync()
+
+        self.assertEqual(0, sent)
+        self.assertEqual(44 + 9, len(patch.getvalue()))
+        libvhd.vhd_sync_apply(patch, self.dest)
+
+    def test_zero_blocks_written_over_parent(self):
+        os.remove(self.dest)
+        base = self._path('base.vhd')
+        libvhd.vhd_create(base, 9 * MB)
+        self._write(base, 2 * SPB, 'z' * 8 * SECTOR)
+        libvhd.vhd_create(self.dest, 0, parent=base)
+
+        patch, _ = self._sync()
+        libvhd.vhd_sync_apply(patch, self.dest)
+
+        self.assertEqual(self._contents(self.src), self._contents(self.dest))
+
+    def test_drops_destination_sidecar(self):
+        vhd = libvhd.VHD(self.dest)
+        vhd.block_manifest()
+        vhd.close()
+        self._change_src()
+
+        patch, _ = self._sync()
+        libvhd.vhd_sync_apply(patch, self.dest)
+
+        self.assertFalse(os.path.exists(self.dest + '.manifest'))
+
+    def test_corrupt_block(self):
+        self._change_src()
+        patch, _ = self._sync()
+        data = bytearray(patch.getvalue())
+        data[44 + 9 + 16 + 100] ^= 0xFF
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDelta,
+                          libvhd.vhd_sync_apply, io.BytesIO(str(data)),
+                          self.dest)
+
+    def test_truncated(self):
+        self._change_src()
+        patch, _ = self._sync()
+        data = patch.getvalue()
+
+        for length in (20, 60, len(data) - 5):
+            self.assertRaises(libvhd.exceptions.VHDInvalidDelta,
+                              libvhd.vhd_sync_apply,
+                              io.BytesIO(data[:length]), self.dest)
+
+    def test_size_mismatch(self):
+        other = self._path('other.vhd')
+        libvhd.vhd_create(other, 4 * MB)
+        vhd = libvhd.VHD(other)
+        self.addCleanup(vhd.close)
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidSize,
+                          libvhd.vhd_sync_export, self.src,
+                          vhd.block_manifest(sidecar=False), io.BytesIO(),
+                          sidecar=False)
@@ -0,0 +1,32 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import unittest
+import uuid
+from libvhd.utils.utils import uuid_unparse
+
+
+class TestUUIDUnparse(unittest.TestCase):
+
+    def test_leading_zero_bytes(self):
+        expected = uuid.UUID('0102030a-0b0c-0d0e-0f00-000000000010')
+
+        self.assertEqual(expected, uuid_unparse(expected.bytes))
+
+    def test_null_uuid(self):
+        self.assertEqual(uuid.UUID(int=0), uuid_unparse('\x00' * 16))
@@ -0,0 +1,250 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import errno
+import json
+import mock
+import os
+import struct
+from libvhd import libvhd
+from libvhd import vhdutils
+import tests
+
+MB = 1 << 20
+SECTOR = libvhd.VHD_SECTOR_SIZE
+SPB = 4096
+# pyvhd puts the header at 512 and the BAT at 1536
+BAT_OFFSET = 1536
+# The batmap header is in the sector after the BAT, the map after it
+BATMAP_HEADER_OFFSET = BAT_OFFSET + SECTOR
+BATMAP_OFFSET = BATMAP_HEADER_OFFSET + SECTOR
+
+
+class TestVerify(tests.PyVHDTestCase):
+
+    def setUp(self):
+        super(TestVerify, self).setUp()
+        self.filename = self._path('a.vhd')
+        # Three blocks, the last one half covered; two allocated
+        libvhd.vhd_create(self.filename, 5 * MB)
+        self._write(self.filename, 0, 'a' * SECTOR)
+        self._write(self.filename, SPB, 'b' * SECTOR)
+
+    def _bat_entry(self, block):
+        with open(self.filename, 'rb') as f:
+            f.seek(BAT_OFFSET + 4 * block)
+            return struct.unpack('>I', f.read(4))[0]
+
+    def _patch(self, offset, data):
+        with open(self.filename, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def _set_bat_entry(self, block, entry):
+        self._patch(BAT_OFFSET + 4 * block, struct.pack('>I', entry))
+
+    def _use_batmap(self, bits):
+        """Fill block 0, leaving block 1 partly written, and set the
+        batmap to 'bits'.
+        """
+        self._write(self.filename, 0, 'a' * SPB * SECTOR)
+        self._patch(BATMAP_OFFSET, bits)
+
+    def _checks(self, report):
+        return [(problem['check'], problem.get('block'))
+                for problem in report.problems]
+
+    def test_clean(self):
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertTrue(report.ok)
+        self.assertEqual(2, report.blocks_checked)
+
+    def test_clean_differencing(self):
+        child = self._path('child.vhd')
+        libvhd.vhd_create(child, 0, parent=self.filename)
+        self._write(child, 2 * SPB, 'c' * SECTOR)
+
+        report = vhdutils.verify(child, workers=1)
+
+        self.assertEqual([], report.problems)
+
+    def test_fixed(self):
+        fixed = self._path('fixed.vhd')
+        libvhd.vhd_create(fixed, 1 * MB, disk_type='fixed')
+
+        self.assertTrue(vhdutils.verify(fixed, workers=1).ok)
+
+    def test_overlapping_blocks(self):
+        self._set_bat_entry(1, self._bat_entry(0) + 8)
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('overlap', 1)], self._checks(report))
+        self.assertEqual('block 0', report.problems[0]['other'])
+
+    def test_block_over_bat(self):
+        self._set_bat_entry(1, 3)
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        # Moved there, block 1 also runs into the batmap and block 0
+        self.assertEqual([('overlap', None), ('overlap', None),
+                          ('overlap', 0), ('overlap', 1)],
+                         self._checks(report))
+        self.assertEqual(['block 1', 'block 1', 'block 1', 'BAT'],
+                         [problem['other'] for problem in report.problems])
+
+    def test_block_out_of_range(self):
+        self._set_bat_entry(1, 0x100000)
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('block_out_of_range', 1)], self._checks(report))
+        self.assertEqual(1, report.blocks_checked)
+
+    def test_bitmap_past_end(self):
+        self._write(self.filename, 2 * SPB, 'c' * SECTOR)
+        # Only the first 2048 sectors of block 2 are inside the disk
+        self._patch(self._bat_entry(2) * SECTOR + 256, '\x01')
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('bitmap_past_end', 2)], self._checks(report))
+
+    def test_batmap(self):
+        self._use_batmap('\x80')
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([], report.problems)
+        self.assertEqual(2, report.blocks_checked)
+
+    def test_batmap_not_full(self):
+        self._use_batmap('\xc0')
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('batmap_not_full', 1)], self._checks(report))
+
+    def test_batmap_unallocated(self):
+        self._use_batmap('\xa0')
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('batmap_unallocated', 2)], self._checks(report))
+
+    def test_batmap_truncated(self):
+        self._use_batmap('\xc0')
+        self._patch(BATMAP_HEADER_OFFSET + 8, struct.pack('>Q', 1 << 40))
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('batmap_truncated', None)], self._checks(report))
+
+    def test_batmap_overlap(self):
+        self._use_batmap('\x80')
+        self._patch(BATMAP_HEADER_OFFSET + 8,
+                    struct.pack('>Q', self._bat_entry(1) * SECTOR))
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('overlap', 1)], self._checks(report))
+        self.assertEqual('batmap', report.problems[0]['other'])
+
+    def _fail_data_reads(self, block):
+        """Make reads of a block's data fail; return the offsets read."""
+        data_offset = (self._bat_entry(block) + 1) * SECTOR
+        offsets = []
+        real_read_at = vhdutils._read_at
+
+        def _read_at(f, offset, size):
+            offsets.append(offset)
+            if offset == data_offset:
+                raise IOError(errno.EIO, os.strerror(errno.EIO))
+            return real_read_at(f, offset, size)
+        patcher = mock.patch.object(vhdutils, '_read_at',
+                                    side_effect=_read_at)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return data_offset, offsets
+
+    def test_data_not_read_by_default(self):
+        data_offset, offsets = self._fail_data_reads(1)
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertTrue(report.ok)
+        self.assertNotIn(data_offset, offsets)
+
+    def test_check_data(self):
+        self._fail_data_reads(1)
+
+        report = vhdutils.verify(self.filename, workers=1, check_data=True)
+
+        self.assertEqual([('block_unreadable', 1)], self._checks(report))
+
+    def test_bad_checksums_and_footer_copy(self):
+        self._patch(8, 'x')
+        self._patch(SECTOR + 100, 'x')
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual(set(['footer_copy_mismatch', 'header_checksum']),
+                         set(check for check, _ in self._checks(report)))
+
+    def test_missing_footer_falls_back_to_copy(self):
+        with open(self.filename, 'r+b') as f:
+            f.seek(-SECTOR, os.SEEK_END)
+            f.write('\x00' * SECTOR)
+
+        report = vhdutils.verify(self.filename, workers=1)
+
+        self.assertEqual([('footer_missing', None)], self._checks(report))
+
+    def test_not_a_vhd(self):
+        junk = self._path('junk')
+        with open(junk, 'wb') as f:
+            f.write('x' * 4096)
+
+        report = vhdutils.verify(junk)
+
+        self.assertEqual(['footer_missing'],
+                         [problem['check'] for problem in report.problems])
+
+    def test_reports_every_problem(self):
+        self._write(self.filename, 2 * SPB, 'c' * SECTOR)
+        self._set_bat_entry(1, self._bat_entry(0))
+        self._patch(self._bat_entry(2) * SECTOR + 256, '\x01')
+        self._patch(SECTOR + 100, 'x')
+
+        report = vhdutils.verify(self.filename, workers=2)
+
+        self.assertEqual([('header_checksum', None), ('overlap', 1),
+                          ('bitmap_past_end', 2)], self._checks(report))
+        self.assertFalse(report.ok)
+        self.assertEqual(report.problems,
+                         json.loads(json.dumps(report.to_dict()))['problems'])
+
+    def test_process_pool(self):
+        self.assertEqual(vhdutils.verify(self.filename, workers=1).problems,
+                         vhdutils.verify(self.filename, workers=2).problems)
+
+    def test_missing_name(self):
+        self.assertRaises(vhdutils.exceptions.VHDUtilMissingArgument,
+                          vhdutils.verify, None)
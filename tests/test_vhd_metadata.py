@@ -0,0 +1,105 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014, Rackspace Hosting, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#    implied. See the License for the specific language governing
+#    permissions and limitations under the License.
+
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import libvhd.utils.utils as utils
+from libvhd import libvhd
+from libvhd import pyvhd
+
+MB = 1 << 20
+
+
+class TestVHDMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.backend = pyvhd.PyLibVHD()
+        patcher = mock.patch.object(utils, '_get_libvhd_handle',
+                                    return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        libvhd.vhd_create(self._path('parent.vhd'), 8 * MB)
+        libvhd.vhd_create(self._path('child.vhd'), 0,
+                          parent=self._path('parent.vhd'))
+        libvhd.vhd_create(self._path('fixed.vhd'), 1 * MB,
+                          disk_type='fixed')
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _assert_same_as_vhd(self, name):
+        vhd = libvhd.VHD(self._path(name))
+        self.addCleanup(vhd.close)
+        meta = libvhd.VHDMetadata(self._path(name))
+
+        self.assertEqual(vhd.get_footer().to_dict(),
+                         meta.get_footer().to_dict())
+        header, meta_header = vhd.get_header(), meta.get_header()
+        for field in header:
+            if field == 'hdr_ver':
+                self.assertEqual(header.hdr_ver.version,
+                                 meta_header.hdr_ver.version)
+            else:
+                self.assertEqual(header[field], meta_header[field], field)
+        self.assertEqual(vhd.get_max_virtual_size(),
+                         meta.get_max_virtual_size())
+
+    def test_dynamic(self):
+        self._assert_same_as_vhd('parent.vhd')
+
+    def test_differencing(self):
+        self._assert_same_as_vhd('child.vhd')
+
+    def test_fixed(self):
+        self._assert_same_as_vhd('fixed.vhd')
+
+    def test_does_not_open_through_libvhd(self):
+        with mock.patch.object(self.backend, 'vhd_open') as vhd_open:
+            meta = libvhd.VHDMetadata(self._path('child.vhd'))
+
+            self.assertEqual('parent.vhd', meta.get_header().prt_name)
+            self.assertEqual(self._path('parent.vhd'),
+                             meta.get_parent_path())
+        self.assertFalse(vhd_open.called)
+
+    def test_parent_path_of_non_differencing(self):
+        meta = libvhd.VHDMetadata(self._path('parent.vhd'))
+
+        self.assertRaises(libvhd.exceptions.VHDInvalidDiskType,
+                          meta.get_parent_path)
+
+    def test_falls_back_to_footer_copy(self):
+        with open(self._path('parent.vhd'), 'r+b') as f:
+            f.seek(-512, os.SEEK_END)
+            f.write('\x00' * 512)
+
+        meta = libvhd.VHDMetadata(self._path('parent.vhd'))
+
+        self.assertEqual(8 * MB, meta.get_footer().curr_size)
+
+    def test_not_a_vhd(self):
+        with open(self._path('junk'), 'wb') as f:
+            f.write('x' * 4096)
+
+        self.assertRaises(libvhd.exceptions.VHDOpenFailure,
+                          libvhd.VHDMetadata, self._path('junk'))